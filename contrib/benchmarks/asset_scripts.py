@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of asset.get_asset_info_from_script over a corpus of
+# transfer/create/reissue/owner/tag output scripts (plus plain outputs),
+# with and without the cache of decoded scripts.
+#
+# The wallet decodes the same scripts over and over (history, balance, coin
+# selection), which is what the repeated passes stand for.
+#
+# usage: asset_scripts.py [num_scripts] [passes]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from electrum.asset import (
+    AssetMemo, generate_create_script, generate_reissue_script, generate_owner_script,
+    generate_transfer_script_from_base, generate_verifier_tag, generate_null_tag, generate_freeze_tag,
+    get_asset_info_from_script, _get_asset_info_from_script, ASSET_INFO_CACHE_SIZE)
+from electrum.bitcoin import address_to_script, hash160_to_p2pkh
+
+
+def make_corpus(num_scripts: int, rng: random.Random) -> list:
+    ipfs = bytes.fromhex('1220') + bytes(32)
+    def address():
+        return hash160_to_p2pkh(rng.randbytes(20))
+    def name():
+        return ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(rng.randint(3, 30)))
+    makers = [
+        lambda: address_to_script(address()),
+        lambda: address_to_script(address()),
+        lambda: generate_transfer_script_from_base(name(), rng.randint(1, 10**12), address_to_script(address())),
+        lambda: generate_transfer_script_from_base(name(), 1, address_to_script(address()),
+                                                   memo=AssetMemo(ipfs, rng.randint(0, 2**32))),
+        lambda: generate_create_script(address(), name(), 10**8, rng.randint(0, 8), True, rng.choice([ipfs, None])),
+        lambda: generate_reissue_script(address(), name(), 10**8, 0xff, False, rng.choice([ipfs, None])),
+        lambda: generate_owner_script(address(), name()),
+        lambda: generate_verifier_tag(f'#{name()[:20]}&!#{name()[:20]}'),
+        lambda: generate_null_tag('#' + name()[:20], rng.randbytes(20).hex(), rng.choice([True, False])),
+        lambda: generate_freeze_tag('$' + name()[:20], rng.choice([True, False])),
+    ]
+    return [bytes.fromhex(rng.choice(makers)()) for _ in range(num_scripts)]
+
+
+def bench(decode, corpus, passes: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(passes):
+        for script in corpus:
+            decode(script)
+    return time.perf_counter() - t0
+
+
+def main():
+    num_scripts = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    passes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    corpus = make_corpus(num_scripts, random.Random(0))
+
+    t_uncached = bench(_get_asset_info_from_script.__wrapped__, corpus, passes)
+    _get_asset_info_from_script.cache_clear()
+    t_cached = bench(get_asset_info_from_script, corpus, passes)
+    print(f"decoding {num_scripts} output scripts {passes} times (cache size {ASSET_INFO_CACHE_SIZE})")
+    print(f"  uncached: {t_uncached:.3f} s  ({num_scripts * passes / t_uncached:,.0f} scripts/s)")
+    print(f"  cached:   {t_cached:.3f} s  ({num_scripts * passes / t_cached:,.0f} scripts/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Benchmarks the startup cost of Blockchain.get_chainwork() over a
+# mainnet-sized headers file, without and with the persisted chainwork index.
+#
+# usage: chainwork_index.py [num_headers_after_last_checkpoint]
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from electrum import constants, blockchain
+from electrum.blockchain import Blockchain
+from electrum.simple_config import SimpleConfig
+from electrum.util import make_dir
+
+from headers_mmap import make_headers_file
+
+
+def startup(datadir: str) -> float:
+    """Simulates a fresh start: empty in-memory cache, instantiate the chain, get its chainwork."""
+    blockchain.blockchains = {}
+    blockchain._CHAINWORK_CACHE.clear()
+    blockchain._CHAINWORK_CACHE.update({
+        '0' * 64: 0,
+        constants.net.DGW_CHECKPOINTS[-1][1][0]: 0,
+    })
+    t0 = time.perf_counter()
+    config = SimpleConfig({'electrum_path': datadir})
+    chain = Blockchain(config=config, forkpoint=0, parent=None,
+                       forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+    chain.get_chainwork()
+    return time.perf_counter() - t0
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as datadir:
+        make_dir(os.path.join(datadir, 'forks'))
+        headers_path = os.path.join(datadir, 'blockchain_headers')
+        make_headers_file(headers_path, num_headers)
+        startup(datadir)  # warm up page cache and kawpow light cache
+        os.unlink(headers_path + '.chainwork')
+        t_cold = startup(datadir)
+        t_indexed = startup(datadir)
+        index_size = os.path.getsize(headers_path + '.chainwork')
+    print(f"startup get_chainwork() with {num_headers} headers after last checkpoint")
+    print(f"  without index: {t_cold:.3f} s")
+    print(f"  with index:    {t_indexed:.3f} s  ({index_size} bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Benchmarks Blockchain.get_chainwork() over a mainnet-sized headers file,
+# reading headers with plain file reads vs through the persistent mmap.
+#
+# usage: headers_mmap.py [num_headers_after_last_checkpoint]
+
+import os
+import sys
+import struct
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from electrum import constants, blockchain
+from electrum.blockchain import Blockchain, HEADER_SIZE
+from electrum.simple_config import SimpleConfig
+from electrum.util import make_dir
+
+
+def make_headers_file(path: str, num_headers: int) -> None:
+    """Writes a sparse file covering the checkpointed region,
+    followed by synthetic KawPoW headers."""
+    start_height = constants.net.max_checkpoint() + 1
+    bits = 0x1b01a3c4
+    with open(path, 'wb') as f:
+        f.seek(start_height * HEADER_SIZE)
+        for i in range(num_headers):
+            height = start_height + i
+            f.write(struct.pack('<I32s32sIIIQ32s',
+                                0x30000000,
+                                os.urandom(32),
+                                os.urandom(32),
+                                constants.net.KawpowActivationTS + 60 * height,
+                                bits,
+                                height,
+                                i,
+                                os.urandom(32)))
+
+
+def run(datadir: str, use_mmap: bool) -> float:
+    config = SimpleConfig({'electrum_path': datadir, 'blockchain_mmap_headers': use_mmap})
+    blockchain.blockchains = {}
+    # do not let the chainwork index of the previous run skip the header reads
+    index_path = os.path.join(datadir, 'blockchain_headers.chainwork')
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+    blockchain._CHAINWORK_CACHE.clear()
+    blockchain._CHAINWORK_CACHE.update({
+        '0' * 64: 0,
+        constants.net.DGW_CHECKPOINTS[-1][1][0]: 0,
+    })
+    chain = Blockchain(config=config, forkpoint=0, parent=None,
+                       forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+    t0 = time.perf_counter()
+    chain.get_chainwork()
+    return time.perf_counter() - t0
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as datadir:
+        make_dir(os.path.join(datadir, 'forks'))
+        make_headers_file(os.path.join(datadir, 'blockchain_headers'), num_headers)
+        run(datadir, use_mmap=True)  # warm up page cache and kawpow light cache
+        t_file = run(datadir, use_mmap=False)
+        t_mmap = run(datadir, use_mmap=True)
+    print(f"get_chainwork() over {num_headers} headers after last checkpoint")
+    print(f"  file reads: {t_file:.3f} s")
+    print(f"  mmap:       {t_mmap:.3f} s  ({t_file / t_mmap:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
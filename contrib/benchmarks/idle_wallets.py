@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Measures the CPU time used by idle loaded wallets, as in a daemon that has
+# many wallets open with nothing to sync. Each wallet runs its address
+# synchronizer, with its Synchronizer and SPV jobs, against a fake server
+# that reports no history for any address.
+#
+# usage: idle_wallets.py [--wallets N] [--seconds S] [--with-wallet-loop]
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from electrum import util
+from electrum.simple_config import SimpleConfig
+from electrum.wallet import restore_wallet_from_text
+
+
+XPUB = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+
+
+class IdleSession:
+
+    def subscribe_now(self, params, queue):
+        queue.put_nowait((params[0], None))
+
+    async def subscribe(self, method, params, queue):
+        self.subscribe_now(params, queue)
+
+    async def subscribe_batch(self, method, params_list, queue):
+        for params in params_list:
+            self.subscribe_now(params, queue)
+
+    def unsubscribe(self, queue):
+        pass
+
+
+class IdleInterface:
+
+    server = 'idle'
+
+    def __init__(self):
+        self.taskgroup = util.OldTaskGroup()
+        self.session = IdleSession()
+
+
+class IdleNetwork:
+
+    def __init__(self, config):
+        self.config = config
+        self.asyncio_loop = util.get_asyncio_loop()
+        self.interface = IdleInterface()
+
+    def blockchain(self):
+        return None
+
+    def get_local_height(self):
+        return 0
+
+
+async def run(args) -> float:
+    config = SimpleConfig({'electrum_path': tempfile.mkdtemp()})
+    network = IdleNetwork(config)
+    wallets = [restore_wallet_from_text(XPUB, path=None, config=config)['wallet']
+               for _ in range(args.wallets)]
+    for wallet in wallets:
+        if args.with_wallet_loop:
+            wallet.start_network(network)
+        else:
+            wallet.adb.start_network(network)
+    # let them subscribe to their addresses and settle
+    for _ in range(100):
+        await asyncio.sleep(0.1)
+        if all(wallet.adb.is_up_to_date() for wallet in wallets):
+            break
+    else:
+        raise Exception('wallets did not get up to date')
+    t0 = time.process_time()
+    await asyncio.sleep(args.seconds)
+    cpu = time.process_time() - t0
+    for wallet in wallets:
+        await wallet.stop()
+    await network.interface.taskgroup.cancel_remaining()
+    return cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU time used by idle wallets')
+    parser.add_argument('--wallets', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--with-wallet-loop', action='store_true',
+                        help='also run the wallet main loop (gap-limit address generation)')
+    args = parser.parse_args()
+    loop = util.get_asyncio_loop()
+    cpu = asyncio.run_coroutine_threadsafe(run(args), loop).result()
+    print(f"CPU time of {args.wallets} idle wallets over {args.seconds:.0f} s: "
+          f"{cpu:.3f} s ({100 * cpu / args.seconds:.1f}% of a core)")
+
+
+if __name__ == '__main__':
+    loop, stop_loop, loop_thread = util.create_and_start_event_loop()
+    try:
+        main()
+    finally:
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
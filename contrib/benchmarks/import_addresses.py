@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Benchmarks importing many watch-only addresses into an Imported_Wallet,
+# including the final write of the wallet file. A tenth of the input is
+# invalid or duplicate.
+#
+# usage: import_addresses.py [num_addresses]
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from electrum import util
+from electrum.bitcoin import hash160_to_p2pkh
+from electrum.simple_config import SimpleConfig
+from electrum.wallet import restore_wallet_from_text
+
+
+def make_addresses(num_addresses: int, rng: random.Random) -> list:
+    addresses = [hash160_to_p2pkh(rng.randbytes(20)) for _ in range(num_addresses)]
+    for i in rng.sample(range(num_addresses), num_addresses // 20):
+        addresses[i] = addresses[i][:-1] + ('1' if addresses[i][-1] != '1' else '2')
+    for i in rng.sample(range(num_addresses), num_addresses // 20):
+        addresses[i] = addresses[rng.randrange(num_addresses)]
+    return addresses
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rng = random.Random(0)
+    first_address = hash160_to_p2pkh(rng.randbytes(20))
+    addresses = make_addresses(num_addresses, rng)
+
+    with tempfile.TemporaryDirectory() as datadir:
+        config = SimpleConfig({'electrum_path': datadir})
+        wallet = restore_wallet_from_text(first_address, path=os.path.join(datadir, 'wallet'), config=config)['wallet']
+        t0 = time.perf_counter()
+        good, bad = wallet.import_addresses(addresses)
+        t_import = time.perf_counter() - t0
+        file_size = os.path.getsize(wallet.storage.path)
+
+    print(f"importing {num_addresses} addresses ({len(good)} new, {len(bad)} rejected, "
+          f"wallet file {file_size // 1000} kB)")
+    print(f"  {t_import:.2f} s")
+
+
+if __name__ == '__main__':
+    loop, stop_loop, loop_thread = util.create_and_start_event_loop()
+    try:
+        main()
+    finally:
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
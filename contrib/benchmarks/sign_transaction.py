@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Benchmarks PartialTransaction.sign() on a p2pkh transaction with many
+# inputs, where the legacy sighash preimage of every input covers all the
+# inputs and outputs of the transaction.
+#
+# usage: sign_transaction.py [num_inputs] [num_outputs] [num_workers]
+
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from electrum import descriptor, ecc
+from electrum.bitcoin import public_key_to_p2pkh, address_to_script
+from electrum.transaction import PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint
+from electrum.util import bfh
+
+
+def make_tx(num_inputs: int, num_outputs: int):
+    privkey = ecc.ECPrivkey(os.urandom(32))
+    pubkey = privkey.get_public_key_hex(compressed=True)
+    desc = descriptor.get_singlesig_descriptor_from_legacy_leaf(pubkey=pubkey, script_type='p2pkh')
+    inputs = []
+    for i in range(num_inputs):
+        txin = PartialTxInput(prevout=TxOutpoint(txid=os.urandom(32), out_idx=i % 3))
+        txin.script_descriptor = desc
+        txin._trusted_value_sats = 10 ** 8
+        txin.nsequence = 0xfffffffd
+        inputs.append(txin)
+    address = public_key_to_p2pkh(bfh(pubkey))
+    outputs = [PartialTxOutput(scriptpubkey=bfh(address_to_script(address)), value=10 ** 6)
+               for _ in range(num_outputs)]
+    tx = PartialTransaction.from_io(inputs, outputs, locktime=0, BIP69_sort=False)
+    return tx, {pubkey: (privkey.get_secret_bytes(), True)}
+
+
+def sign(tx: PartialTransaction, keypairs, num_workers: int) -> float:
+    t0 = time.perf_counter()
+    tx.sign(keypairs, None, num_workers=num_workers)
+    t = time.perf_counter() - t0
+    assert tx.is_complete()
+    return t
+
+
+def main():
+    num_inputs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    num_outputs = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    tx, keypairs = make_tx(num_inputs, num_outputs)
+    t_sign = sign(copy.deepcopy(tx), keypairs, 0)
+    print(f"signing a {num_inputs}-input, {num_outputs}-output p2pkh transaction")
+    print(f"  {t_sign:.2f} s  ({1000 * t_sign / num_inputs:.2f} ms per input)")
+    if num_workers > 1:
+        t_workers = sign(copy.deepcopy(tx), keypairs, num_workers)
+        print(f"  {t_workers:.2f} s with {num_workers} workers")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Parse throughput (tx/s) of Transaction.deserialize over the raw network
+# transactions recorded in electrum/tests (mainnet, testnet and Bitcoin Core
+# test vectors).
+#
+# usage: tx_parse.py [num_parses]
+
+import glob
+import os
+import re
+import sys
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, ROOT_DIR)
+
+from electrum.transaction import Transaction
+
+
+def load_corpus() -> list:
+    corpus = set()
+    for path in glob.glob(os.path.join(ROOT_DIR, 'electrum', 'tests', '*.py')):
+        with open(path) as f:
+            for raw_hex in re.findall(r"['\"]([0-9a-f]{120,})['\"]", f.read()):
+                if len(raw_hex) % 2:
+                    continue
+                raw = bytes.fromhex(raw_hex)
+                try:
+                    Transaction(raw).deserialize()
+                except Exception:
+                    continue  # not a network tx
+                corpus.add(raw)
+    return sorted(corpus)
+
+
+def main():
+    num_parses = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    corpus = load_corpus()
+    raws = (corpus * (num_parses // len(corpus) + 1))[:num_parses]
+    size = sum(map(len, raws))
+
+    t0 = time.perf_counter()
+    for raw in raws:
+        Transaction(raw).deserialize()
+    t = time.perf_counter() - t0
+
+    print(f"parsing {num_parses} txs ({len(corpus)} distinct, {size / num_parses:.0f} bytes on average)")
+    print(f"  {num_parses / t:.0f} tx/s  {size / t / 1e6:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -27,7 +27,6 @@ import itertools
 from collections import defaultdict
 from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List, Mapping, Union
 
-from .crypto import sha256
 from . import bitcoin, util
 from .bitcoin import COINBASE_MATURITY
 from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException, with_lock, OldTaskGroup
@@ -70,6 +69,19 @@ class HistoryItem(NamedTuple):
     balance: int
 
 
+class AddrBalance(NamedTuple):
+    """The unspent coins of an address, by what their balance category depends on.
+    Coinbase maturity and the spent inputs of unconfirmed coins are resolved when
+    the balance is queried, so an entry only goes stale when a tx of the address
+    is added or removed, or crosses between confirmed and unconfirmed.
+    """
+    # asset -> (value, number of coins) of the confirmed non-coinbase coins
+    confirmed: Mapping[Optional[str], Tuple[int, int]]
+    # (prevout_str, txid, asset, value)
+    coinbase: Sequence[Tuple[str, str, Optional[str], int]]
+    unconfirmed: Sequence[Tuple[str, str, Optional[str], int]]
+
+
 class AddressSynchronizer(Logger, EventListener):
     """ address database """
 
@@ -119,9 +131,9 @@ class AddressSynchronizer(Logger, EventListener):
         self.unverified_association = defaultdict(dict)
         self.unconfirmed_association = defaultdict(dict)
 
-        self._get_balance_cache = {}
-        self._get_asset_balance_cache = {}
-        self._get_assets_in_mempool_cache = {}
+        self._addr_balances = {}  # type: Dict[str, AddrBalance]
+        # scripthash -> outpoint -> (value, asset), built on first use
+        self._prevouts_by_scripthash = None  # type: Optional[Dict[str, Dict[TxOutpoint, Tuple[int, Optional[str]]]]]
 
         self.load_and_cleanup()
 
@@ -261,9 +273,6 @@ class AddressSynchronizer(Logger, EventListener):
 
     @event_listener
     def on_event_blockchain_updated(self, *args):
-        self._get_balance_cache = {}  # invalidate cache
-        self._get_asset_balance_cache = {}
-        self._get_assets_in_mempool_cache = {}
         self.db.put('stored_height', self.get_local_height())
 
     async def stop(self):
@@ -286,6 +295,17 @@ class AddressSynchronizer(Logger, EventListener):
             self.synchronizer.add(address)
         self.up_to_date_changed()
 
+    def add_addresses(self, addresses: Sequence[str]):
+        """Like add_address, for many addresses: the synchronizer gets them
+        as one batch, and the up-to-date status is updated once.
+        """
+        for address in addresses:
+            if address not in self.db.history:
+                self.db.history[address] = []
+        if self.synchronizer:
+            self.synchronizer.add_addresses(addresses)
+        self.up_to_date_changed()
+
     def get_conflicting_transactions(self, tx_hash, tx: Transaction, include_self=False):
         """Returns a set of transaction hashes from the wallet history that are
         directly conflicting with tx, i.e. they have common outpoints being
@@ -392,9 +412,7 @@ class AddressSynchronizer(Logger, EventListener):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v, asset)
-                        self._get_balance_cache.clear()  # invalidate cache
-                        self._get_asset_balance_cache.clear()
-                        self._get_assets_in_mempool_cache.clear()
+                        self._addr_balances.pop(addr, None)  # invalidate cache
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -415,20 +433,18 @@ class AddressSynchronizer(Logger, EventListener):
             for n, txo in enumerate(tx.outputs()):
                 v = txo.value
                 ser = tx_hash + ':%d'%n
-                asset_data = get_asset_info_from_script(txo.scriptpubkey)
-                scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
-                self.db.add_prevout_by_scripthash(scripthash, prevout=TxOutpoint.from_str(ser), value=asset_data.amount or v, asset=asset_data.asset)
                 addr = txo.address
                 if addr and self.is_mine(addr):
+                    asset_data = get_asset_info_from_script(txo.scriptpubkey)
                     self.db.add_txo_addr(tx_hash, addr, n, asset_data.amount or v, asset_data.asset, is_coinbase)
-                    self._get_balance_cache.clear()  # invalidate cache
-                    self._get_asset_balance_cache.clear()
-                    self._get_assets_in_mempool_cache.clear()
+                    self._addr_balances.pop(addr, None)  # invalidate cache
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, asset_data.amount or v, asset_data.asset)
                         self._add_tx_to_local_history(next_tx)
+                        self._add_tx_to_coin_index(next_tx)
+                        self._add_tx_to_prevouts_index(next_tx)
                     else:
                         if asset_data.asset:
                             self.watch_asset(asset_data.asset)
@@ -442,8 +458,10 @@ class AddressSynchronizer(Logger, EventListener):
 
             # add to local history
             self._add_tx_to_local_history(tx_hash)
+            self._add_tx_to_coin_index(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
+            self._add_tx_to_prevouts_index(tx_hash, tx)
             self.db.add_num_inputs_to_tx(tx_hash, len(tx.inputs()))
             if is_new:
                 util.trigger_callback('adb_added_tx', self, tx_hash, tx)
@@ -516,10 +534,9 @@ class AddressSynchronizer(Logger, EventListener):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
+            self._remove_tx_from_coin_index(tx_hash)
             for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_balance_cache.clear()  # invalidate cache
-                self._get_asset_balance_cache.clear()
-                self._get_assets_in_mempool_cache.clear()
+                self._addr_balances.pop(addr, None)  # invalidate cache
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
@@ -527,10 +544,8 @@ class AddressSynchronizer(Logger, EventListener):
             self.unverified_tx.pop(tx_hash, None)
             self.unconfirmed_tx.pop(tx_hash, None)
             if tx:
-                for idx, txo in enumerate(tx.outputs()):
-                    scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
-                    prevout = TxOutpoint(bfh(tx_hash), idx)
-                    self.db.remove_prevout_by_scripthash(scripthash, prevout=prevout, value=txo.value)
+                self._remove_tx_from_prevouts_index(tx_hash, tx)
+        self._wake_up_verifier()
         util.trigger_callback('adb_removed_tx', self, tx_hash, tx)
 
     def get_depending_transactions(self, tx_hash: str) -> Set[str]:
@@ -556,6 +571,7 @@ class AddressSynchronizer(Logger, EventListener):
                     self.unverified_tx.pop(tx_hash, None)
                     self.unconfirmed_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._invalidate_balances_for_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
@@ -576,13 +592,20 @@ class AddressSynchronizer(Logger, EventListener):
         # Store fees
         for tx_hash, fee_sat in tx_fees.items():
             self.db.add_tx_fee_from_server(tx_hash, fee_sat)
+        self._wake_up_verifier()
+        util.trigger_callback('adb_addr_history_updated', self, addr)
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # type: Dict[str, Set[str]]  # address -> set(txid)
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
+        # address -> prevout_str -> (prevout, txid, asset, value, is_coinbase)
+        self._addr_txos = defaultdict(dict)  # type: Dict[str, Dict[str, Tuple[TxOutpoint, str, Optional[str], int, bool]]]
+        # address -> prevout_str -> spending txid
+        self._addr_spends = defaultdict(dict)  # type: Dict[str, Dict[str, str]]
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             self._add_tx_to_local_history(txid)
+            self._add_tx_to_coin_index(txid)
 
     @profiler
     def check_history(self):
@@ -610,9 +633,10 @@ class AddressSynchronizer(Logger, EventListener):
             with self.transaction_lock:
                 self.db.clear_history()
                 self._history_local.clear()
-                self._get_balance_cache.clear()  # invalidate cache
-                self._get_asset_balance_cache.clear()
-                self._get_assets_in_mempool_cache.clear()
+                self._addr_txos.clear()
+                self._addr_spends.clear()
+                self._addr_balances.clear()  # invalidate cache
+                self._prevouts_by_scripthash = None
 
     def _get_tx_sort_key(self, tx_hash: str) -> Tuple[int, int]:
         """Returns a key to be used for sorting txs."""
@@ -712,6 +736,89 @@ class AddressSynchronizer(Logger, EventListener):
                     self._history_local[addr] = cur_hist
                     self._mark_address_history_changed(addr)
 
+    def _add_tx_to_coin_index(self, txid: str) -> None:
+        """Adds the is_mine outputs created and spent by txid, from db.txo and db.txi."""
+        with self.transaction_lock:
+            for addr in self.db.get_txo_addresses(txid):
+                txos = self._addr_txos[addr]
+                for n, (v, asset, is_cb) in self.db.get_txo_addr(txid, addr).items():
+                    prevout_str = f'{txid}:{n}'
+                    if prevout_str not in txos:
+                        txos[prevout_str] = (TxOutpoint(txid=bytes.fromhex(txid), out_idx=n), txid, asset, v, is_cb)
+            for addr in self.db.get_txi_addresses(txid):
+                spends = self._addr_spends[addr]
+                for prevout_str, v, asset in self.db.get_txi_addr(txid, addr):
+                    spends[prevout_str] = txid
+
+    def _remove_tx_from_coin_index(self, txid: str) -> None:
+        """Must be called before the txo and txi of txid are removed from the db."""
+        with self.transaction_lock:
+            for addr in self.db.get_txo_addresses(txid):
+                txos = self._addr_txos.get(addr, {})
+                for n in self.db.get_txo_addr(txid, addr):
+                    txos.pop(f'{txid}:{n}', None)
+            for addr in self.db.get_txi_addresses(txid):
+                spends = self._addr_spends.get(addr, {})
+                for prevout_str, v, asset in self.db.get_txi_addr(txid, addr):
+                    if spends.get(prevout_str) == txid:
+                        spends.pop(prevout_str)
+
+    def _add_tx_to_prevouts_index(self, txid: str, tx: Transaction = None) -> None:
+        """Adds the outputs of txid that are relevant to the wallet to the prevouts index,
+        if it has been built: all of them if the wallet funded txid (or if configured
+        to index all outputs), otherwise the is_mine ones.
+        """
+        with self.transaction_lock:
+            if self._prevouts_by_scripthash is None:
+                return
+            if self.config.WALLET_PREVOUTS_INDEX_ALL_OUTPUTS or self.db.get_txi_addresses(txid):
+                output_idxs = None
+            else:
+                output_idxs = {n for addr in self.db.get_txo_addresses(txid) for n in self.db.get_txo_addr(txid, addr)}
+                if not output_idxs:
+                    return
+            tx = tx or self.db.get_transaction(txid)
+            if tx is None:
+                return
+            for n, txo in enumerate(tx.outputs()):
+                if output_idxs is not None and n not in output_idxs:
+                    continue
+                asset_data = get_asset_info_from_script(txo.scriptpubkey)
+                scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
+                prevouts = self._prevouts_by_scripthash.setdefault(scripthash, {})
+                prevouts[TxOutpoint(txid=bytes.fromhex(txid), out_idx=n)] = (asset_data.amount or txo.value, asset_data.asset)
+
+    def _remove_tx_from_prevouts_index(self, txid: str, tx: Transaction) -> None:
+        with self.transaction_lock:
+            if self._prevouts_by_scripthash is None:
+                return
+            for n, txo in enumerate(tx.outputs()):
+                scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
+                prevouts = self._prevouts_by_scripthash.get(scripthash)
+                if prevouts is None:
+                    continue
+                prevouts.pop(TxOutpoint(txid=bytes.fromhex(txid), out_idx=n), None)
+                if not prevouts:
+                    self._prevouts_by_scripthash.pop(scripthash)
+
+    @with_lock
+    def get_prevouts_by_scripthash(self, scripthash: str) -> Set[Tuple[TxOutpoint, int, Optional[str]]]:
+        """Returns the (outpoint, value, asset) of the outputs paying to scripthash
+        among the wallet-relevant outputs (see _add_tx_to_prevouts_index).
+        """
+        assert isinstance(scripthash, str)
+        with self.transaction_lock:
+            if self._prevouts_by_scripthash is None:
+                self._prevouts_by_scripthash = {}
+                if self.config.WALLET_PREVOUTS_INDEX_ALL_OUTPUTS:
+                    txids = self.db.list_transactions()
+                else:
+                    txids = set(self.db.list_txi()) | set(self.db.list_txo())
+                for txid in txids:
+                    self._add_tx_to_prevouts_index(txid)
+            prevouts = self._prevouts_by_scripthash.get(scripthash, {})
+            return {(prevout, value, asset) for prevout, (value, asset) in prevouts.items()}
+
     def _mark_address_history_changed(self, addr: str) -> None:
         def set_and_clear():
             event = self._address_history_changed_events[addr]
@@ -731,6 +838,11 @@ class AddressSynchronizer(Logger, EventListener):
         assert self.is_mine(addr), "address needs to be is_mine to be watched"
         await self._address_history_changed_events[addr].wait()
 
+    def _wake_up_verifier(self) -> None:
+        # the verifier sleeps until there might be something new to verify
+        if self.verifier:
+            self.verifier.wake_up()
+
     def add_unverified_or_unconfirmed_tx(self, tx_hash, tx_height):
         if self.db.is_in_verified_tx(tx_hash):
             if tx_height <= 0:
@@ -738,6 +850,7 @@ class AddressSynchronizer(Logger, EventListener):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
                     self.unconfirmed_tx[tx_hash] = tx_height
+                    self._invalidate_balances_for_tx(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
@@ -746,6 +859,8 @@ class AddressSynchronizer(Logger, EventListener):
                     self.unverified_tx[tx_hash] = tx_height
                 else:
                     self.unconfirmed_tx[tx_hash] = tx_height
+                self._invalidate_balances_for_tx(tx_hash)
+        self._wake_up_verifier()
 
     def add_unverified_or_unconfirmed_asset_metadata(self, asset, d):
         metadata = StrictAssetMetadata(
@@ -782,6 +897,7 @@ class AddressSynchronizer(Logger, EventListener):
             else:
                 self.unconfirmed_asset_metadata[asset] = metadata, source, source_divisions, source_ipfs
                 util.trigger_callback('adb_added_unconfirmed_asset_metadata', self, asset)
+        self._wake_up_verifier()
 
     def get_unverified_asset_metadatas(self):
         '''Returns a map from tx hash to transaction height'''
@@ -877,6 +993,7 @@ class AddressSynchronizer(Logger, EventListener):
                 self.unverified_verifier_for_restricted[asset] = data
             else:
                 self.unconfirmed_verifier_for_restricted[asset] = data
+        self._wake_up_verifier()
 
     def get_restricted_verifier_string_for_synchronizer(self, asset: str) -> Dict[str, object]:
         with self.lock:
@@ -932,6 +1049,7 @@ class AddressSynchronizer(Logger, EventListener):
                 else:
                     self.unconfirmed_association[asset][res] = d
                     util.trigger_callback('adb_added_unconfirmed_association', self, asset, res)
+        self._wake_up_verifier()
 
     def get_associations_for_synchronizer(self, asset: str) -> Dict:
         with self.lock:
@@ -986,6 +1104,7 @@ class AddressSynchronizer(Logger, EventListener):
                 else:
                     self.unconfirmed_broadcast[asset][tx_hash] = d
                     util.trigger_callback('adb_added_unconfirmed_broadcast', self, asset, tx_hash)
+        self._wake_up_verifier()
 
     def get_broadcasts_for_synchronizer(self, asset: str) -> Dict[str, Dict[str, object]]:
         with self.lock:
@@ -1042,6 +1161,7 @@ class AddressSynchronizer(Logger, EventListener):
                 self.unverified_freeze_for_restricted[asset] = data
             else:
                 self.unconfirmed_freeze_for_restricted[asset] = data
+        self._wake_up_verifier()
 
     def get_restricted_freeze_for_synchronizer(self, asset: str) -> Dict[str, object]:
         with self.lock:
@@ -1104,6 +1224,7 @@ class AddressSynchronizer(Logger, EventListener):
                     self.unverified_tags_for_h160[h160][asset] = d
                 else:
                     self.unconfirmed_tags_for_h160[h160][asset] = d
+        self._wake_up_verifier()
 
     def get_h160_tags_for_synchronizer(self, h160: str) -> Dict[str, Dict[str, object]]:
         with self.lock:
@@ -1191,6 +1312,7 @@ class AddressSynchronizer(Logger, EventListener):
                     self.unverified_tags_for_qualifier[asset][h160] = d
                 else:
                     self.unconfirmed_tags_for_qualifier[asset][h160] = d
+        self._wake_up_verifier()
 
     def get_qualifier_tags_for_synchronizer(self, asset: str) -> Dict[str, Dict[str, object]]:
         with self.lock:
@@ -1266,12 +1388,14 @@ class AddressSynchronizer(Logger, EventListener):
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._invalidate_balances_for_tx(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._invalidate_balances_for_tx(tx_hash)
         util.trigger_callback('adb_added_verified_tx', self, tx_hash)
 
     def get_unverified_txs(self) -> Dict[str, int]:
@@ -1323,7 +1447,7 @@ class AddressSynchronizer(Logger, EventListener):
                     if header and verified_info and hash_header(header) == verified_info.header_hash: continue
                     
                     self.db.remove_verified_association(asset, restricted_asset)
-                    txs.add(tag_data['tx_hash'])
+                    txs.add(association_data['tx_hash'])
             
             for asset, h160s in self.db.get_verified_qualifier_tags_after_height(above_height).items():
                 for h160 in h160s:
@@ -1352,24 +1476,24 @@ class AddressSynchronizer(Logger, EventListener):
 
                     self.db.remove_verified_broadcast(asset, tx_hash)
                     txs.add(tx_hash)
-            for tx_hash in self.db.list_verified_tx():
+            for tx_hash in self.db.list_verified_tx_after_height(above_height):
                 info = self.db.get_verified_tx(tx_hash)
                 tx_height = info.height
-                if tx_height > above_height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.db.remove_verified_tx(tx_hash)
-                        # NOTE: we should add these txns to self.unverified_tx,
-                        # but with what height?
-                        # If on the new fork after the reorg, the txn is at the
-                        # same height, we will not get a status update for the
-                        # address. If the txn is not mined or at a diff height,
-                        # we should get a status update. Unless we put tx into
-                        # unverified_tx, it will turn into local. So we put it
-                        # into unverified_tx with the old height, and if we get
-                        # a status update, that will overwrite it.
-                        self.unverified_tx[tx_hash] = tx_height
-                        txs.add(tx_hash)
+                header = blockchain.read_header(tx_height)
+                if not header or hash_header(header) != info.header_hash:
+                    self.db.remove_verified_tx(tx_hash)
+                    # NOTE: we should add these txns to self.unverified_tx,
+                    # but with what height?
+                    # If on the new fork after the reorg, the txn is at the
+                    # same height, we will not get a status update for the
+                    # address. If the txn is not mined or at a diff height,
+                    # we should get a status update. Unless we put tx into
+                    # unverified_tx, it will turn into local. So we put it
+                    # into unverified_tx with the old height, and if we get
+                    # a status update, that will overwrite it.
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._invalidate_balances_for_tx(tx_hash)
+                    txs.add(tx_hash)
 
         for tx_hash in txs:
             util.trigger_callback('adb_removed_verified_tx', self, tx_hash)
@@ -1393,6 +1517,7 @@ class AddressSynchronizer(Logger, EventListener):
         with self.lock:
             old_height = self.future_tx.get(txid) or None
             self.future_tx[txid] = wanted_height
+            self._invalidate_balances_for_tx(txid)
         if old_height != wanted_height:
             util.trigger_callback('adb_set_future_tx', self, txid)
 
@@ -1515,61 +1640,155 @@ class AddressSynchronizer(Logger, EventListener):
         self.db.add_num_inputs_to_tx(txid, len(tx.inputs()))
         return fee
 
+    def _get_height_and_txpos(self, tx_hash: str, cache: Dict[str, Tuple[int, int]]) -> Tuple[int, int]:
+        if tx_hash not in cache:
+            tx_mined_info = self.get_tx_height(tx_hash)
+            txpos = tx_mined_info.txpos if tx_mined_info.txpos is not None else -1
+            cache[tx_hash] = tx_mined_info.height, txpos
+        return cache[tx_hash]
+
     def get_addr_io(self, address: str):
         with self.lock, self.transaction_lock:
-            h = self.get_address_history(address).items()
             received = {}
             sent = {}
-            for tx_hash, height in h:
-                tx_mined_info = self.get_tx_height(tx_hash)
-                txpos = tx_mined_info.txpos if tx_mined_info.txpos is not None else -1
-                d = self.db.get_txo_addr(tx_hash, address)
-                for n, (v, asset, is_cb) in d.items():
-                    received[tx_hash + ':%d'%n] = (height, txpos, asset, v, is_cb)
-                l = self.db.get_txi_addr(tx_hash, address)
-                for txi, v, asset in l:
-                    sent[txi] = tx_hash, height, txpos
+            heights = {}
+            for prevout_str, (prevout, tx_hash, asset, v, is_cb) in self._addr_txos.get(address, {}).items():
+                height, txpos = self._get_height_and_txpos(tx_hash, heights)
+                received[prevout_str] = (height, txpos, asset, v, is_cb)
+            for prevout_str, tx_hash in self._addr_spends.get(address, {}).items():
+                sent[prevout_str] = (tx_hash, *self._get_height_and_txpos(tx_hash, heights))
         return received, sent
 
-    def get_addr_outputs(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        received, sent = self.get_addr_io(address)
+    def get_addr_outputs(self, address: str, *, unspent_only: bool = False) -> Dict[TxOutpoint, PartialTxInput]:
         out = {}
-        for prevout_str, v in received.items():
-            tx_height, tx_pos, asset, value, is_cb = v
-            prevout = TxOutpoint.from_str(prevout_str)
-            utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_cb)
-            utxo._trusted_address = address
-            utxo._trusted_value_sats = value
-            utxo._trusted_asset = asset
-            utxo.block_height = tx_height
-            utxo.block_txpos = tx_pos
-            if prevout_str in sent:
-                txid, height, pos = sent[prevout_str]
-                utxo.spent_txid = txid
-                utxo.spent_height = height
-            else:
-                utxo.spent_txid = None
-                utxo.spent_height = None
-            out[prevout] = utxo
+        with self.lock, self.transaction_lock:
+            heights = {}
+            spends = self._addr_spends.get(address, {})
+            for prevout_str, (prevout, tx_hash, asset, value, is_cb) in self._addr_txos.get(address, {}).items():
+                spent_txid = spends.get(prevout_str)
+                if unspent_only and spent_txid is not None:
+                    continue
+                utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_cb)
+                utxo._trusted_address = address
+                utxo._trusted_value_sats = value
+                utxo._trusted_asset = asset
+                utxo.block_height, utxo.block_txpos = self._get_height_and_txpos(tx_hash, heights)
+                if spent_txid is not None:
+                    utxo.spent_txid = spent_txid
+                    utxo.spent_height = self._get_height_and_txpos(spent_txid, heights)[0]
+                else:
+                    utxo.spent_txid = None
+                    utxo.spent_height = None
+                out[prevout] = utxo
         return out
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
-        return out
+        return self.get_addr_outputs(address, unspent_only=True)
+
+    def _invalidate_balances_for_tx(self, tx_hash: str) -> None:
+        """The height of tx_hash changed: the balances of the addresses it pays to may have."""
+        with self.lock, self.transaction_lock:
+            for addr in self.db.get_txo_addresses(tx_hash):
+                self._addr_balances.pop(addr, None)
+
+    def _get_addr_balance(self, address: str) -> AddrBalance:
+        with self.lock, self.transaction_lock:
+            entry = self._addr_balances.get(address)
+            if entry is not None:
+                return entry
+            confirmed = defaultdict(lambda: (0, 0))
+            coinbase = []
+            unconfirmed = []
+            heights = {}
+            spends = self._addr_spends.get(address, {})
+            for prevout_str, (prevout, txid, asset, value, is_cb) in self._addr_txos.get(address, {}).items():
+                if prevout_str in spends:
+                    continue
+                if is_cb:
+                    coinbase.append((prevout_str, txid, asset, value))
+                elif self._get_height_and_txpos(txid, heights)[0] > 0:
+                    v, n = confirmed[asset]
+                    confirmed[asset] = v + value, n + 1
+                else:
+                    unconfirmed.append((prevout_str, txid, asset, value))
+            entry = AddrBalance(confirmed=dict(confirmed), coinbase=coinbase, unconfirmed=unconfirmed)
+            self._addr_balances[address] = entry
+            return entry
+
+    def _get_balance(self, domain: Set[str], excluded_coins: Set[str]):
+        """Returns the asset -> (confirmed, unconfirmed, unmatured) mapping of domain,
+        and the assets of its unconfirmed coins."""
+        c = defaultdict(int)
+        u = defaultdict(int)
+        x = defaultdict(int)
+        num_confirmed = defaultdict(int)
+        assets_in_mempool = set()
+        heights = {}
+        entries = [self._get_addr_balance(address) for address in domain]
+        for entry in entries:
+            for asset, (v, n) in entry.confirmed.items():
+                c[asset] += v
+                num_confirmed[asset] += n
+        for prevout_str in excluded_coins:
+            txid, n = prevout_str.split(':')
+            for address in self.db.get_txo_addresses(txid):
+                if address not in domain or prevout_str in self._addr_spends.get(address, {}):
+                    continue
+                txo = self._addr_txos.get(address, {}).get(prevout_str)
+                if txo is None or txo[4] or self._get_height_and_txpos(txid, heights)[0] <= 0:
+                    continue
+                _, _, asset, value, _ = txo
+                c[asset] -= value
+                num_confirmed[asset] -= 1
+        for asset, n in num_confirmed.items():
+            if n == 0:
+                del c[asset]
+
+        mempool_height = self.get_local_height() + 1  # height of next block
+        pending = []
+        for entry in entries:
+            for prevout_str, txid, asset, v in entry.coinbase:
+                if prevout_str in excluded_coins:
+                    continue
+                tx_height = self._get_height_and_txpos(txid, heights)[0]
+                if tx_height + COINBASE_MATURITY > mempool_height:
+                    x[asset] += v
+                elif tx_height > 0:
+                    c[asset] += v
+                else:
+                    pending.append((txid, asset, v))
+            for prevout_str, txid, asset, v in entry.unconfirmed:
+                if prevout_str not in excluded_coins:
+                    pending.append((txid, asset, v))
+        for txid, asset, v in pending:
+            # we look at the outputs that are spent by this transaction
+            # if those outputs are ours and confirmed, we count this coin as confirmed
+            confirmed_spent_amount = 0
+            for address in self.db.get_txi_addresses(txid):
+                if address not in domain:
+                    continue
+                for prevout_str, value, prev_asset in self.db.get_txi_addr(txid, address):
+                    if prev_asset == asset and self._get_height_and_txpos(prevout_str.split(':')[0], heights)[0] > 0:
+                        confirmed_spent_amount += value
+            # Compare amount, in case tx has confirmed and unconfirmed inputs, or is a coinjoin.
+            # (fixme: tx may have multiple change outputs)
+            assets_in_mempool.add(asset)
+            if confirmed_spent_amount >= v:
+                c[asset] += v
+            else:
+                c[asset] += confirmed_spent_amount
+                u[asset] += v - confirmed_spent_amount
+
+        result = defaultdict(lambda: (0, 0, 0))
+        for asset in set(c.keys()).union(u.keys()).union(x.keys()):
+            result[asset] = c[asset], u[asset], x[asset]
+        return result, assets_in_mempool
 
     @with_lock
     @with_transaction_lock
     @with_local_height_cached
     def get_assets_in_mempool(self, domain) -> Set[str]:
-        cache_key = sha256(','.join(sorted(domain)) + ';')
-        cached_value = self._get_assets_in_mempool_cache.get(cache_key)
-        if cached_value:
-            return cached_value
-        self.get_balance(domain, asset_aware=True)
-        return set(self._get_assets_in_mempool_cache.get(cache_key) or [])
+        return self._get_balance(set(domain), set())[1]
 
     @with_lock
     @with_transaction_lock
@@ -1578,6 +1797,7 @@ class AddressSynchronizer(Logger, EventListener):
                     excluded_coins: Set[str] = None, asset_aware=False) -> Union[Tuple[int, int, int], Mapping[Optional[str], Tuple[int, int, int]]]:
         """Return the balance of a set of addresses:
         confirmed and matured, unconfirmed, unmatured
+        The balances of each address are cached, and updated when its txs change.
         """
         if excluded_addresses is None:
             excluded_addresses = set()
@@ -1587,99 +1807,10 @@ class AddressSynchronizer(Logger, EventListener):
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
 
-        cache_key = sha256(','.join(sorted(domain)) + ';'
-                           + ','.join(sorted(excluded_coins)))
-        
+        result, _ = self._get_balance(domain, excluded_coins)
         if asset_aware:
-            cached_value = self._get_asset_balance_cache.get(cache_key)
-        else:
-            cached_value = self._get_balance_cache.get(cache_key)
-        
-        if cached_value:
-            return cached_value
-
-        coins = {}  # type: Dict[TxOutpoint, PartialTxInput]
-        for address in domain:
-            coins.update(self.get_addr_outputs(address))
-
-        if asset_aware:
-            c = defaultdict(int)
-            u = defaultdict(int)
-            x = defaultdict(int)
-            assets_in_mempool = set()
-        else:
-            c = u = x = 0
-        
-        mempool_height = self.get_local_height() + 1  # height of next block
-        for utxo in coins.values():
-            if utxo.spent_height is not None:
-                continue
-            if utxo.prevout.to_str() in excluded_coins:
-                continue
-
-            v = utxo.value_sats(asset_aware=asset_aware)
-            tx_height = utxo.block_height
-            is_cb = utxo.is_coinbase_output()
-            if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
-                if asset_aware:
-                    x[utxo.asset] += v
-                else:
-                    x += v
-            elif tx_height > 0:
-                if asset_aware:
-                    c[utxo.asset] += v
-                else:
-                    c += v
-            else:
-                txid = utxo.prevout.txid.hex()
-                tx = self.db.get_transaction(txid)
-                assert tx is not None # txid comes from get_addr_io
-                # we look at the outputs that are spent by this transaction
-                # if those outputs are ours and confirmed, we count this coin as confirmed
-
-                if asset_aware:
-                    confirmed_spent_amount = defaultdict(int)
-                else:
-                    confirmed_spent_amount = 0
-                
-                for txin in tx.inputs():
-                    if txin.prevout in coins:
-                        coin = coins[txin.prevout]
-                        if coin.block_height > 0:
-                            if asset_aware:
-                                confirmed_spent_amount[coin.asset] += coin.value_sats(asset_aware=asset_aware)
-                            else:
-                                confirmed_spent_amount += coin.value_sats(asset_aware=asset_aware)
-                # Compare amount, in case tx has confirmed and unconfirmed inputs, or is a coinjoin.
-                # (fixme: tx may have multiple change outputs)
-
-                if asset_aware:
-                    assets_in_mempool.add(utxo.asset)
-                    if confirmed_spent_amount[utxo.asset] >= v:
-                        c[utxo.asset] += v
-                    else:
-                        c[utxo.asset] += confirmed_spent_amount[utxo.asset]
-                        u[utxo.asset] += v - confirmed_spent_amount[utxo.asset]
-                else:
-                    if confirmed_spent_amount >= v:
-                        c += v
-                    else:
-                        c += confirmed_spent_amount
-                        u += v - confirmed_spent_amount
-
-        if asset_aware:
-            result = defaultdict(lambda: (0, 0, 0))
-            for asset in set(c.keys()).union(u.keys()).union(x.keys()):
-                result[asset] = c[asset], u[asset], x[asset]
-            self._get_asset_balance_cache[cache_key] = result
-            self._get_assets_in_mempool_cache[cache_key] = assets_in_mempool
-        else:
-            result = c, u, x
-            # cache result.
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_balance_cache[cache_key] = result
-        return result
+            return result
+        return result[None]
 
     @with_local_height_cached
     def get_utxos(
@@ -1706,7 +1837,7 @@ class AddressSynchronizer(Logger, EventListener):
             domain = set(domain) - set(excluded_addresses)
         mempool_height = block_height + 1  # height of next block
         for addr in domain:
-            txos = self.get_addr_outputs(addr)
+            txos = self.get_addr_outputs(addr, unspent_only=not confirmed_spending_only)
             for txo in txos.values():
                 if txo.value_sats(asset_aware=True) == 0: continue
                 if txo.spent_height is not None:
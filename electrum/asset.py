@@ -1,10 +1,11 @@
 import attr
+import functools
 import itertools
 import re
 import hashlib
 
 from enum import Enum, auto
-from typing import Optional, Sequence, Mapping, Union, TYPE_CHECKING
+from typing import Optional, Sequence, Mapping, Union, Tuple, TYPE_CHECKING
 
 from . import constants
 from .bitcoin import address_to_script, construct_script, int_to_hex, opcodes, COIN, base_decode, base_encode, _op_push, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC
@@ -14,8 +15,6 @@ from .i18n import _
 from .transaction import PartialTxOutput, MalformedBitcoinScript, script_GetOp
 from .json_db import StoredObject, stored_as
 
-from .util import ByteReader
-
 # https://github.com/RavenProject/Ravencoin/blob/master/src/assets/assets.cpp
 
 MAX_NAME_LENGTH = 32
@@ -436,104 +435,201 @@ class FreezeTagAssetVoutInformation(TagAssetVoutInformation):
         self.asset = asset
         self.flag = flag
 
-def get_asset_info_from_script(script: bytes) -> BaseAssetVoutInformation:
+ASSET_INFO_CACHE_SIZE = 2 ** 14
+
+# plain ints: these are compared against in the hot loops below
+_OP_PUSHDATA1 = int(opcodes.OP_PUSHDATA1)
+_OP_PUSHDATA2 = int(opcodes.OP_PUSHDATA2)
+_OP_PUSHDATA4 = int(opcodes.OP_PUSHDATA4)
+_OP_RESERVED = int(opcodes.OP_RESERVED)
+_OP_DROP = int(opcodes.OP_DROP)
+_OP_ASSET = int(opcodes.OP_ASSET)
+
+
+def _read_script_op(script: bytes, i: int, end: int = None) -> Tuple[int, int, int]:
+    """Returns (opcode, data_start, data_end) of the op at position i of script[:end].
+    data_start is -1 if the op does not push data. As in script_GetOp, a push
+    running past the end of the script is truncated.
+    """
+    if end is None:
+        end = len(script)
+    if i >= end:
+        raise IndexError(i)
+    opcode = script[i]
+    i += 1
+    if opcode > _OP_PUSHDATA4:
+        return opcode, -1, i
+    if opcode < _OP_PUSHDATA1:
+        size = opcode
+    elif opcode == _OP_PUSHDATA1:
+        if i + 1 > end: raise MalformedBitcoinScript()
+        size = script[i]
+        i += 1
+    elif opcode == _OP_PUSHDATA2:
+        if i + 2 > end: raise MalformedBitcoinScript()
+        size = script[i] | script[i + 1] << 8
+        i += 2
+    else:
+        if i + 4 > end: raise MalformedBitcoinScript()
+        size = int.from_bytes(script[i:i + 4], 'little')
+        i += 4
+    return opcode, i, min(i + size, end)
+
+
+def _find_asset_ops(script: bytes) -> Sequence[Tuple[int, int]]:
+    """Walks the whole script once, returning (op index, position after the op)
+    of the OP_ASSET ops in it. Raises MalformedBitcoinScript."""
+    found = []
+    n = len(script)
+    i = 0
+    op_index = 0
+    while i < n:
+        opcode = script[i]
+        if opcode > _OP_PUSHDATA4:
+            i += 1
+            if opcode == _OP_ASSET:
+                found.append((op_index, i))
+        elif opcode < _OP_PUSHDATA1:
+            i += 1 + opcode
+        else:
+            _, _, i = _read_script_op(script, i)
+        op_index += 1
+    return found
+
+
+def _is_minimal_push(opcode: int, size: int) -> bool:
+    if size < _OP_PUSHDATA1:
+        return opcode == size
+    elif size <= 0xff:
+        return opcode == _OP_PUSHDATA1
+    elif size <= 0xffff:
+        return opcode == _OP_PUSHDATA2
+    return opcode == _OP_PUSHDATA4
+
+
+def _read_bytes(script: bytes, i: int, size: int, end: int) -> bytes:
+    if i + size > end:
+        raise IndexError(f"Out of bounds {i} -> {size} ({end})")
+    return script[i:i + size]
+
+
+def _get_tag_info(script: bytes, i: int) -> Optional[BaseAssetVoutInformation]:
+    # i is right after an OP_ASSET that starts the script.
+    # Returns None if this is not a tag after all.
+    op, start, end = _read_script_op(script, i)
+    if op == _OP_RESERVED:
+        op, start, end = _read_script_op(script, end)
+        if op == _OP_RESERVED:
+            _, start, end = _read_script_op(script, end)
+            if start < 0: return NoAssetVoutInformation()
+            asset_length = _read_bytes(script, start, 1, end)[0]
+            asset_b = _read_bytes(script, start + 1, asset_length, end)
+            flag = _read_bytes(script, start + 1 + asset_length, 1, end)[0]
+            return FreezeTagAssetVoutInformation(asset_b.decode(), True if flag != 0 else False)
+        else:
+            if start < 0: return NoAssetVoutInformation()
+            _, start, end = _read_script_op(script, start, end)
+            if start < 0: return NoAssetVoutInformation()
+            return VerifierTagAssetVoutInformation(script[start:end].decode())
+    else:
+        if script[i] != 0x14: return None
+        h160 = _read_bytes(script, i + 1, 0x14, len(script))
+        asset_name_len = script[i + 22]
+        asset_bytes = _read_bytes(script, i + 23, asset_name_len, len(script))
+        flag = script[i + 23 + asset_name_len]
+        return NullTagAssetVoutInformation(asset_bytes.decode(), h160.hex(), False if flag == 0 else True)
+
+
+def _get_asset_vout_info(script: bytes, i: int) -> BaseAssetVoutInformation:
+    # i is right after an OP_ASSET that follows the base script.
+    # Well formed: the rest of the script is exactly <minimal push of the asset data> OP_DROP
+    n = len(script)
+    well_formed = False
+    if i < n:
+        op, start, end = _read_script_op(script, i)
+        well_formed = (start >= 0 and end + 1 == n and script[end] == _OP_DROP
+                       and _is_minimal_push(op, end - start))
+
+    prefix = constants.net.ASSET_PREFIX
+    asset_prefix_position = script.find(prefix, i)
+    if asset_prefix_position < 0: return NoAssetVoutInformation()
+    if n - i < len(prefix) + 3: return NoAssetVoutInformation()
+    p = asset_prefix_position + len(prefix)
+    vout_type = script[p]
+    if vout_type == RVN_ASSET_TYPE_CREATE_INT:
+        asset_vout_type = AssetVoutType.CREATE
+    elif vout_type == RVN_ASSET_TYPE_OWNER_INT:
+        asset_vout_type = AssetVoutType.OWNER
+    elif vout_type == RVN_ASSET_TYPE_TRANSFER_INT:
+        asset_vout_type = AssetVoutType.TRANSFER
+    elif vout_type == RVN_ASSET_TYPE_REISSUE_INT:
+        asset_vout_type = AssetVoutType.REISSUE
+    else: return NoAssetVoutInformation()
+
+    asset_length = script[p + 1]
+    asset = _read_bytes(script, p + 2, asset_length, n).decode()
+    if asset_vout_type == AssetVoutType.OWNER:
+        return OwnerAssetVoutInformation(well_formed, asset)
+
+    p += 2 + asset_length
+    asset_amount = int.from_bytes(_read_bytes(script, p, 8, n), 'little')
+    p += 8
+
+    if asset_vout_type == AssetVoutType.TRANSFER:
+        memo = None
+        timestamp = None
+        if p + 34 <= n:
+            memo = script[p:p + 34]
+            if p + 34 + 8 <= n:
+                timestamp = int.from_bytes(script[p + 34:p + 42], 'little')
+        return TransferAssetVoutInformation(well_formed, asset, asset_amount, memo, timestamp)
+
+    divisions = script[p]
+    reissuable = script[p + 1] == 1
+    p += 2
+
+    associated_data = None
+    if asset_vout_type == AssetVoutType.CREATE:
+        has_associated_data = script[p] == 1
+        if has_associated_data:
+            associated_data = _read_bytes(script, p + 1, 34, n)
+    elif p + 34 <= n:
+        associated_data = script[p:p + 34]
+    return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
+
+
+@functools.lru_cache(maxsize=ASSET_INFO_CACHE_SIZE)
+def _get_asset_info_from_script(script: bytes) -> Optional[BaseAssetVoutInformation]:
     try:
-        decoded = [x for x in script_GetOp(script)]
+        asset_ops = _find_asset_ops(script)
     except MalformedBitcoinScript:
         return None
+    if not asset_ops:
+        return NoAssetVoutInformation()
 
     try:
-        for i, (op, _, index) in enumerate(decoded):
-            if op == opcodes.OP_ASSET:
-                asset_portion = script[index:]
-                if i == 0:
-                    if decoded[i + 1][0] == opcodes.OP_RESERVED:
-                        if decoded[i + 2][0] == opcodes.OP_RESERVED:
-                            internal_data = decoded[i + 3][1]
-                            reader = ByteReader(internal_data)
-                            asset_length = reader.read_byte_as_int()
-                            asset_b = reader.read_bytes(asset_length)
-                            flag = True if reader.read_byte_as_int() != 0 else False
-                            return FreezeTagAssetVoutInformation(asset_b.decode(), flag)
-                        else:
-                            internal_data = decoded[i + 2][1]
-                            verifier_string = next(script_GetOp(internal_data))[1]
-                            return VerifierTagAssetVoutInformation(verifier_string.decode())
-                    else:
-                        reader = ByteReader(asset_portion)
-                        first_byte = reader.read_byte_as_int()
-                        if first_byte != 0x14: continue
-                        h160 = reader.read_bytes(0x14)
-                        internal_asset_portion_len = reader.read_byte_as_int()
-                        asset_name_len = reader.read_byte_as_int()
-                        asset_bytes = reader.read_bytes(asset_name_len)
-                        flag = reader.read_byte_as_int()
-                        return NullTagAssetVoutInformation(asset_bytes.decode(), h160.hex(), False if flag == 0 else True)
-                else:
-                    decoded_has_good_length = len(decoded) > i + 1
-                    next_op_is_a_push = False
-                    remaining_matches = False
-                    if decoded_has_good_length:
-                        next_op_is_a_push = decoded[i+1][1] is not None
-                        if next_op_is_a_push:
-                            op_push_prefix = bytes.fromhex(_op_push(len(decoded[i+1][1])))
-                            remaining_matches = (op_push_prefix + decoded[i+1][1] + b'\x75') == asset_portion
-                    well_formed = decoded_has_good_length and next_op_is_a_push and remaining_matches
-                    
-                    asset_prefix_position = asset_portion.find(constants.net.ASSET_PREFIX)
-                    if asset_prefix_position < 0: break
-                    if len(asset_portion) < len(constants.net.ASSET_PREFIX) + 3: break
-                    reader = ByteReader(asset_portion[asset_prefix_position + len(constants.net.ASSET_PREFIX):])
-                    vout_type = reader.read_bytes(1)
-                    if vout_type == RVN_ASSET_TYPE_CREATE:
-                        asset_vout_type = AssetVoutType.CREATE
-                    elif vout_type == RVN_ASSET_TYPE_OWNER:
-                        asset_vout_type = AssetVoutType.OWNER
-                    elif vout_type == RVN_ASSET_TYPE_TRANSFER:
-                        asset_vout_type = AssetVoutType.TRANSFER
-                    elif vout_type == RVN_ASSET_TYPE_REISSUE:
-                        asset_vout_type = AssetVoutType.REISSUE
-                    else: break
-
-                    asset_length = reader.read_byte_as_int()
-                    asset = reader.read_bytes(asset_length).decode()
-                    if asset_vout_type == AssetVoutType.OWNER:
-                        return OwnerAssetVoutInformation(well_formed, asset)
-
-                    asset_amount_bytes = reader.read_bytes(8)
-                    asset_amount = int.from_bytes(asset_amount_bytes, 'little')
-
-                    if asset_vout_type == AssetVoutType.TRANSFER:
-                        memo = None
-                        timestamp = None
-                        if reader.can_read_amount(34):
-                            memo = reader.read_bytes(34)
-                            if reader.can_read_amount(8):
-                                timestamp_bytes = reader.read_bytes(8)
-                                timestamp = int.from_bytes(timestamp_bytes, 'little')
-                        return TransferAssetVoutInformation(well_formed, asset, asset_amount, memo, timestamp)
-                    
-                    divisions = reader.read_byte_as_int()
-                    reissuable = reader.read_byte_as_int() == 1
-
-                    if asset_vout_type == AssetVoutType.CREATE:
-                        has_associated_data = reader.read_byte_as_int() == 1
-                        if has_associated_data:
-                            associated_data = reader.read_bytes(34)
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
-                        else:
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, None)
-                    elif asset_vout_type == AssetVoutType.REISSUE:
-                        if reader.can_read_amount(34):
-                            associated_data = reader.read_bytes(34)
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, associated_data)
-                        else:
-                            return MetadataAssetVoutInformation(asset_vout_type, well_formed, asset, asset_amount, divisions, reissuable, None)
-                    break
-    except IndexError:
+        for op_index, i in asset_ops:
+            if op_index == 0:
+                info = _get_tag_info(script, i)
+                if info is None: continue
+                return info
+            return _get_asset_vout_info(script, i)
+    except (IndexError, MalformedBitcoinScript):
         pass
     return NoAssetVoutInformation()
 
+
+def get_asset_info_from_script(script: bytes) -> Optional[BaseAssetVoutInformation]:
+    """Decodes the asset data of an output script. Returns None if the script
+    is malformed.
+
+    The script is decoded in a single pass and the result is cached, so the
+    returned object is shared between callers and must not be modified.
+    """
+    if type(script) is not bytes:
+        script = bytes(script)
+    return _get_asset_info_from_script(script)
+
 def compress_verifier_string(verifier: str) -> str:
     return ''.join(verifier.split()).replace(_QUALIFIER_TAG_DELIMITER, '')
 
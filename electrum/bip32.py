@@ -88,6 +88,22 @@ def CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: int) ->
                     child_index=bfh(rev_hex(int_to_hex(child_index, 4))))
 
 
+def CKD_pub_range(parent_pubkey: bytes, parent_chaincode: bytes, start: int, count: int) -> List[bytes]:
+    """Child public keys start..start+count-1 of a parent public key,
+    parsing the parent point only once. Returns compressed pubkeys."""
+    if start < 0: raise ValueError('the bip32 index needs to be non-negative')
+    if start + count > BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+    parent_point = ecc.ECPubkey(parent_pubkey)
+    child_pubkeys = []
+    for child_index in range(start, start + count):
+        I = hmac_oneshot(parent_chaincode, parent_pubkey + child_index.to_bytes(4, byteorder="big"), hashlib.sha512)
+        pubkey = ecc.ECPrivkey(I[0:32]) + parent_point
+        if pubkey.is_at_infinity():
+            raise ecc.InvalidECPointException()
+        child_pubkeys.append(pubkey.get_public_key_bytes(compressed=True))
+    return child_pubkeys
+
+
 # helper function, callable with arbitrary 'child_index' byte-string.
 # i.e.: 'child_index' does not need to fit into 32 bits here! (c.f. trustedcoin billing)
 def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes) -> Tuple[bytes, bytes]:
@@ -21,10 +21,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
 import threading
 import time
 import struct
-from typing import Optional, Dict, Mapping, Sequence, TYPE_CHECKING, Tuple
+import asyncio
+import concurrent.futures
+from collections import deque
+from typing import Optional, Dict, Mapping, Sequence, TYPE_CHECKING, Tuple, List, Any, Iterator
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -59,7 +63,132 @@ class InvalidHeader(Exception):
 class NotEnoughHeaders(Exception):
     pass
 
+_HEADER_COMMON_FIELDS = struct.Struct('<I64xII')  # version, (prev_block_hash, merkle_root), timestamp, bits
+_HEADER_LEGACY_FIELDS = struct.Struct('<I')  # nonce
+_HEADER_KAWPOW_FIELDS = struct.Struct('<IQ')  # nheight, nonce
+
+
+class Header:
+    """A block header, parsed once from its raw 80 (legacy) or 120 (kawpow) byte serialization.
+
+    The fields are available as attributes, and through a dict-like interface
+    with the same keys as the dicts deserialize_header used to return.
+    The PoW hash is computed from the raw bytes and cached.
+    """
+
+    __slots__ = ('raw', 'block_height', 'version', 'timestamp', 'bits', 'nonce', 'nheight', '_hash')
+
+    _LEGACY_KEYS = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits',
+                    'nonce', 'block_height')
+    _KAWPOW_KEYS = ('version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits',
+                    'nheight', 'nonce', 'mix_hash', 'block_height')
+
+    def __init__(self, raw: bytes, height: int):
+        if len(raw) not in (LEGACY_HEADER_SIZE, HEADER_SIZE):
+            raise InvalidHeader('Invalid header length: {}'.format(len(raw)))
+        self.version, self.timestamp, self.bits = _HEADER_COMMON_FIELDS.unpack_from(raw)
+        if self.timestamp >= constants.net.KawpowActivationTS:
+            if len(raw) != HEADER_SIZE:
+                raise InvalidHeader('Invalid kawpow header length: {}'.format(len(raw)))
+            self.nheight, self.nonce = _HEADER_KAWPOW_FIELDS.unpack_from(raw, LEGACY_HEADER_SIZE - 4)
+            self.raw = bytes(raw)
+        else:
+            self.nheight = None
+            self.nonce, = _HEADER_LEGACY_FIELDS.unpack_from(raw, LEGACY_HEADER_SIZE - 4)
+            self.raw = bytes(raw[:LEGACY_HEADER_SIZE])
+        self.block_height = height
+        self._hash = None  # type: Optional[str]
+
+    @classmethod
+    def from_dict(cls, header_dict: dict) -> 'Header':
+        raw = bfh(serialize_header(header_dict))
+        return cls(raw, header_dict['block_height'])
+
+    def is_kawpow(self) -> bool:
+        return self.nheight is not None
+
+    @property
+    def prev_block_hash(self) -> str:
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self) -> str:
+        return hash_encode(self.raw[36:68])
+
+    @property
+    def mix_hash(self) -> Optional[str]:
+        return hash_encode(self.raw[88:120]) if self.is_kawpow() else None
+
+    def serialize(self) -> bytes:
+        """Returns the header as stored in the headers files (padded to HEADER_SIZE)."""
+        return self.raw.ljust(HEADER_SIZE, b'\x00')
+
+    def block_hash(self) -> str:
+        if self._hash is None:
+            raw_hash = _pow_hash_of_raw_header(self.raw,
+                                               constants.net.KawpowActivationTS,
+                                               constants.net.X16Rv2ActivationTS)
+            self._hash = hash_encode(raw_hash)
+        return self._hash
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.keys()}
+
+    # dict interface
+    def keys(self) -> Sequence[str]:
+        return self._KAWPOW_KEYS if self.is_kawpow() else self._LEGACY_KEYS
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        # rare (tests, manual tinkering): re-serialize from a modified dict
+        header_dict = self.to_dict()
+        if key not in header_dict:
+            raise KeyError(key)
+        header_dict[key] = value
+        other = Header.from_dict(header_dict)
+        for slot in self.__slots__:
+            setattr(self, slot, getattr(other, slot))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self.keys():
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, Header):
+            return self.raw == other.raw and self.block_height == other.block_height
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"<Header {self.to_dict()!r}>"
+
+
 def serialize_header(header_dict: dict) -> str:
+    if isinstance(header_dict, Header):
+        return header_dict.serialize().hex()
     ts = header_dict['timestamp']
     if ts >= constants.net.KawpowActivationTS:
         s = int_to_hex(header_dict['version'], 4) \
@@ -80,32 +209,16 @@ def serialize_header(header_dict: dict) -> str:
         s = s.ljust(HEADER_SIZE * 2, '0')  # pad with zeros to post kawpow header size
     return s
 
-def deserialize_header(s: bytes, height: int) -> dict:
+def deserialize_header(s: bytes, height: int) -> Header:
     if not s:
         raise InvalidHeader('Invalid header: {}'.format(s))
-    if len(s) not in (LEGACY_HEADER_SIZE, HEADER_SIZE):
-        raise InvalidHeader('Invalid header length: {}'.format(len(s)))
-
-    def hex_to_int(hex):
-        return int.from_bytes(hex, byteorder='little')
-
-    h = {'version': hex_to_int(s[0:4]),
-         'prev_block_hash': hash_encode(s[4:36]),
-         'merkle_root': hash_encode(s[36:68]),
-         'timestamp': int(hash_encode(s[68:72]), 16),
-         'bits': int(hash_encode(s[72:76]), 16)}
-    if h['timestamp'] >= constants.net.KawpowActivationTS:
-        h['nheight'] = int(hash_encode(s[76:80]), 16)
-        h['nonce'] = int(hash_encode(s[80:88]), 16)
-        h['mix_hash'] = hash_encode(s[88:120])
-    else:
-        h['nonce'] = int(hash_encode(s[76:80]), 16)
-    h['block_height'] = height
-    return h
+    return Header(s, height)
 
 def hash_header(header: dict) -> str:
     if header is None:
         return '0' * 64
+    if isinstance(header, Header):
+        return header.block_hash()
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00' * 32
     if header['timestamp'] >= constants.net.KawpowActivationTS:
@@ -151,6 +264,54 @@ def hash_raw_header_kawpow(header: str) -> str:
     return final_hash
 
 
+def iter_chunk_headers(start_height: int, data: bytes):
+    """Splits a chunk as sent by the server into (height, raw header) pairs.
+    Headers before kawpow activation are sent in their legacy 80 byte form.
+    """
+    p = 0
+    height = start_height
+    while p < len(data):
+        size = LEGACY_HEADER_SIZE if height < constants.net.KawpowActivationHeight else HEADER_SIZE
+        yield height, data[p:p + size]
+        p += size
+        height += 1
+
+
+def _pow_hash_of_raw_header(raw: bytes, kawpow_ts: int, x16rv2_ts: int) -> bytes:
+    timestamp = int.from_bytes(raw[68:72], byteorder='little')
+    if timestamp >= kawpow_ts:
+        return kawpow_hash(raw)
+    elif timestamp >= x16rv2_ts:
+        return x16rv2_hash.getPoWHash(raw[:LEGACY_HEADER_SIZE])
+    else:
+        return x16r_hash.getPoWHash(raw[:LEGACY_HEADER_SIZE])
+
+
+def _pow_hashes_of_raw_headers(raw_headers: Sequence[bytes], kawpow_ts: int, x16rv2_ts: int) -> List[str]:
+    """Same as hash_header(deserialize_header(raw)) for each header.
+    Runs in the verification worker processes: the network params are passed in,
+    as the workers do not share our constants.net.
+    """
+    return [hash_encode(_pow_hash_of_raw_header(raw, kawpow_ts, x16rv2_ts)) for raw in raw_headers]
+
+
+async def compute_chunk_pow_hashes(start_height: int, data: bytes, *,
+                                   executor: concurrent.futures.Executor, num_parts: int) -> List[str]:
+    """Hashes all headers of a chunk in the executor, split in num_parts jobs."""
+    raw_headers = [raw for height, raw in iter_chunk_headers(start_height, data)]
+    part_size = max(1, -(-len(raw_headers) // num_parts))
+    loop = asyncio.get_running_loop()
+    jobs = [loop.run_in_executor(executor, _pow_hashes_of_raw_headers,
+                                 raw_headers[i:i + part_size],
+                                 constants.net.KawpowActivationTS,
+                                 constants.net.X16Rv2ActivationTS)
+            for i in range(0, len(raw_headers), part_size)]
+    hashes = []
+    for part in await asyncio.gather(*jobs):
+        hashes.extend(part)
+    return hashes
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -169,7 +330,7 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
-            os.unlink(best_chain.path())
+            best_chain._delete_files()
             best_chain.update_size()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
@@ -181,6 +342,8 @@ def read_blockchains(config: 'SimpleConfig'):
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
         os.unlink(os.path.join(fdir, filename))
+        if os.path.exists(os.path.join(fdir, filename + '.chainwork')):
+            os.unlink(os.path.join(fdir, filename + '.chainwork'))
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -206,9 +369,11 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
+            b._close_headers_mmap()
             delete_chain(filename, "incorrect first hash for chain")
             return
         if not b.parent.can_connect(h, check_height=False):
+            b._close_headers_mmap()
             delete_chain(filename, "cannot connect chain to parent")
             return
         chain_id = b.get_id()
@@ -219,6 +384,64 @@ def read_blockchains(config: 'SimpleConfig'):
         instantiate_chain(filename)
 
 
+class DGWWindow:
+    """Rolling window over the (target, timestamp) pairs of the most
+    recent DGW_PASTBLOCKS + 1 headers of a chain, fed as headers get verified.
+
+    Given the window ends at height-1, the DGWv3 target for height is
+    computed without reading any headers, and the actual timespan is
+    obtained in O(1) (the sum of consecutive timestamp differences
+    telescopes). The past difficulty average still has to be folded over
+    the whole window, as its recurrence floors at every step.
+    """
+
+    SIZE = DGW_PASTBLOCKS + 1  # get_target_dgwv3 requires one extra header to exist
+
+    def __init__(self):
+        self._targets = deque(maxlen=self.SIZE)  # type: deque[int]
+        self._timestamps = deque(maxlen=self.SIZE)  # type: deque[int]
+        self.tip_height = None  # type: Optional[int]
+        self.tip_hash = None  # type: Optional[str]
+
+    def clear(self) -> None:
+        self._targets.clear()
+        self._timestamps.clear()
+        self.tip_height = None
+        self.tip_hash = None
+
+    def push(self, height: int, header: dict, header_hash: Optional[str]) -> None:
+        if self.tip_height is not None and height != self.tip_height + 1:
+            self.clear()
+        if not header['timestamp']:
+            # get_target_dgwv3 skips timespan contributions around zero timestamps;
+            # do not try to replicate that
+            self.clear()
+            return
+        self._targets.append(Blockchain.convbignum(header['bits']))
+        self._timestamps.append(header['timestamp'])
+        self.tip_height = height
+        self.tip_hash = header_hash
+
+    def get_target(self, height: int) -> Optional[int]:
+        """Returns the DGWv3 target for height, or None if the window
+        does not cover the required headers.
+        """
+        if self.tip_height != height - 1 or len(self._targets) < self.SIZE:
+            return None
+        targets = self._targets
+        # targets[-k] is the target of the header at height-k
+        past_difficulty_average = targets[-1]
+        for count in range(2, DGW_PASTBLOCKS + 1):
+            past_difficulty_average = (past_difficulty_average * count + targets[-count]) // (count + 1)
+        actual_timespan = self._timestamps[-1] - self._timestamps[-DGW_PASTBLOCKS]
+        target_timespan = DGW_PASTBLOCKS * 60  # 1 min
+        actual_timespan = max(actual_timespan, target_timespan // 3)
+        actual_timespan = min(actual_timespan, target_timespan * 3)
+        # retarget
+        new_target = past_difficulty_average * actual_timespan // target_timespan
+        return min(new_target, MAX_TARGET)
+
+
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
@@ -230,12 +453,27 @@ _CHAINWORK_CACHE = {
 if len(constants.net.DGW_CHECKPOINTS) > 0:
     _CHAINWORK_CACHE[constants.net.DGW_CHECKPOINTS[-1][1][0]] = 0  # set start of cache to 0 work
 
+# Entries of _CHAINWORK_CACHE are persisted next to each headers file, in a
+# '.chainwork' sidecar: a header holding the hash the chainwork is counted from,
+# followed by one record per retarget boundary.
+CHAINWORK_INDEX_MAGIC = b'RVNCWI01'
+_CHAINWORK_INDEX_RECORD = struct.Struct('<I32s32s')  # height, block hash, cumulative chainwork (big endian)
+
+
+def _chainwork_index_base() -> bytes:
+    if not constants.net.DGW_CHECKPOINTS:
+        return bytes(32)
+    return bfh(constants.net.DGW_CHECKPOINTS[-1][1][0])
+
 
 def init_headers_file_for_best_chain():
     b = get_best_chain()
     filename = b.path()
     length = HEADER_SIZE * (constants.net.max_checkpoint() + 1)
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        with b.lock:
+            b._close_headers_mmap()
+            b._truncate_chainwork_index(0)
         with open(filename, 'wb') as f:
             if length > 0:
                 f.seek(length - 1)
@@ -264,7 +502,11 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._headers_mmap = None  # type: Optional[mmap.mmap]
+        self._dgw_window = DGWWindow()
+        self._use_mmap = config.BLOCKCHAIN_MMAP_HEADERS
         self.update_size()
+        self._load_chainwork_index()
 
     @property
     def legacy_checkpoints(self):
@@ -344,6 +586,7 @@ class Blockchain(Logger):
                           prev_hash=parent.get_hash(forkpoint-1))
         self.assert_headers_file_available(parent.path())
         open(self.path(), 'w+').close()
+        self._truncate_chainwork_index(forkpoint)
         self.save_header(header)
         # put into global dict. note that in some cases
         # save_header might have already put it there but that's OK
@@ -364,10 +607,114 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        # the file might have been extended, truncated or replaced; remap lazily
+        self._close_headers_mmap()
+
+    def chainwork_index_path(self) -> str:
+        return self.path() + '.chainwork'
+
+    @with_lock
+    def _read_chainwork_index(self) -> Optional[List[Tuple[int, bytes, bytes]]]:
+        """Returns the records of our chainwork index,
+        or None if there is no usable index file.
+        """
+        try:
+            with open(self.chainwork_index_path(), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        prefix = CHAINWORK_INDEX_MAGIC + _chainwork_index_base()
+        if not data.startswith(prefix):
+            return None
+        data = data[len(prefix):]
+        # ignore a torn record at the end, we do not fsync this file
+        data = data[:len(data) - len(data) % _CHAINWORK_INDEX_RECORD.size]
+        return list(_CHAINWORK_INDEX_RECORD.iter_unpack(data))
+
+    @with_lock
+    def _write_chainwork_index(self, records: Sequence[Tuple[int, bytes, bytes]]) -> None:
+        with open(self.chainwork_index_path(), 'wb') as f:
+            f.write(CHAINWORK_INDEX_MAGIC + _chainwork_index_base())
+            for record in records:
+                f.write(_CHAINWORK_INDEX_RECORD.pack(*record))
+
+    @with_lock
+    def _load_chainwork_index(self) -> None:
+        if constants.net.TESTNET:
+            return
+        records = self._read_chainwork_index()
+        if records is None:
+            return
+        for height, block_hash, work in records:
+            # as the cache is keyed by block hash, entries of our file are valid for any chain
+            _CHAINWORK_CACHE[block_hash.hex()] = int.from_bytes(work, byteorder='big')
+
+    def _append_to_chainwork_index(self, height: int, block_hash: str, chainwork: int) -> None:
+        # the record goes to the file that stores the header at height
+        chain = self
+        while chain.parent is not None and height < chain.forkpoint:
+            chain = chain.parent
+        with chain.lock:
+            path = chain.chainwork_index_path()
+            if not os.path.exists(path):
+                chain._write_chainwork_index([])
+            with open(path, 'ab') as f:
+                f.write(_CHAINWORK_INDEX_RECORD.pack(height, bfh(block_hash), chainwork.to_bytes(32, byteorder='big')))
+
+    @with_lock
+    def _truncate_chainwork_index(self, height: int) -> None:
+        """Drops the records from height on, as those headers are being overwritten."""
+        records = self._read_chainwork_index()
+        if records is None:
+            if os.path.exists(self.chainwork_index_path()):
+                os.unlink(self.chainwork_index_path())
+            return
+        kept = [record for record in records if record[0] < height]
+        if len(kept) != len(records):
+            self._write_chainwork_index(kept)
+
+    @with_lock
+    def _delete_files(self) -> None:
+        self._close_headers_mmap()
+        for path in (self.path(), self.chainwork_index_path()):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    @with_lock
+    def _get_headers_mmap(self) -> Optional[mmap.mmap]:
+        """Returns a read-only memory map of our headers file.
+        The map is kept open across calls, so that reading a header does not
+        need any syscalls. Returns None if the file is empty, or if
+        memory-mapping is disabled or not possible.
+        """
+        if self._headers_mmap is not None:
+            return self._headers_mmap
+        if not self._use_mmap:
+            return None
+        length = self._size * HEADER_SIZE
+        if length == 0:
+            return None
+        try:
+            with open(self.path(), 'rb') as f:
+                self._headers_mmap = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"failed to mmap headers file, falling back to file reads: {e!r}")
+            self._use_mmap = False
+            return None
+        return self._headers_mmap
+
+    @with_lock
+    def _close_headers_mmap(self) -> None:
+        # note: must be called before the file is truncated, replaced or deleted (required on Windows)
+        if self._headers_mmap is not None:
+            self._headers_mmap.close()
+            self._headers_mmap = None
 
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
-        _hash = hash_header(header)
+    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      *, header_hash: str = None) -> None:
+        # header_hash can be passed in if it was already computed (e.g. by the verification pool)
+        _hash = header_hash if header_hash is not None else hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise InvalidHeader("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
@@ -381,19 +728,35 @@ class Blockchain(Logger):
         if block_hash_as_num > target:
             raise InvalidHeader(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
-    def verify_chunk(self, start_height: int, data: bytes) -> None:
-        raw = []
-        p = 0
-        s = start_height
+    def _get_dgw_window(self, start_height: int, prev_hash: str) -> DGWWindow:
+        """Returns our DGW window, positioned so that it ends at start_height-1."""
+        window = self._dgw_window
+        if window.tip_height == start_height - 1 and window.tip_hash == prev_hash:
+            return window
+        # the window got out of sync (e.g. verifying a fork, or a chunk failed);
+        # re-seed it from the headers we have, if they are needed at all
+        window.clear()
+        if start_height <= constants.net.max_checkpoint() or constants.net.TESTNET:
+            return window
+        for height in range(start_height - DGWWindow.SIZE, start_height):
+            header = self.read_header(height)
+            if header is None:
+                window.clear()
+                return window
+            window.push(height, header, None)
+        window.tip_hash = prev_hash
+        return window
+
+    def verify_chunk(self, start_height: int, data: bytes, header_hashes: Sequence[str] = None) -> None:
+        """Verifies a chunk of headers connecting to start_height-1.
+        header_hashes, if given, are the already computed PoW hashes of the headers
+        in the chunk, so only the cheap sequential checks are done here.
+        """
+        s = start_height - 1
         prev_hash = self.get_hash(start_height - 1)
+        dgw_window = self._get_dgw_window(start_height, prev_hash)
         headers = {}
-        while p < len(data):
-            if s < constants.net.KawpowActivationHeight:
-                raw = data[p:p + LEGACY_HEADER_SIZE]
-                p += LEGACY_HEADER_SIZE
-            else:
-                raw = data[p:p + HEADER_SIZE]
-                p += HEADER_SIZE
+        for s, raw in iter_chunk_headers(start_height, data):
             try:
                 expected_header_hash = self.get_hash(s)
             except MissingHeader:
@@ -413,16 +776,18 @@ class Blockchain(Logger):
                     # Just use the headers own bits for the logic
                     target = self.bits_to_target(header['bits'])
             else:
-                target = self.get_target(s, headers)
+                target = self.get_target(s, headers, dgw_window=dgw_window)
             
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
-            s += 1
+            header_hash = header_hashes[s - start_height] if header_hashes is not None else hash_header(header)
+            self.verify_header(header, prev_hash, target, expected_header_hash, header_hash=header_hash)
+            prev_hash = header_hash
+            dgw_window.push(s, header, prev_hash)
+        num_headers = s - start_height + 1
 
         # DGW must be received in correct chunk sizes to be valid with our checkpoints
         if constants.net.DGW_CHECKPOINTS_START <= start_height <= constants.net.max_checkpoint():
             assert start_height % constants.net.DGW_CHECKPOINTS_SPACING == 0, 'dgw chunk not from start'
-            assert s - start_height == constants.net.DGW_CHECKPOINTS_SPACING, 'dgw chunk not correct size'
+            assert num_headers == constants.net.DGW_CHECKPOINTS_SPACING, 'dgw chunk not correct size'
 
     @with_lock
     def path(self):
@@ -530,7 +895,11 @@ class Blockchain(Logger):
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_header(deserialize_header(parent_data[:HEADER_SIZE], forkpoint))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self._close_headers_mmap()
+        parent._close_headers_mmap()
         os.replace(child_old_name, parent.path())
+        if os.path.exists(child_old_name + '.chainwork'):
+            os.replace(child_old_name + '.chainwork', parent.chainwork_index_path())
         self.update_size()
         parent.update_size()
         # update pointers
@@ -555,6 +924,9 @@ class Blockchain(Logger):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        self._close_headers_mmap()
+        if offset < self._size * HEADER_SIZE:
+            self._truncate_chainwork_index(self.forkpoint + offset // HEADER_SIZE)
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -568,7 +940,7 @@ class Blockchain(Logger):
     @with_lock
     def save_header(self, header: dict) -> None:
         delta = header.get('block_height') - self.forkpoint
-        data = bfh(serialize_header(header))
+        data = header.serialize() if isinstance(header, Header) else bfh(serialize_header(header))
         # headers are only _appended_ to the end:
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
@@ -584,13 +956,24 @@ class Blockchain(Logger):
         if height > self.height():
             return
         delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        h = None
+        mm = self._get_headers_mmap()
+        if mm is not None:
+            try:
+                h = mm[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE]
+            except ValueError:
+                # the map got closed without going through _close_headers_mmap
+                self.logger.warning("headers mmap closed unexpectedly, reading from file")
+                if self._headers_mmap is mm:
+                    self._headers_mmap = None
+        if h is None:
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                f.seek(delta * HEADER_SIZE)
+                h = f.read(HEADER_SIZE)
+        if len(h) < HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
         if h == bytes([0])*HEADER_SIZE:
             return None
         return deserialize_header(h, height)
@@ -656,7 +1039,7 @@ class Blockchain(Logger):
                 raise MissingHeader(height)
             return hash_header(header)
 
-    def get_target(self, height: int, chain=None) -> int:         
+    def get_target(self, height: int, chain=None, *, dgw_window: DGWWindow = None) -> int:
         dgw_height_checkpoint = self.is_dgw_height_checkpoint(height)
 
         if constants.net.TESTNET:
@@ -686,9 +1069,14 @@ class Blockchain(Logger):
         else:
             # Now we no longer have cached checkpoints and need to compute our own DWG targets to verify
             # a header
+            if dgw_window is not None:
+                target = dgw_window.get_target(height)
+                if target is not None:
+                    return target
             return self.get_target_dgwv3(height, chain)
 
-    def convbignum(self, bits):
+    @staticmethod
+    def convbignum(bits):
         MM = 256 * 256 * 256
         a = bits % MM
         if a < 0x8000:
@@ -818,7 +1206,9 @@ class Blockchain(Logger):
                 work_in_chunk += self.chainwork_of_header_at_height(cached_height + i + 1)
             cached_height += 2016
             running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
+            block_hash = self.get_hash(cached_height)
+            _CHAINWORK_CACHE[block_hash] = running_total
+            self._append_to_chainwork_index(cached_height, block_hash, running_total)
         
         work_in_last_partial_chunk = 0
         for i in range(height - cached_height):
@@ -856,8 +1246,17 @@ class Blockchain(Logger):
         assert start_height >= 0, start_height
         try:
             data = bfh(hexdata)
+            header_hashes = None
+            num_workers = self.config.BLOCKCHAIN_VERIFY_WORKERS
+            if num_workers > 0:
+                # hashing is the expensive part of verification: fan it out to the worker
+                # processes, without blocking the event loop
+                header_hashes = await compute_chunk_pow_hashes(
+                    start_height, data,
+                    executor=util.get_worker_executor('header_pow', num_workers, processes=True),
+                    num_parts=num_workers)
             # This is computationally intensive (thanks DGW)
-            self.verify_chunk(start_height, data)
+            self.verify_chunk(start_height, data, header_hashes)
             self.save_chunk(start_height, data)
             return True
         except BaseException as e:
@@ -877,7 +1276,7 @@ class Blockchain(Logger):
 
 def check_header(header: dict) -> Optional[Blockchain]:
     """Returns any Blockchain that contains header, or None."""
-    if type(header) is not dict:
+    if not isinstance(header, (dict, Header)):
         return None
     with blockchains_lock: chains = list(blockchains.values())
     for b in chains:
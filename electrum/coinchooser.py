@@ -24,6 +24,7 @@
 # SOFTWARE.
 from collections import defaultdict
 from math import floor, log10
+import time
 from typing import NamedTuple, List, Callable, Sequence, Union, Dict, Tuple, Mapping, Type, TYPE_CHECKING, Optional
 from decimal import Decimal
 
@@ -47,31 +48,38 @@ class PRNG:
     def __init__(self, seed):
         self.sha = sha256(seed)
         self.pool = bytearray()
+        self.pos = 0  # bytes of pool already used
 
     def get_bytes(self, n: int) -> bytes:
-        while len(self.pool) < n:
+        while len(self.pool) - self.pos < n:
             self.pool.extend(self.sha)
             self.sha = sha256(self.sha)
-        result, self.pool = self.pool[:n], self.pool[n:]
-        return bytes(result)
+        result = bytes(self.pool[self.pos:self.pos + n])
+        self.pos += n
+        if self.pos >= 4096:
+            del self.pool[:self.pos]
+            self.pos = 0
+        return result
 
     def randint(self, start, end):
         # Returns random integer in [start, end)
         n = end - start
-        r = 0
-        p = 1
-        while p < n:
-            r = self.get_bytes(1)[0] + (r << 8)
-            p = p << 8
+        # as many big-endian bytes as needed to cover n values
+        r = int.from_bytes(self.get_bytes(((n - 1).bit_length() + 7) // 8), 'big')
         return start + (r % n)
 
     def choice(self, seq):
         return seq[self.randint(0, len(seq))]
 
     def shuffle(self, x):
-        for i in reversed(range(1, len(x))):
+        # same as calling randint(0, i+1) for each i, with the bytes fetched at once
+        sizes = [(i.bit_length() + 7) // 8 for i in reversed(range(1, len(x)))]
+        pool = self.get_bytes(sum(sizes))
+        pos = 0
+        for i, size in zip(reversed(range(1, len(x))), sizes):
             # pick an element in x[:i+1] with which to exchange x[i]
-            j = self.randint(0, i+1)
+            j = int.from_bytes(pool[pos:pos + size], 'big') % (i + 1)
+            pos += size
             x[i], x[j] = x[j], x[i]
 
 
@@ -106,17 +114,30 @@ class ScoredCandidate(NamedTuple):
     buckets: List[Bucket]
 
 
+class SelectionTarget(NamedTuple):
+    """What the buckets chosen by make_tx have to pay for."""
+    input_value: Mapping[Optional[str], int]   # of the fixed inputs
+    spent_amount: Mapping[Optional[str], int]  # by the fixed outputs
+    base_weight: int                           # of the tx without buckets and change
+    change_output_weight: int                  # of an RVN change output
+    has_fixed_inputs: bool
+    fee_estimator_w: Callable[[int], int]
+    dust_threshold: int
+
+
 def strip_unneeded(bkts: List[Bucket], sufficient_funds) -> List[Bucket]:
     '''Remove buckets that are unnecessary in achieving the spend amount'''
-    if sufficient_funds([], bucket_value_sum=defaultdict(int)):
+    if sufficient_funds(bucket_value_sum=defaultdict(int), bucket_weight_sum=0):
         # none of the buckets are needed
         return []
     bkts = sorted(bkts, reverse=True)
     bucket_value_sum = defaultdict(int)
+    bucket_weight_sum = 0
     for i in range(len(bkts)):
-        for asset, amount in (bkts[i]).value.items():
+        for asset, amount in bkts[i].value_.items():
             bucket_value_sum[asset] += amount
-        if sufficient_funds(bkts[:i+1], bucket_value_sum=bucket_value_sum):
+        bucket_weight_sum += bkts[i].weight
+        if sufficient_funds(bucket_value_sum=bucket_value_sum, bucket_weight_sum=bucket_weight_sum):
             return bkts[:i+1]
     raise Exception("keeping all buckets is still not enough")
 
@@ -164,7 +185,7 @@ class CoinChooserBase(Logger):
                 # when converting from weight to vBytes, instead of rounding up,
                 # keep fractional part, to avoid overestimating fee
                 fee = fee_estimator_vb(Decimal(weight) / 4)
-                effective_value = value
+                effective_value = defaultdict(int, value)
                 effective_value[None] -= fee
             return Bucket(desc=desc,
                           weight=weight,
@@ -370,28 +391,26 @@ class CoinChooserBase(Logger):
         def fee_estimator_w(weight):
             return fee_estimator_vb(Transaction.virtual_size_from_weight(weight))
 
-        def sufficient_funds(buckets, *, bucket_value_sum: Mapping[Optional[str], int]):
-            '''Given a list of buckets, return True if it has enough
-            value to pay for the transaction'''
-            # assert bucket_value_sum == sum(bucket.value for bucket in buckets)  # expensive!
-            total_input = defaultdict(int)
-            total_input.update(input_value)
-            for asset, value in bucket_value_sum.items():
-                total_input[asset] += value
-
+        def sufficient_funds(*, bucket_value_sum: Mapping[Optional[str], int], bucket_weight_sum: int):
+            '''Given the summed value and weight of a selection of buckets,
+            return True if it has enough value to pay for the transaction.
+            Callers keep running sums while they grow a selection, so this is
+            constant time.'''
             # shortcut for performance
-            if any((total_input[k] < v for k, v in spent_amount.items())):
+            if any(input_value.get(k, 0) + bucket_value_sum.get(k, 0) < v for k, v in spent_amount.items()):
                 return False
 
             # any bitcoin tx must have at least 1 input by consensus
             # (check we add some new UTXOs now or already have some fixed inputs)
-            if not buckets and not inputs:
+            # note: every bucket has a positive weight
+            if not bucket_weight_sum and not inputs:
                 return False
-            
-            # note re performance: so far this was constant time
-            # what follows is linear in len(buckets)
-            total_weight = self._get_tx_weight(buckets, base_weight=base_weight)
-            return total_input[None] >= spent_amount[None] + fee_estimator_w(total_weight)
+
+            # buckets have no witness on RVN (see make_Bucket), so the weight
+            # of the tx is the sum of the weights, as in _get_tx_weight
+            total_weight = base_weight + bucket_weight_sum
+            total_input = input_value.get(None, 0) + bucket_value_sum.get(None, 0)
+            return total_input >= spent_amount[None] + fee_estimator_w(total_weight)
 
         def tx_from_buckets(buckets):
             return self._construct_tx_from_selected_buckets(buckets=buckets,
@@ -402,6 +421,18 @@ class CoinChooserBase(Logger):
                                                             dust_threshold=dust_threshold,
                                                             base_weight=base_weight)
 
+        # change goes back to the first input address if no change address is given
+        change_addr = change_addrs[0] if change_addrs else (coins[0].address if coins else None)
+        change_output_weight = 4 * Transaction.estimated_output_size_for_address(change_addr) \
+            if change_addr and is_address(change_addr) else 0
+        target = SelectionTarget(input_value=input_value,
+                                 spent_amount=spent_amount,
+                                 base_weight=base_weight,
+                                 change_output_weight=change_output_weight,
+                                 has_fixed_inputs=bool(inputs),
+                                 fee_estimator_w=fee_estimator_w,
+                                 dust_threshold=dust_threshold)
+
         # Collect the coins into buckets
         all_buckets = self.bucketize_coins(coins, fee_estimator_vb=fee_estimator_vb)
         # Filter some buckets out. Only keep those that have positive effective value.
@@ -411,7 +442,8 @@ class CoinChooserBase(Logger):
         all_buckets = list(filter(lambda b: len(b.effective_value) > 1 or b.effective_value[None] > 0, all_buckets))
         # Choose a subset of the buckets
         scored_candidate = self.choose_buckets(all_buckets, sufficient_funds,
-                                               self.penalty_func(base_tx, tx_from_buckets=tx_from_buckets))
+                                               self.penalty_func(base_tx, tx_from_buckets=tx_from_buckets),
+                                               target=target)
         tx = scored_candidate.tx
 
         self.logger.info(f"using {len(tx.inputs())} inputs")
@@ -421,7 +453,8 @@ class CoinChooserBase(Logger):
 
     def choose_buckets(self, buckets: List[Bucket],
                        sufficient_funds: Callable,
-                       penalty_func: Callable[[List[Bucket]], ScoredCandidate]) -> ScoredCandidate:
+                       penalty_func: Callable[[List[Bucket]], ScoredCandidate],
+                       *, target: SelectionTarget = None) -> ScoredCandidate:
         raise NotImplemented('To be subclassed')
 
 
@@ -430,7 +463,7 @@ class CoinChooserRandom(CoinChooserBase):
     def bucket_candidates_any(self, buckets: List[Bucket], sufficient_funds) -> List[List[Bucket]]:
         '''Returns a list of bucket sets.'''
         if not buckets:
-            if sufficient_funds([], bucket_value_sum=defaultdict(int)):
+            if sufficient_funds(bucket_value_sum=defaultdict(int), bucket_weight_sum=0):
                 return [[]]
             else:
                 raise NotEnoughFunds()
@@ -439,7 +472,7 @@ class CoinChooserRandom(CoinChooserBase):
 
         # Add all singletons
         for n, bucket in enumerate(buckets):
-            if sufficient_funds([bucket], bucket_value_sum=bucket.value):
+            if sufficient_funds(bucket_value_sum=bucket.value_, bucket_weight_sum=bucket.weight):
                 candidates.add((n,))
 
         # And now some random ones
@@ -449,14 +482,14 @@ class CoinChooserRandom(CoinChooserBase):
             # Get a random permutation of the buckets, and
             # incrementally combine buckets until sufficient
             self.p.shuffle(permutation)
-            bkts = []
             bucket_value_sum = defaultdict(int)
+            bucket_weight_sum = 0
             for count, index in enumerate(permutation):
                 bucket = buckets[index]
-                bkts.append(bucket)
-                for asset, amount in bucket.value.items():
+                for asset, amount in bucket.value_.items():
                     bucket_value_sum[asset] += amount
-                if sufficient_funds(bkts, bucket_value_sum=bucket_value_sum):
+                bucket_weight_sum += bucket.weight
+                if sufficient_funds(bucket_value_sum=bucket_value_sum, bucket_weight_sum=bucket_weight_sum):
                     candidates.add(tuple(sorted(permutation[:count + 1])))
                     break
             else:
@@ -486,33 +519,37 @@ class CoinChooserRandom(CoinChooserBase):
         bucket_sets = [conf_buckets, unconf_buckets, other_buckets]
         already_selected_buckets = []
         already_selected_buckets_value_sum = defaultdict(int)
+        already_selected_buckets_weight_sum = 0
 
         for bkts_choose_from in bucket_sets:
             try:
                 def sfunds(
-                    bkts, *, bucket_value_sum,
+                    *, bucket_value_sum, bucket_weight_sum,
                     already_selected_buckets_value_sum=already_selected_buckets_value_sum,
-                    already_selected_buckets=already_selected_buckets,
+                    already_selected_buckets_weight_sum=already_selected_buckets_weight_sum,
                 ):
-                    for asset, amount in already_selected_buckets_value_sum.items():
-                        bucket_value_sum[asset] += amount
-                    return sufficient_funds(already_selected_buckets + bkts,
-                                            bucket_value_sum=bucket_value_sum)
+                    # note: bucket_value_sum is the running sum of the caller, do not modify it
+                    value_sum = defaultdict(int, already_selected_buckets_value_sum)
+                    for asset, amount in bucket_value_sum.items():
+                        value_sum[asset] += amount
+                    return sufficient_funds(bucket_value_sum=value_sum,
+                                            bucket_weight_sum=already_selected_buckets_weight_sum + bucket_weight_sum)
 
                 candidates = self.bucket_candidates_any(bkts_choose_from, sfunds)
                 break
             except NotEnoughFunds:
                 already_selected_buckets += bkts_choose_from
                 for bucket in bkts_choose_from:
-                    for asset, amount in bucket.value.items():
+                    for asset, amount in bucket.value_.items():
                         already_selected_buckets_value_sum[asset] += amount
+                    already_selected_buckets_weight_sum += bucket.weight
         else:
             raise NotEnoughFunds()
 
         candidates = [(already_selected_buckets + c) for c in candidates]
         return [strip_unneeded(c, sufficient_funds) for c in candidates]
 
-    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, *, target=None):
         candidates = self.bucket_candidates_prefer_confirmed(buckets, sufficient_funds)
         scored_candidates = [penalty_func(cand) for cand in candidates]
         winner = min(scored_candidates, key=lambda x: x.penalty)
@@ -580,8 +617,173 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+class CoinChooserBnB(CoinChooserPrivacy):
+    """Looks for a set of coins that pays for the transaction without
+    needing an RVN change output, by a branch-and-bound search (with a time
+    limit) over the coins of each address. Coins of an address are spent
+    together, as with Privacy. If no such set is found, coins are chosen
+    as with Privacy.
+    """
+
+    max_tries = 100_000
+    time_budget = 0.5  # seconds
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func, *, target=None):
+        if target is not None:
+            # same preference for confirmed coins as bucket_candidates_prefer_confirmed
+            conf_buckets = [bkt for bkt in buckets if bkt.min_height > 0]
+            unconf_buckets = [bkt for bkt in buckets if bkt.min_height == 0]
+            tiers = [conf_buckets, conf_buckets + unconf_buckets, buckets]
+            deadline = time.monotonic() + self.time_budget
+            for i, bkts in enumerate(tiers):
+                if i > 0 and len(bkts) == len(tiers[i - 1]):
+                    continue
+                selection = self.bucket_candidate_changeless(bkts, sufficient_funds, target, deadline=deadline)
+                if selection is not None:
+                    self.logger.info(f"Total number of buckets: {len(buckets)}. "
+                                     f"Found changeless selection of {len(selection)}")
+                    return penalty_func(selection)
+        return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+
+    @classmethod
+    def bucket_candidate_assets(cls, buckets: List[Bucket], asset_targets: Mapping[str, int]) -> Optional[List[Bucket]]:
+        """Returns buckets that cover the needed amount of each asset, or None
+        if there is not enough. Per asset, the smallest bucket covering what
+        is still missing is taken, else the largest ones until it is covered.
+        """
+        selected = []  # type: List[Bucket]
+        asset_sums = defaultdict(int)
+        for asset, asset_target in sorted(asset_targets.items()):
+            if asset_sums[asset] >= asset_target:
+                continue
+            selected_ids = {id(bkt) for bkt in selected}
+            candidates = sorted((bkt for bkt in buckets if bkt.value_.get(asset, 0) > 0 and id(bkt) not in selected_ids),
+                                key=lambda bkt: (-bkt.value_[asset], bkt.weight, bkt.desc))
+            missing = asset_target - asset_sums[asset]
+            covering = [bkt for bkt in candidates if bkt.value_[asset] >= missing]
+            if covering:
+                candidates = covering[-1:]
+            for bkt in candidates:
+                selected.append(bkt)
+                for a, amount in bkt.value_.items():
+                    asset_sums[a] += amount
+                if asset_sums[asset] >= asset_target:
+                    break
+            else:
+                return None
+        return selected
+
+    def bucket_candidate_changeless(self, buckets: List[Bucket], sufficient_funds, target: SelectionTarget,
+                                    *, deadline: float) -> Optional[List[Bucket]]:
+        """Returns a set of buckets that pays for the tx without RVN change, or None.
+
+        The needed assets are covered first, by bucket_candidate_assets. The
+        RVN part is then searched with branch and bound over the buckets
+        without needed assets: among the sets found within max_tries steps
+        and before the deadline, the one losing the least RVN to fees (then,
+        the lightest one) is returned. The search uses a linear approximation
+        of the fee; candidates are checked with the fee estimator and
+        sufficient_funds.
+        """
+        fee_estimator_w = target.fee_estimator_w
+        input_value = defaultdict(int, target.input_value)
+        spent_amount = target.spent_amount
+        asset_targets = {asset: amount - input_value[asset]
+                         for asset, amount in spent_amount.items() if asset is not None}
+        asset_buckets = [bkt for bkt in buckets if any(bkt.value_.get(asset, 0) for asset in asset_targets)]
+        fixed = self.bucket_candidate_assets(asset_buckets, asset_targets)
+        if fixed is None:
+            return None
+        fixed_value_sum = defaultdict(int)
+        for bkt in fixed:
+            for asset, amount in bkt.value_.items():
+                fixed_value_sum[asset] += amount
+        # assets that get a change output. Asset change is never dust.
+        change_weight = sum(
+            target.change_output_weight + 4 * extra_size_for_asset_transfer(asset)
+            for asset in set(input_value) | set(fixed_value_sum)
+            if asset is not None and input_value[asset] + fixed_value_sum[asset] > spent_amount.get(asset, 0))
+        fixed_bucket_weight = sum(bkt.weight for bkt in fixed)
+        fixed_weight = target.base_weight + change_weight + fixed_bucket_weight
+
+        # precomputed per-bucket arrays, by decreasing effective value
+        feerate = (fee_estimator_w(fixed_weight + 10 ** 6) - fee_estimator_w(fixed_weight)) / 10 ** 6
+        asset_bucket_ids = {id(bkt) for bkt in asset_buckets}
+        buckets = sorted((bkt for bkt in buckets if id(bkt) not in asset_bucket_ids),
+                         key=lambda bkt: (-(bkt.value_.get(None, 0) - feerate * bkt.weight), bkt.desc))
+        n = len(buckets)
+        weights = [bkt.weight for bkt in buckets]
+        values = [bkt.value_.get(None, 0) for bkt in buckets]
+        effective_values = [value - feerate * weight for value, weight in zip(values, weights)]
+        # suffix sums, bounding what the unexplored buckets can add
+        pos_suffix = [0.0] * (n + 1)
+        neg_suffix = [0.0] * (n + 1)
+        for i in reversed(range(n)):
+            pos_suffix[i] = pos_suffix[i + 1] + max(0.0, effective_values[i])
+            neg_suffix[i] = neg_suffix[i + 1] + min(0.0, effective_values[i])
+
+        # excess of a selection ~= base_excess + its effective value
+        base_excess = (input_value[None] + fixed_value_sum[None] - spent_amount.get(None, 0)
+                       - fee_estimator_w(fixed_weight))
+        # excess that gets dropped to the fee instead of making an RVN change output
+        max_excess = target.dust_threshold + feerate * target.change_output_weight
+        tolerance = 1 + feerate * 8  # rounding of the fee estimator
+        has_inputs = target.has_fixed_inputs or bool(fixed)
+
+        def is_changeless(value: int, weight: int) -> bool:
+            fee = fee_estimator_w(fixed_weight + weight)
+            excess = base_excess + fee_estimator_w(fixed_weight) - fee + value
+            fee_for_change = fee_estimator_w(fixed_weight + weight + target.change_output_weight) - fee
+            return 0 <= excess < target.dust_threshold + fee_for_change
+
+        selection = []  # type: List[int]
+        sel_effective_value = 0.0
+        sel_value = 0
+        sel_weight = 0
+        best = None  # type: Optional[List[int]]
+        best_value = best_weight = None
+        i = 0
+        for tries in range(self.max_tries):
+            if tries % 1024 == 0 and time.monotonic() > deadline:
+                break
+            backtrack = False
+            approx_excess = base_excess + sel_effective_value
+            if (approx_excess + pos_suffix[i] < -tolerance
+                    or approx_excess + neg_suffix[i] > max_excess + tolerance
+                    or (best is not None and (sel_value, sel_weight) >= (best_value, best_weight))):
+                backtrack = True
+            elif approx_excess >= -tolerance and (selection or has_inputs):
+                if is_changeless(sel_value, sel_weight):
+                    bucket_value_sum = defaultdict(int, fixed_value_sum)
+                    bucket_value_sum[None] += sel_value
+                    if sufficient_funds(bucket_value_sum=bucket_value_sum,
+                                        bucket_weight_sum=fixed_bucket_weight + sel_weight):
+                        best, best_value, best_weight = list(selection), sel_value, sel_weight
+                        backtrack = True
+            if not backtrack and i < n:
+                # explore the branch including bucket i first
+                selection.append(i)
+                sel_effective_value += effective_values[i]
+                sel_value += values[i]
+                sel_weight += weights[i]
+                i += 1
+                continue
+            # backtrack: exclude the last included bucket instead
+            if not selection:
+                break
+            j = selection.pop()
+            sel_effective_value -= effective_values[j]
+            sel_value -= values[j]
+            sel_weight -= weights[j]
+            i = j + 1
+        if best is None:
+            return None
+        return fixed + [buckets[j] for j in best]
+
+
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBnB,
 }  # type: Mapping[str, Type[CoinChooserBase]]
 
 def get_name(config: 'SimpleConfig') -> str:
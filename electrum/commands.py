@@ -464,10 +464,10 @@ class Commands:
         return tx.serialize()
 
     @command('wp')
-    async def signtransaction(self, tx, password=None, wallet: Abstract_Wallet = None):
+    async def signtransaction(self, tx, password=None, workers=None, wallet: Abstract_Wallet = None):
         """Sign a transaction. The wallet keys will be used to sign the transaction."""
         tx = tx_from_any(tx)
-        wallet.sign_transaction(tx, password)
+        wallet.sign_transaction(tx, password, num_workers=workers)
         return tx.serialize()
 
     @command('')
@@ -1476,7 +1476,8 @@ command_options = {
     'from_amount': (None, "Amount to convert (default: 1)"),
     'from_ccy':    (None, "Currency to convert from"),
     'to_ccy':      (None, "Currency to convert to"),
-    'asset':       (None, "The asset for the transaction")
+    'asset':       (None, "The asset for the transaction"),
+    'workers':     (None, "Number of threads signing the inputs, experimental (default: config 'wallet_signing_workers')"),
 }
 
 
@@ -1504,6 +1505,7 @@ arg_types = {
     'encrypt_file': eval_bool,
     'rbf': eval_bool,
     'timeout': float,
+    'workers': int,
 }
 
 config_variables = {
@@ -595,6 +595,7 @@ class Daemon(Logger):
                     if self.network:
                         await group.spawn(self.network.stop(full_shutdown=True))
                     await group.spawn(self.taskgroup.cancel_remaining())
+            util.shutdown_worker_executors()
             self.logger.info('saving IPFS metadata')
             IPFSDB.get_instance().write()
             if self._plugins:
@@ -468,6 +468,7 @@ class ElectrumGui(BaseElectrumGui, Logger):
         self.timer.start()
         IPFSDB.initialize(self.config.get_ipfs_data_path(), self.config.get_ipfs_raw_path())
         IPFSDB.get_instance().purge_stale_ipfs_data()
+        IPFSDB.get_instance().enforce_cache_size(self.config.MAX_IPFS_CACHE_SIZE)
         path = self.config.get_wallet_path(use_gui_last_wallet=True)
         try:
             if not self.start_new_window(path, self.config.get('url'), app_is_starting=True):
@@ -179,6 +179,26 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_batch_request(self, method: str, params_list: Sequence[List], *, timeout=None) -> Sequence:
+        """Sends one JSON-RPC batch of method calls, one per params.
+        Returns the results in the same order. Requests that failed have an exception as result.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(params_list)} {method} (id: {msg_id})")
+
+        async def send_batch():
+            async with self.send_batch() as batch:
+                for params in params_list:
+                    batch.add_request(method, params)
+            return batch.results
+
+        try:
+            results = await util.wait_for2(send_batch(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'request timed out: batch of {len(params_list)} {method} (id: {msg_id})') from e
+        self.maybe_log(f"--> {results} (id: {msg_id})")
+        return results
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -195,6 +215,34 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_batch(self, method: str, params_list: Sequence[List], queue: asyncio.Queue):
+        """Like subscribe, for several params at once. The ones not in the cache
+        are requested in a single JSON-RPC batch. If the server returned an error for
+        some of them, the first error is raised after queueing the other results.
+        """
+        if len(params_list) == 1:
+            return await self.subscribe(method, params_list[0], queue)
+        to_request = []
+        for params in params_list:
+            key = self.get_hashable_key_for_rpc_call(method, params)
+            self.subscriptions[key].append(queue)
+            if key in self.cache:
+                await queue.put(params + [self.cache[key]])
+            else:
+                to_request.append(params)
+        if not to_request:
+            return
+        results = await self.send_batch_request(method, to_request)
+        error = None
+        for params, result in zip(to_request, results):
+            if isinstance(result, Exception):
+                error = error or result
+                continue
+            self.cache[self.get_hashable_key_for_rpc_call(method, params)] = result
+            await queue.put(params + [result])
+        if error is not None:
+            raise error
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -648,11 +696,22 @@ class Interface(Logger):
         if tip is not None:
             size = min(size, tip - height + 1)
             size = max(size, 0)
+        hexdata = await self._fetch_chunk(height, size)
+        conn = await self.blockchain.connect_chunk(height, hexdata)
+
+        if not conn:
+            return conn, 0
+        return conn, size
+
+    async def _fetch_chunk(self, height: int, size: int) -> str:
+        """Requests the headers [height, height+size) and sanity-checks the response.
+        Returns the headers as hex, they are not verified yet.
+        """
         try:
-            self._requested_chunks.add((height, height + size))            
+            self._requested_chunks.add((height, height + size))
             res = await self.session.send_request('blockchain.block.headers', [height, size])
         finally:
-            self._requested_chunks.discard((height, height + size))        
+            self._requested_chunks.discard((height, height + size))
         assert_dict_contains_field(res, field_name='count')
         assert_dict_contains_field(res, field_name='hex')
         assert_dict_contains_field(res, field_name='max')
@@ -668,11 +727,62 @@ class Interface(Logger):
             raise RequestCorrupted(f"server uses too low 'max' count for block.headers: {res['max']} < 2016")
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = await self.blockchain.connect_chunk(height, res['hex'])
+        return res['hex']
 
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+    async def request_chunks_pipelined(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Downloads the headers [height, tip] in chunks of 2016, keeping several
+        requests in flight, and connects them to our blockchain strictly in order.
+        If enabled, requests are spread over other interfaces that are at least at tip.
+
+        Like request_chunk, returns (could_connect, num_headers), where num_headers
+        is the number of headers connected before the first failure, if any.
+        """
+        assert height <= tip, (height, tip)
+        if constants.net.DGW_CHECKPOINTS_START <= height <= constants.net.max_checkpoint():
+            # same alignment as in request_chunk; as chunks are 2016 long, all of them stay aligned
+            height = (height // constants.net.DGW_CHECKPOINTS_SPACING) * constants.net.DGW_CHECKPOINTS_SPACING
+        config = self.network.config
+        depth = max(1, config.NETWORK_HEADER_PIPELINE_DEPTH)
+        sources = [self]
+        if config.NETWORK_HEADER_PIPELINE_SPREAD:
+            sources += self.network.get_interfaces_for_header_download(min_tip=tip, exclude=self)
+        starts = list(range(height, tip + 1, 2016))
+
+        def chunk_size(start: int) -> int:
+            return min(2016, tip - start + 1)
+
+        async def fetch(index: int) -> Tuple['Interface', str]:
+            start = starts[index]
+            size = chunk_size(start)
+            source = sources[index % len(sources)]
+            if source is not self:
+                try:
+                    return source, await source._fetch_chunk(start, size)
+                except Exception as e:
+                    self.logger.info(f"failed to get chunk {start} from {source.server}: {e!r}")
+            return self, await self._fetch_chunk(start, size)
+
+        self.logger.info(f"requesting {len(starts)} chunks from height {height}, "
+                         f"{depth} in flight, from {len(sources)} servers")
+        num_headers = 0
+        tasks = {}  # type: Dict[int, asyncio.Task]
+        async with OldTaskGroup() as group:
+            for index, start in enumerate(starts):
+                for i in range(index, min(index + depth, len(starts))):
+                    if i not in tasks:
+                        tasks[i] = await group.spawn(fetch(i))
+                source, hexdata = await tasks.pop(index)
+                conn = await self.blockchain.connect_chunk(start, hexdata)
+                if not conn and source is not self:
+                    # that server might follow another fork; ask ours
+                    hexdata = await self._fetch_chunk(start, chunk_size(start))
+                    conn = await self.blockchain.connect_chunk(start, hexdata)
+                if not conn:
+                    await group.cancel_remaining()
+                    return num_headers > 0, num_headers
+                num_headers += chunk_size(start)
+                util.trigger_callback('network_updated')
+        return True, num_headers
 
     def is_main_server(self) -> bool:
         return (self.network.interface == self or
@@ -813,7 +923,10 @@ class Interface(Logger):
                     # the start and end block's targets
                     height = (height // constants.net.DGW_CHECKPOINTS_SPACING) * constants.net.DGW_CHECKPOINTS_SPACING
 
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if self.network.config.NETWORK_HEADER_PIPELINE_DEPTH > 1:
+                    could_connect, num_headers = await self.request_chunks_pipelined(height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
 
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
@@ -1009,6 +1122,27 @@ class Interface(Logger):
         # do request
         res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
         # check response
+        self._check_merkle_response(res)
+        return res
+
+    async def get_merkles_for_transactions(self, tx_hashes: Sequence[str], tx_height: int) -> List[Union[dict, Exception]]:
+        """Like get_merkle_for_transaction, for several txs at the same height, in one batch request.
+        Returns the responses in the same order. For txs the server returned an error for, that error.
+        """
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        if not is_non_negative_integer(tx_height):
+            raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.session.send_batch_request(
+            'blockchain.transaction.get_merkle', [[tx_hash, tx_height] for tx_hash in tx_hashes])
+        for res in results:
+            if not isinstance(res, Exception):
+                self._check_merkle_response(res)
+        return list(results)
+
+    @classmethod
+    def _check_merkle_response(cls, res) -> None:
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
         pos = assert_dict_contains_field(res, field_name='pos')
@@ -1018,7 +1152,6 @@ class Interface(Logger):
         assert_list_or_tuple(merkle)
         for item in merkle:
             assert_hash256_str(item)
-        return res
 
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
@@ -1,3 +1,4 @@
+import base64
 import json
 import os
 import threading
@@ -8,13 +9,14 @@ import time
 import itertools
 
 import aiofiles
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from typing import TYPE_CHECKING, Set, Dict, Optional
 
 from aiohttp import ClientResponse
 from aiorpcx import run_in_thread
 from multiformats import CID
-from ipfs_car_decoder import stream_bytes, FileByteStream
+from ipfs_car_decoder import CarDecodeException
+from unix_fs_exporter import export, BlockStore, UnixFSFile, RawNode, IdentityNode
 
 from .bitcoin import base_decode
 from .json_db import JsonDB, locked, modifier, StoredObject, StoredDict
@@ -76,10 +78,168 @@ def human_readable_size(size, decimal_places=3, greater_than=False):
 
 
 def cidv0_to_base32_cidv1(b58_ipfs_hash: str):
+    raw_hash = base_decode(b58_ipfs_hash, base=58)
+    if len(raw_hash) == 34 and raw_hash[:2] == b"\x12\x20":
+        # sha2-256 dag-pb; multiformats takes about a millisecond for this
+        cid = b"\x01\x70" + raw_hash
+        return "b" + base64.b32encode(cid).decode("ascii").lower().rstrip("=")
     v0_cid = CID.decode(b58_ipfs_hash)
     return CID("base32", 1, "dag-pb", v0_cid.digest).encode()
 
 
+# CARv2 starts with this header section, followed by a fixed size header
+# pointing at the CARv1 payload
+_CARV2_PRAGMA = bytes.fromhex("a16776657273696f6e02")
+_CARV2_HEADER_LENGTH = 40
+
+
+def _read_varint(buf, pos: int, end: int):
+    """Returns (value, position after the varint), or None if the varint is
+    not complete before end."""
+    result = 0
+    shift = 0
+    while pos < end:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise CarDecodeException("cannot decode varint")
+    return None
+
+
+class _StreamingCARBlockStore(BlockStore):
+    """Block store filled from a CAR stream while it is being downloaded.
+    Blocks are hash-verified as they arrive; get_block waits for blocks that
+    have not arrived yet."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._buf_offset = 0  # stream position of self._buf[0]
+        self._skip_to = None  # type: Optional[int]
+        self._data_end = None  # type: Optional[int]
+        self._is_v2 = False
+        self._header_read = False
+        self._blocks = {}  # type: Dict[bytes, bytes]
+        self._complete = False
+        self._blocks_cond = asyncio.Condition()
+
+    async def feed(self, chunk: bytes) -> None:
+        assert not self._complete
+        self._buf += chunk
+        if self._parse():
+            async with self._blocks_cond:
+                self._blocks_cond.notify_all()
+
+    async def finish(self) -> None:
+        """Marks the end of the stream. Raises if it ended in the middle of
+        a section."""
+        self._parse()
+        end = len(self._buf)
+        if self._data_end is not None:
+            end = self._data_end - self._buf_offset
+        if not self._header_read or self._skip_to is not None or end > 0:
+            raise CarDecodeException("truncated car stream")
+        self._complete = True
+        async with self._blocks_cond:
+            self._blocks_cond.notify_all()
+
+    async def get_block(self, cid: CID) -> bytes:
+        digest = cid.digest
+        async with self._blocks_cond:
+            await self._blocks_cond.wait_for(lambda: digest in self._blocks or self._complete)
+        try:
+            return self._blocks[digest]
+        except KeyError:
+            raise CarDecodeException(f"block {cid} not in car stream") from None
+
+    def _parse(self) -> bool:
+        """Consumes the complete sections in the buffer. Returns whether
+        new blocks were added."""
+        buf = self._buf
+        pos = 0
+        added = False
+        while True:
+            if self._skip_to is not None:
+                if self._skip_to < self._buf_offset + pos:
+                    raise CarDecodeException("car v2 data offset points backwards")
+                pos = min(self._skip_to - self._buf_offset, len(buf))
+                if self._buf_offset + pos < self._skip_to:
+                    break
+                self._skip_to = None
+            end = len(buf)
+            if self._data_end is not None:
+                end = min(end, self._data_end - self._buf_offset)
+            varint = _read_varint(buf, pos, end)
+            if varint is None:
+                break
+            length, start = varint
+            if length <= 0:
+                raise CarDecodeException("section length must be positive")
+            if start + length > end:
+                break
+            if not self._header_read:
+                if buf[start:start + length] == _CARV2_PRAGMA:
+                    if self._is_v2:
+                        raise CarDecodeException("v1 header must be with the v2 header")
+                    header_end = start + length + _CARV2_HEADER_LENGTH
+                    if header_end > end:
+                        break
+                    data_offset = int.from_bytes(buf[header_end - 24:header_end - 16], "little")
+                    data_size = int.from_bytes(buf[header_end - 16:header_end - 8], "little")
+                    self._is_v2 = True
+                    self._skip_to = data_offset
+                    self._data_end = data_offset + data_size
+                    pos = header_end
+                    continue
+                # the roots of the v1 header are not needed, we know which cid we want
+                self._header_read = True
+            else:
+                self._add_block(memoryview(bytes(buf[start:start + length])))
+                added = True
+            pos = start + length
+        del buf[:pos]
+        self._buf_offset += pos
+        return added
+
+    def _add_block(self, section: memoryview) -> None:
+        if len(section) >= 34 and section[0] == 0x12 and section[1] == 0x20:
+            cid = CID.decode(bytes(section[:34]))
+            pos = 34
+        else:
+            end = len(section)
+            fields = []
+            pos = 0
+            for i in range(4):
+                varint = _read_varint(section, pos, end)
+                if varint is None:
+                    raise CarDecodeException("truncated block cid")
+                value, pos = varint
+                fields.append(value)
+            version, codec, multihash_code, multihash_length = fields
+            if pos + multihash_length > end:
+                raise CarDecodeException("truncated block cid")
+            raw_hash = bytes(section[pos:pos + multihash_length])
+            cid = CID("base32", version, codec, (multihash_code, raw_hash))
+            pos += multihash_length
+        data = bytes(section[pos:])
+        hash_fun, _ = cid.hashfun.implementation
+        if hash_fun(data) != cid.raw_digest:
+            raise CarDecodeException(f"block {cid} does not match its digest")
+        self._blocks[cid.digest] = data
+
+
+async def _write_car_stream_to_file(v1_cid: str, block_store: BlockStore, path: str) -> None:
+    result = await export(CID.decode(v1_cid), block_store)
+    if not isinstance(result, (UnixFSFile, RawNode, IdentityNode)):
+        raise CarDecodeException(f"car stream for {v1_cid} not convertable to bytes")
+    async with aiofiles.open(path, "wb") as f:
+        async for chunk in result.content:
+            await f.write(chunk)
+
+
 @attr.s
 class IPFSMetadata(StoredObject):
     known_size = attr.ib(
@@ -112,6 +272,14 @@ class IPFSMetadata(StoredObject):
         default=False, type=bool, validator=attr.validators.instance_of(bool)
     )
     associated_assets = attr.ib(factory=set, type=Set[str], converter=set)
+    # assets of a wallet (held or watched) rather than ones only being viewed;
+    # their data is never evicted from the cache
+    pinned_assets = attr.ib(factory=set, type=Set[str], converter=set)
+    last_accessed = attr.ib(
+        default=None,
+        type=Optional[int],
+        validator=attr.validators.optional(attr.validators.instance_of(int)),
+    )
 
 
 class IPFSDBReadWriteError(Exception):
@@ -157,8 +325,26 @@ class IPFSDB(JsonDB, EventListener):
         self._ipfs_lookup_current = set()
         self._ipfs_download_current = set()
 
+        # ipfs hash -> size of the data on disk, least recently accessed first
+        self._cached_data_sizes = OrderedDict()  # type: OrderedDict[str, int]
+        self._cached_data_total_size = 0
+        self._load_cached_data_sizes()
+
         self.register_callbacks()
 
+    def _load_cached_data_sizes(self):
+        for ipfs_hash, m in sorted(
+            self.data.items(), key=lambda item: item[1].last_accessed or 0
+        ):
+            if not m.is_client_side:
+                continue
+            try:
+                size = os.path.getsize(self._local_path_for_ipfs_data(ipfs_hash))
+            except OSError:
+                continue
+            self._cached_data_sizes[ipfs_hash] = size
+            self._cached_data_total_size += size
+
     def _should_convert_to_stored_dict(self, key) -> bool:
         return False
 
@@ -231,13 +417,35 @@ class IPFSDB(JsonDB, EventListener):
 
     @locked
     def get_total_bytes_on_disk(self):
-        total_size = 0
-        for _, _, filenames in os.walk(self.raw_ipfs_path):
-            for file in filenames:
-                path = os.path.join(self.raw_ipfs_path, file)
-                if not os.path.islink(path):
-                    total_size += os.path.getsize(path)
-        return total_size
+        return self._cached_data_total_size
+
+    @locked
+    def _add_cached_data(self, ipfs_hash: str, m: IPFSMetadata):
+        m.last_accessed = int(time.time())
+        size = os.path.getsize(self._local_path_for_ipfs_data(ipfs_hash))
+        self._cached_data_total_size += size - self._cached_data_sizes.pop(ipfs_hash, 0)
+        self._cached_data_sizes[ipfs_hash] = size
+
+    @modifier
+    def enforce_cache_size(self, max_size: int, *, keep: Optional[str] = None):
+        """Removes the least recently accessed data until the cache fits in
+        max_size bytes. Data of pinned assets is kept."""
+        if self._cached_data_total_size <= max_size:
+            return
+        for ipfs_hash in list(self._cached_data_sizes):
+            if self._cached_data_total_size <= max_size:
+                break
+            m = self.data.get(ipfs_hash)
+            if ipfs_hash == keep or (m is not None and m.pinned_assets):
+                continue
+            self.logger.info(f"evicting ipfs data for {ipfs_hash}")
+            if m is not None:
+                m.is_client_side = False
+            self.remove_ipfs_data(ipfs_hash)
+        if self._cached_data_total_size > max_size:
+            self.logger.info(
+                f"ipfs cache over budget with pinned data: {self._cached_data_total_size} > {max_size}"
+            )
 
     @modifier
     def clear_cache(self):
@@ -248,6 +456,8 @@ class IPFSDB(JsonDB, EventListener):
         self.set_modified(True)
 
     def remove_ipfs_data(self, ipfs_hash: str):
+        with self.lock:
+            self._cached_data_total_size -= self._cached_data_sizes.pop(ipfs_hash, 0)
         ipfs_file = self._local_path_for_ipfs_data(ipfs_hash)
         try:
             os.remove(ipfs_file)
@@ -263,7 +473,7 @@ class IPFSDB(JsonDB, EventListener):
             if m is None:
                 return
             v1_cid = cidv0_to_base32_cidv1(ipfs_hash)
-            car_block = os.path.join(network.config.path, "cache", f"{v1_cid}.car")
+            writer = None
             try:
                 resp.raise_for_status()
                 if resp.content_type != "application/vnd.ipld.car":
@@ -272,24 +482,32 @@ class IPFSDB(JsonDB, EventListener):
                 # Ensure we aren't appending to something thats already there
                 self.remove_ipfs_data(ipfs_hash)
 
+                # Blocks are verified as they arrive and the file is written
+                # while the car block is still downloading
+                block_store = _StreamingCARBlockStore()
+                ipfs_file = self._local_path_for_ipfs_data(ipfs_hash)
+                writer = asyncio.create_task(
+                    _write_car_stream_to_file(v1_cid, block_store, ipfs_file)
+                )
+
                 downloaded_length = 0
-                async with aiofiles.open(car_block, "wb") as f:
-                    async for chunk, _ in resp.content.iter_chunks():
-                        downloaded_length += len(chunk)
-                        if downloaded_length > network.config.MAX_IPFS_DOWNLOAD_SIZE:
-                            self.logger.warning(f"oversized ipfs data for {ipfs_hash}")
-                            m.over_sized = True
-                            m.known_size = downloaded_length
-                            raise self._DownloadException()
-                        await f.write(chunk)
+                async for chunk, _ in resp.content.iter_chunks():
+                    downloaded_length += len(chunk)
+                    if downloaded_length > network.config.MAX_IPFS_DOWNLOAD_SIZE:
+                        self.logger.warning(f"oversized ipfs data for {ipfs_hash}")
+                        m.over_sized = True
+                        m.known_size = downloaded_length
+                        raise self._DownloadException()
+                    await block_store.feed(chunk)
+                    if writer.done():
+                        # failed, or all blocks of the file have been received
+                        break
+                else:
+                    await block_store.finish()
                 self.logger.info(f"successfully downloaded car block for {ipfs_hash}")
 
                 try:
-                    ipfs_file = self._local_path_for_ipfs_data(ipfs_hash)
-                    async with FileByteStream(car_block) as stream:
-                        async with aiofiles.open(ipfs_file, "wb") as f:
-                            async for chunk in stream_bytes(v1_cid, stream):
-                                await f.write(chunk)
+                    await writer
                 except Exception as e:
                     self.logger.warning(f"failed to decode car block for {ipfs_hash}")
                     raise e
@@ -297,14 +515,20 @@ class IPFSDB(JsonDB, EventListener):
                 self.logger.info(f"successfully decoded car block for {ipfs_hash}")
                 m.known_size = downloaded_length
                 m.is_client_side = True
-            except Exception as e:
+                self._add_cached_data(ipfs_hash, m)
+                self.enforce_cache_size(
+                    network.config.MAX_IPFS_CACHE_SIZE, keep=ipfs_hash
+                )
+            except BaseException as e:
+                if writer is not None and not writer.done():
+                    writer.cancel()
+                    # let it close the file before removing it
+                    await asyncio.wait([writer])
                 self.remove_ipfs_data(ipfs_hash)
                 # Move on to next url
                 if not isinstance(e, self._DownloadException):
                     raise e
             finally:
-                if os.path.exists(car_block):
-                    os.unlink(car_block)
                 resp.close()
 
         async def lookup_data(ipfs_url: str):
@@ -584,7 +808,7 @@ class IPFSDB(JsonDB, EventListener):
                 )
 
     async def maybe_get_info_for_ipfs_hash(
-        self, network: "Network", ipfs_hash: str, asset: str
+        self, network: "Network", ipfs_hash: str, asset: str, *, pin: bool = False
     ):
         assert isinstance(ipfs_hash, str)
         assert isinstance(asset, str)
@@ -593,7 +817,7 @@ class IPFSDB(JsonDB, EventListener):
         raw_hash = base_decode(ipfs_hash, base=58)
         if len(raw_hash) != 34 or raw_hash[:2] != b"\x12\x20":
             raise ValueError(f"Invalid ipfs hash: {ipfs_hash} ({ipfs_hash.__class__})")
-        self.associate_asset_with_ipfs(ipfs_hash, asset)
+        self.associate_asset_with_ipfs(ipfs_hash, asset, pin=pin)
         if not network.config.DOWNLOAD_IPFS:
             return
         with self.lock:
@@ -636,7 +860,7 @@ class IPFSDB(JsonDB, EventListener):
         metadata = adb.db.get_verified_asset_metadata(asset)
         if metadata and metadata.is_associated_data_ipfs():
             await self.maybe_get_info_for_ipfs_hash(
-                adb.network, metadata.associated_data_as_ipfs(), asset
+                adb.network, metadata.associated_data_as_ipfs(), asset, pin=True
             )
 
     @event_listener
@@ -648,7 +872,7 @@ class IPFSDB(JsonDB, EventListener):
             metadata = metadata_tup[0]
             if metadata.is_associated_data_ipfs():
                 await self.maybe_get_info_for_ipfs_hash(
-                    adb.network, metadata.associated_data_as_ipfs(), asset
+                    adb.network, metadata.associated_data_as_ipfs(), asset, pin=True
                 )
 
     @event_listener
@@ -658,7 +882,9 @@ class IPFSDB(JsonDB, EventListener):
         broadcast = adb.db.get_verified_broadcast(asset, tx_hash)
         maybe_ipfs = broadcast["data"]
         if maybe_ipfs[:2] == "Qm":
-            await self.maybe_get_info_for_ipfs_hash(adb.network, maybe_ipfs, asset)
+            await self.maybe_get_info_for_ipfs_hash(
+                adb.network, maybe_ipfs, asset, pin=True
+            )
 
     @event_listener
     async def on_event_adb_added_unconfirmed_broadcast(
@@ -667,7 +893,9 @@ class IPFSDB(JsonDB, EventListener):
         broadcast = adb.get_unverified_broadcasts()[asset][tx_hash]
         maybe_ipfs = broadcast["data"]
         if maybe_ipfs[:2] == "Qm":
-            await self.maybe_get_info_for_ipfs_hash(adb.network, maybe_ipfs, asset)
+            await self.maybe_get_info_for_ipfs_hash(
+                adb.network, maybe_ipfs, asset, pin=True
+            )
 
     @event_listener
     def on_event_ipfs_hash_dissociate_asset(self, ipfs_hash: str, asset: str):
@@ -679,18 +907,23 @@ class IPFSDB(JsonDB, EventListener):
         if m:
             self.logger.info(f"disassociating {asset} from {ipfs_hash}")
             m.associated_assets.discard(asset)
+            m.pinned_assets.discard(asset)
             if not m.associated_assets:
                 self.logger.info(f"nothing pinning {ipfs_hash}; removing")
                 self.remove_ipfs_info(ipfs_hash)
 
     @modifier
-    def associate_asset_with_ipfs(self, ipfs_hash: str, asset: str):
+    def associate_asset_with_ipfs(self, ipfs_hash: str, asset: str, *, pin: bool = False):
         m = self.data.get(ipfs_hash, None)
         if m is None:
-            m = IPFSMetadata(associated_assets={asset})
+            m = IPFSMetadata(
+                associated_assets={asset}, pinned_assets={asset} if pin else set()
+            )
             self.data[ipfs_hash] = m
         else:
             m.associated_assets.add(asset)
+            if pin:
+                m.pinned_assets.add(asset)
 
     @locked
     def get_metadata(self, ipfs_hash: str):
@@ -715,4 +948,7 @@ class IPFSDB(JsonDB, EventListener):
         path = self._local_path_for_ipfs_data(ipfs_hash)
         if not os.path.exists(path):
             return None, None
+        m.last_accessed = int(time.time())
+        if ipfs_hash in self._cached_data_sizes:
+            self._cached_data_sizes.move_to_end(ipfs_hash)
         return path, m.known_mime
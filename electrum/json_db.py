@@ -25,7 +25,7 @@
 import threading
 import copy
 import json
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Sequence, Tuple, Dict
 
 from . import util
 from .util import WalletFileException, profiler
@@ -86,14 +86,19 @@ def stored_in(name, _type=dict):
 class StoredObject:
 
     db = None
+    _db_path = None  # where we are stored in the db, if known
 
     def __setattr__(self, key, value):
         if self.db:
-            self.db.set_modified(True)
+            if self._db_path is not None:
+                self.db._mark_dirty(self._db_path)
+            else:
+                self.db.set_modified(True)
         object.__setattr__(self, key, value)
 
-    def set_db(self, db):
+    def set_db(self, db, path=None):
         self.db = db
+        object.__setattr__(self, '_db_path', path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -114,20 +119,28 @@ class StoredDict(dict):
         self.path = path
         # recursively convert dicts to StoredDict
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self._setitem(k, v)
 
     @locked
     def __setitem__(self, key, v):
         is_new = key not in self
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
+            if self.db and self[key] is v and isinstance(v, (list, set)):
+                # the caller mutated it in place and is putting it back
+                self.db._mark_dirty(self.path + [key])
             return
+        self._setitem(key, v)
+        if self.db:
+            self.db._mark_dirty(self.path + [key])
+
+    def _setitem(self, key, v):
         # recursively set db and path
         if isinstance(v, StoredDict):
             v.db = self.db
             v.path = self.path + [key]
             for k, vv in v.items():
-                v[k] = vv
+                v._setitem(k, vv)
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
@@ -141,17 +154,15 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
 
     @locked
     def __delitem__(self, key):
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db._mark_dirty(self.path + [key])
 
     @locked
     def pop(self, key, v=_RaiseKeyError):
@@ -160,9 +171,42 @@ class StoredDict(dict):
         else:
             r = dict.pop(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db._mark_dirty(self.path + [key])
         return r
 
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db._mark_dirty(self.path)
+
+    @locked
+    def mark_modified(self, key):
+        """To be called after the value at key was modified in place
+        (e.g. a list or set), so that the change gets written."""
+        if self.db:
+            self.db._mark_dirty(self.path + [key])
+
+
+def _json_key(key) -> str:
+    """Returns key as json.dumps writes it when it is a dict key."""
+    if isinstance(key, str):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, int):
+        return int.__repr__(key)
+    if isinstance(key, float):
+        return float.__repr__(key)
+    raise TypeError(f'cannot be a json key: {key!r}')
+
+
+_MISSING = object()
+
 
 
 
@@ -173,9 +217,16 @@ class JsonDB(Logger):
         self.lock = threading.RLock()
         self.storage = storage
         self._modified = False
+        # change log: paths of the values that changed since the last write.
+        # Until a subclass starts tracking changes, every write is a full one.
+        self._change_log_enabled = False
+        self._needs_full_write = True
+        self._dirty_paths = {}  # type: Dict[Tuple, None]  # used as an ordered set
         # load data
         if data:
             self.load_data(data)
+            if storage:
+                self._apply_changes(storage.read_changes())
         else:
             self.data = {}
 
@@ -190,6 +241,28 @@ class JsonDB(Logger):
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                # we do not know what changed
+                self._needs_full_write = True
+
+    def _mark_dirty(self, path: Sequence) -> None:
+        with self.lock:
+            self._modified = True
+            if not self._needs_full_write:
+                self._dirty_paths[tuple(path)] = None
+
+    def _start_tracking_changes(self, *, needs_full_write: bool) -> None:
+        """From now on, changes made through StoredDict and StoredObject
+        can be appended to the storage instead of rewriting it."""
+        with self.lock:
+            self._dirty_paths.clear()
+            self._needs_full_write = needs_full_write
+
+    def set_change_log_enabled(self, b: bool) -> None:
+        """If enabled, writes append the changes since the last write to the
+        storage, and only periodically compact it into a full snapshot."""
+        with self.lock:
+            self._change_log_enabled = b
 
     def modified(self):
         return self._modified
@@ -269,17 +342,90 @@ class JsonDB(Logger):
                 v = constructor(v)
         return v
 
-    def write(self):
+    def write(self, *, compact: bool = False):
+        """Saves the changes to storage. 'compact': always write a full snapshot."""
         with self.lock:
-            self._write()
+            self._write(compact=compact)
 
     @profiler
-    def _write(self):
+    def _write(self, *, compact: bool = False):
         if threading.current_thread().daemon:
             self.logger.warning('daemon thread cannot write db')
             return
+        if compact and self.storage.has_changes():
+            self.set_modified(True)
         if not self.modified():
             return
-        json_str = self.dump(human_readable=not self.storage.is_encrypted())
-        self.storage.write(json_str)
-        self.set_modified(False)
+        changes = None
+        if (self._change_log_enabled and not compact
+                and self.storage.file_exists() and not self.storage.needs_compaction()):
+            changes = self._get_changes()
+        if changes is None:
+            json_str = self.dump(human_readable=not self.storage.is_encrypted())
+            self.storage.write(json_str)
+        elif changes:
+            self.storage.append(json.dumps(changes, cls=JsonDBJsonEncoder))
+        self._dirty_paths.clear()
+        self._needs_full_write = False
+        self._modified = False
+
+    def _get_changes(self):
+        """Returns the changes since the last write, as a list of
+        {'op': 'set'|'del', 'path': [...], 'value': ...} items,
+        or None if a full snapshot has to be written instead."""
+        if self._needs_full_write or not self._dirty_paths:
+            # modified (e.g. by a @modifier) but not through StoredDict or
+            # StoredObject: we do not know what changed
+            return None
+        dirty = self._dirty_paths
+        changes = []
+        try:
+            for path in dirty:
+                if any(path[:i] in dirty for i in range(len(path))):
+                    continue  # a parent is written as a whole
+                if not path:
+                    return None
+                json_path = [_json_key(k) for k in path]
+                value = self._get_value_at_path(path)
+                if value is _MISSING:
+                    changes.append({'op': 'del', 'path': json_path})
+                else:
+                    changes.append({'op': 'set', 'path': json_path, 'value': value})
+        except TypeError:
+            return None
+        return changes
+
+    def _get_value_at_path(self, path: Sequence):
+        v = self.data
+        for k in path:
+            if not isinstance(v, dict) or k not in v:
+                return _MISSING
+            v = v[k]
+        return v
+
+    def _apply_changes(self, changes: Sequence[str]) -> None:
+        """Replays the change log of the storage over the snapshot we loaded."""
+        for s in changes:
+            try:
+                for change in json.loads(s):
+                    self._apply_change(change)
+            except WalletFileException:
+                raise
+            except Exception:
+                raise WalletFileException("Cannot read wallet file. (change log parsing failed)")
+
+    def _apply_change(self, change: dict) -> None:
+        *parent_path, key = change['path']
+        d = self.data
+        for k in parent_path:
+            d = d.get(k) if isinstance(d, dict) else None
+        if not isinstance(d, dict):
+            if change['op'] == 'del':
+                return
+            raise WalletFileException(f"Malformed wallet file (change log: no parent for {change['path']})")
+        if change['op'] == 'set':
+            d[key] = change['value']
+        elif change['op'] == 'del':
+            d.pop(key, None)
+        else:
+            raise WalletFileException(f"Malformed wallet file (change log: unknown op {change['op']!r})")
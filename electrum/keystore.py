@@ -31,7 +31,7 @@ from typing import Tuple, TYPE_CHECKING, Union, Sequence, Optional, Dict, List,
 from functools import lru_cache, wraps
 from abc import ABC, abstractmethod
 
-from . import bitcoin, ecc, constants, bip32
+from . import bitcoin, ecc, constants, bip32, util
 from .bitcoin import deserialize_privkey, serialize_privkey, BaseDecodeError
 from .transaction import Transaction, PartialTransaction, PartialTxInput, PartialTxOutput, TxInput
 from .bip32 import (convert_bip32_strpath_to_intpath, BIP32_PRIME,
@@ -223,7 +223,7 @@ class Software_KeyStore(KeyStore):
         decrypted = ec.decrypt_message(message)
         return decrypted
 
-    def sign_transaction(self, tx, password, wallet: 'Abstract_Wallet'):
+    def sign_transaction(self, tx, password, wallet: 'Abstract_Wallet', *, num_workers: int = 0):
         if self.is_watching_only():
             return
         # Raise if password is not correct.
@@ -234,7 +234,7 @@ class Software_KeyStore(KeyStore):
             keypairs[k] = self.get_private_key(v, password)
         # Sign
         if keypairs:
-            tx.sign(keypairs, wallet)
+            tx.sign(keypairs, wallet, num_workers=num_workers)
 
     @abstractmethod
     def update_password(self, old_password, new_password):
@@ -485,6 +485,15 @@ class MasterPublicKeyMixin(ABC):
         return der_suffix if only_der_suffix else full_path
 
 
+# below this many pubkeys per worker, starting the job costs more than deriving in-process
+MIN_PUBKEYS_PER_DERIVATION_WORKER = 250
+
+
+def _derive_pubkey_range(xpub: str, start: int, count: int, net) -> List[bytes]:
+    node = BIP32Node.from_xkey(xpub, net=net)
+    return bip32.CKD_pub_range(node.eckey.get_public_key_bytes(compressed=True), node.chaincode, start, count)
+
+
 class Xpub(MasterPublicKeyMixin):
 
     def __init__(self, *, derivation_prefix: str = None, root_fingerprint: str = None):
@@ -492,6 +501,7 @@ class Xpub(MasterPublicKeyMixin):
         self.xpub_receive = None
         self.xpub_change = None
         self._xpub_bip32_node = None  # type: Optional[BIP32Node]
+        self._derived_pubkeys = {}  # type: Dict[Tuple[int, int], bytes]  # (for_change, n) -> pubkey
 
         # "key origin" info (subclass should persist these):
         self._derivation_prefix = derivation_prefix  # type: Optional[str]
@@ -595,11 +605,7 @@ class Xpub(MasterPublicKeyMixin):
             self._derivation_prefix = derivation_prefix
         self.is_requesting_to_be_rewritten_to_wallet_file = True
 
-    @lru_cache(maxsize=None)
-    def derive_pubkey(self, for_change: int, n: int) -> bytes:
-        for_change = int(for_change)
-        if for_change not in (0, 1):
-            raise CannotDerivePubkey("forbidden path")
+    def _get_xpub_for_change(self, for_change: int) -> str:
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             rootnode = self.get_bip32_node_for_xpub()
@@ -608,7 +614,40 @@ class Xpub(MasterPublicKeyMixin):
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return xpub
+
+    def derive_pubkey(self, for_change: int, n: int) -> bytes:
+        for_change = int(for_change)
+        if for_change not in (0, 1):
+            raise CannotDerivePubkey("forbidden path")
+        pubkey = self._derived_pubkeys.get((for_change, n))
+        if pubkey is None:
+            pubkey = self.get_pubkey_from_xpub(self._get_xpub_for_change(for_change), (n,))
+            self._derived_pubkeys[(for_change, n)] = pubkey
+        return pubkey
+
+    def derive_pubkey_range(self, for_change: int, start: int, count: int, *, num_workers: int = 0) -> List[bytes]:
+        """Returns the pubkeys at indexes start..start+count-1, deriving the missing
+        ones from the parent node in one go, in num_workers processes if that many are
+        worth starting. Results are cached for derive_pubkey.
+        """
+        for_change = int(for_change)
+        if for_change not in (0, 1):
+            raise CannotDerivePubkey("forbidden path")
+        if any((for_change, n) not in self._derived_pubkeys for n in range(start, start + count)):
+            xpub = self._get_xpub_for_change(for_change)
+            num_workers = min(num_workers, count // MIN_PUBKEYS_PER_DERIVATION_WORKER)
+            if num_workers > 1:
+                part_size = -(-count // num_workers)
+                executor = util.get_worker_executor('pubkey_derivation', num_workers, processes=True)
+                jobs = [executor.submit(_derive_pubkey_range, xpub, i, min(part_size, start + count - i), constants.net)
+                        for i in range(start, start + count, part_size)]
+                pubkeys = [pubkey for job in jobs for pubkey in job.result()]
+            else:
+                pubkeys = _derive_pubkey_range(xpub, start, count, constants.net)
+            for n, pubkey in enumerate(pubkeys, start=start):
+                self._derived_pubkeys[(for_change, n)] = pubkey
+        return [self._derived_pubkeys[(for_change, n)] for n in range(start, start + count)]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence) -> bytes:
@@ -668,6 +668,13 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.oneserver = oneserver
         self.num_server = NUM_TARGET_CONNECTED_SERVERS if not oneserver else 0
 
+    def get_interfaces_for_header_download(self, *, min_tip: int, exclude: 'Interface' = None) -> List['Interface']:
+        """Returns the usable interfaces whose server claims to have at least min_tip,
+        to spread header chunk requests over."""
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        return [iface for iface in interfaces
+                if iface is not exclude and iface.is_connected_and_ready() and iface.tip >= min_tip]
+
     async def _switch_to_random_interface(self):
         '''Switch to a random connected server other than the current one'''
         servers = self.get_interfaces()    # Those in connected state
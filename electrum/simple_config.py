@@ -876,6 +876,10 @@ class SimpleConfig(Logger):
     NETWORK_SERVERFINGERPRINT = ConfigVar('serverfingerprint', default=None, type_=str)
     NETWORK_MAX_INCOMING_MSG_SIZE = ConfigVar('network_max_incoming_msg_size', default=1_000_000, type_=int)  # in bytes
     NETWORK_TIMEOUT = ConfigVar('network_timeout', default=None, type_=int)
+    NETWORK_HEADER_PIPELINE_DEPTH = ConfigVar('header_pipeline_depth', default=4, type_=int)  # chunk requests in flight
+    NETWORK_HEADER_PIPELINE_SPREAD = ConfigVar('header_pipeline_spread', default=False, type_=bool)
+    NETWORK_SUBSCRIBE_BATCH_SIZE = ConfigVar('subscribe_batch_size', default=100, type_=int)
+    NETWORK_MERKLE_BATCH_SIZE = ConfigVar('merkle_batch_size', default=100, type_=int)
 
     WALLET_BATCH_RBF = ConfigVar('batch_rbf', default=False, type_=bool)
     WALLET_SPEND_CONFIRMED_ONLY = ConfigVar('confirmed_only', default=False, type_=bool)
@@ -886,6 +890,10 @@ class SimpleConfig(Logger):
     WALLET_BOLT11_FALLBACK = ConfigVar('bolt11_fallback', default=True, type_=bool)
     WALLET_PAYREQ_EXPIRY_SECONDS = ConfigVar('request_expiry', default=invoices.PR_DEFAULT_EXPIRATION_WHEN_CREATING, type_=int)
     WALLET_USE_SINGLE_PASSWORD = ConfigVar('single_password', default=False, type_=bool)
+    WALLET_DB_CHANGE_LOG = ConfigVar('wallet_db_change_log', default=False, type_=bool)  # append changes to the wallet file
+    WALLET_SIGNING_WORKERS = ConfigVar('wallet_signing_workers', default=0, type_=int)  # threads signing tx inputs. experimental
+    WALLET_DERIVATION_WORKERS = ConfigVar('wallet_derivation_workers', default=0, type_=int)  # processes deriving new addresses
+    WALLET_PREVOUTS_INDEX_ALL_OUTPUTS = ConfigVar('wallet_prevouts_index_all_outputs', default=False, type_=bool)  # index foreign outputs of txs we did not fund
     # note: 'use_change' and 'multiple_change' are per-wallet settings
     WALLET_SEND_CHANGE_TO_LIGHTNING = ConfigVar('send_change_to_lightning', default=False, type_=bool)
 
@@ -974,6 +982,8 @@ class SimpleConfig(Logger):
     GUI_ENABLE_DEBUG_LOGS = ConfigVar('gui_enable_debug_logs', default=False, type_=bool)
     LOCALIZATION_LANGUAGE = ConfigVar('language', default="", type_=str)
     BLOCKCHAIN_PREFERRED_BLOCK = ConfigVar('blockchain_preferred_block', default=None)
+    BLOCKCHAIN_MMAP_HEADERS = ConfigVar('blockchain_mmap_headers', default=True, type_=bool)
+    BLOCKCHAIN_VERIFY_WORKERS = ConfigVar('blockchain_verify_workers', default=0, type_=int)  # 0: hash in-process
     SHOW_CRASH_REPORTER = ConfigVar('show_crash_reporter', default=True, type_=bool)
     DONT_SHOW_TESTNET_WARNING = ConfigVar('dont_show_testnet_warning', default=False, type_=bool)
     DONT_SHOW_INTERNET_WARNING = ConfigVar('dont_show_internet_warning', default=False, type_=bool)
@@ -1009,6 +1019,7 @@ class SimpleConfig(Logger):
     DOWNLOAD_IPFS = ConfigVar('download_ipfs_preview', default=False, type_=bool)
     MAX_IPFS_DOWNLOAD_SIZE = ConfigVar('download_ipfs_max_size', default=10_000_000, type_=int)
     MAX_IPFS_DOWNLOAD_WAIT = ConfigVar('download_ipfs_timeout_sec', default=60, type_=int)
+    MAX_IPFS_CACHE_SIZE = ConfigVar('download_ipfs_cache_max_size', default=500_000_000, type_=int)
     SHOW_IPFS = ConfigVar('show_ipfs_preview', default=False, type_=bool)
     SHOW_CREATE_ASSET_PAY_TO = ConfigVar('show_create_asset_pay_to', default=False, type_=bool)
     SHOW_REISSUABLE_WARNING = ConfigVar('show_reissuable_warning', default=True, type_=bool)
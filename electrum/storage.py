@@ -27,9 +27,10 @@ import threading
 import stat
 import hashlib
 import base64
+import json
 import zlib
 from enum import IntEnum
-from typing import Optional
+from typing import Optional, List
 
 from . import ecc
 from .util import (profiler, InvalidPassword, WalletFileException, bfh, standardize_path,
@@ -54,6 +55,12 @@ class StorageEncryptionVersion(IntEnum):
 class StorageReadWriteError(Exception): pass
 
 
+# Separates the records of the change log, that are appended to the wallet file
+# after the snapshot. It can neither appear in json (control characters are escaped
+# in strings), nor in base64 (encrypted storage).
+CHANGE_LOG_SEPARATOR = '\n\x1e'
+
+
 # TODO: Rename to Storage
 class WalletStorage(Logger):
 
@@ -68,24 +75,78 @@ class WalletStorage(Logger):
             test_read_write_permissions(self.path)
         except IOError as e:
             raise StorageReadWriteError(e) from e
+        # read as bytes: newlines must not be translated, as append()
+        # seeks to byte offsets of the file on disk (e.g. a CRLF snapshot)
+        if self.file_exists():
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        else:
+            raw = b''
+        self.raw = raw.decode('utf-8')
+        # the file is a snapshot, optionally followed by a change log
+        snapshot, *changes = raw.split(CHANGE_LOG_SEPARATOR.encode('utf-8'))
+        self._snapshot = snapshot.decode('utf-8')
+        self._changes = [c.decode('utf-8') for c in changes]
+        self._snapshot_size = len(snapshot)
+        self._changes_size = len(raw) - len(snapshot)
+        self._decrypted_changes = []  # type: List[str]
         if self.file_exists():
-            with open(self.path, "r", encoding='utf-8') as f:
-                self.raw = f.read()
             self._encryption_version = self._init_encryption_version()
         else:
-            self.raw = ''
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        if not self.is_encrypted() and self._changes:
+            try:
+                json.loads(self._changes[-1])
+            except ValueError:
+                self._drop_torn_change()
 
     def read(self):
-        return self.decrypted if self.is_encrypted() else self.raw
+        return self.decrypted if self.is_encrypted() else self._snapshot
+
+    def read_changes(self) -> List[str]:
+        """Returns the records of the change log, to be applied in order over
+        what read() returned."""
+        return self._decrypted_changes if self.is_encrypted() else self._changes
+
+    def has_changes(self) -> bool:
+        return bool(self._changes)
+
+    def needs_compaction(self) -> bool:
+        """Whether the change log got big enough to be folded into a new snapshot."""
+        return self._changes_size > self._snapshot_size // 2
+
+    def _drop_torn_change(self) -> None:
+        # the last record is incomplete: we crashed while appending it.
+        # It will be overwritten by the next append.
+        c = self._changes.pop()
+        self._changes_size -= len((CHANGE_LOG_SEPARATOR + c).encode('utf-8'))
+        self.logger.warning(f"ignoring incomplete last record of the change log of {self.path}")
+
+    def append(self, data: str) -> None:
+        """Appends a record to the change log. The record is encrypted
+        on its own, so it can be written without the snapshot."""
+        assert self.file_exists()
+        s = self.encrypt_before_writing(data)
+        b = (CHANGE_LOG_SEPARATOR + s).encode('utf-8')
+        with open(self.path, "r+b") as f:
+            f.truncate(self._snapshot_size + self._changes_size)
+            f.seek(0, os.SEEK_END)
+            f.write(b)
+            f.flush()
+            os.fsync(f.fileno())
+        self._changes.append(s)
+        if self.is_encrypted():
+            self._decrypted_changes.append(data)
+        self._changes_size += len(b)
 
     def write(self, data: str) -> None:
         s = self.encrypt_before_writing(data)
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        with open(temp_path, "w", encoding='utf-8') as f:
-            f.write(s)
+        with open(temp_path, "wb") as f:
+            f.write(s.encode('utf-8'))
             f.flush()
             os.fsync(f.fileno())
+            snapshot_size = os.fstat(f.fileno()).st_size
 
         try:
             mode = os.stat(self.path).st_mode
@@ -98,6 +159,10 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os_chmod(self.path, mode)
         self._file_exists = True
+        self._snapshot_size = snapshot_size
+        self._changes = []
+        self._decrypted_changes = []
+        self._changes_size = 0
         self.logger.info(f"saved {self.path}")
 
     def file_exists(self) -> bool:
@@ -135,7 +200,7 @@ class WalletStorage(Logger):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            magic = base64.b64decode(self._snapshot)[0:4]
             if magic == b'BIE1':
                 return StorageEncryptionVersion.USER_PASSWORD
             elif magic == b'BIE2':
@@ -167,14 +232,26 @@ class WalletStorage(Logger):
         if self.is_past_initial_decryption():
             return
         ec_key = self.get_eckey_from_password(password)
-        if self.raw:
-            enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-            s = s.decode('utf8')
+        if self._snapshot:
+            s = self._decrypt(ec_key, self._snapshot)
         else:
             s = ''
+        decrypted_changes = []
+        for i, c in enumerate(self._changes):
+            try:
+                decrypted_changes.append(self._decrypt(ec_key, c))
+            except Exception:
+                if i < len(self._changes) - 1:
+                    raise WalletFileException("Cannot read wallet file. (change log decryption failed)")
+                self._drop_torn_change()
         self.pubkey = ec_key.get_public_key_hex()
         self.decrypted = s
+        self._decrypted_changes = decrypted_changes
+
+    def _decrypt(self, ec_key, data: str) -> str:
+        enc_magic = self._get_encryption_magic()
+        s = zlib.decompress(ec_key.decrypt_message(data, enc_magic))
+        return s.decode('utf8')
 
     def encrypt_before_writing(self, plaintext: str) -> str:
         s = plaintext
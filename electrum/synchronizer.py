@@ -24,7 +24,7 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple, Set, Callable, Optional
+from typing import Dict, List, TYPE_CHECKING, Tuple, Set, Callable, Optional, Iterable
 from collections import defaultdict
 import logging
 
@@ -47,6 +47,14 @@ if TYPE_CHECKING:
 class SynchronizerFailure(Exception): pass
 
 
+def _check_address(addr: str) -> None:
+    if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
+
+
+def _check_asset_name(asset: str) -> None:
+    if error := get_error_for_asset_name(asset): raise ValueError(f'invalid asset: {error}')
+
+
 def history_status(h):
     if not h:
         return None
@@ -159,6 +167,9 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self.broadcast_status_queue = asyncio.Queue()
         self.qualifier_association_status_queue = asyncio.Queue()
 
+        # set when there might be new work for the main loop, or the up-to-date state might have changed
+        self._main_loop_wakeup = asyncio.Event()
+
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
         try:
@@ -183,47 +194,78 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             self.session.unsubscribe(self.broadcast_status_queue)
             self.session.unsubscribe(self.qualifier_association_status_queue)
 
+    def wake_up(self) -> None:
+        """Makes the main loop look for new work and re-check whether we are up to date.
+        Can be called from any thread.
+        """
+        self.asyncio_loop.call_soon_threadsafe(self._main_loop_wakeup.set)
+
+    async def _spawn(self, func, *args):
+        """Spawns func(*args) in our taskgroup, and wakes up the main loop once it is done."""
+        async def wrapper():
+            try:
+                return await func(*args)
+            finally:
+                self._main_loop_wakeup.set()
+        return await self.taskgroup.spawn(wrapper())
+
     def add(self, addr):
         if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
         self._adding_addrs.add(addr)  # this lets is_up_to_date already know about addr
+        self.wake_up()
+
+    def add_addresses(self, addrs: Iterable[str]):
+        """Like add, for many addresses."""
+        addrs = list(addrs)
+        for addr in addrs:
+            _check_address(addr)
+        self._adding_addrs.update(addrs)
+        self.wake_up()
 
     def add_asset(self, asset):
         if error := get_error_for_asset_name(asset): raise ValueError(f'invalid asset: {error}')
         self._adding_assets.add(asset)
+        self.wake_up()
 
     def add_qualifier_for_tag(self, asset):
         if get_error_for_asset_typed(asset, AssetType.QUALIFIER) and \
             get_error_for_asset_typed(asset, AssetType.SUB_QUALIFIER) and \
             get_error_for_asset_typed(asset, AssetType.RESTRICTED): raise ValueError(f'invalid asset')
         self._adding_qualifiers_for_tags.add(asset)
+        self.wake_up()
 
     def add_h160_for_tag(self, h160: str):
         if len(h160) != 40: raise ValueError(f'{h160} is not a valid h160 hex string')
         self._adding_h160s_for_tags.add(h160)
+        self.wake_up()
 
     def add_restricted_for_verifier(self, asset: str):
         if error := get_error_for_asset_typed(asset, AssetType.RESTRICTED): raise ValueError(f'invalid asset: {error}')
         self._adding_restricted_for_verifier.add(asset)
+        self.wake_up()
 
     def add_restricted_for_freeze(self, asset: str):
         if error := get_error_for_asset_typed(asset, AssetType.RESTRICTED): raise ValueError(f'invalid asset: {error}')
         self._adding_restricted_for_freeze.add(asset)
+        self.wake_up()
 
     def add_broadcast(self, asset: str):
         if error := get_error_for_asset_name(asset): raise ValueError(f'invalid asset: {error}')
         self._adding_broadcasts.add(asset)
+        self.wake_up()
 
     def add_associations_for_qualifier(self, asset: str):
         if (error := get_error_for_asset_typed(asset, AssetType.QUALIFIER)) and \
             (error := get_error_for_asset_typed(AssetType.SUB_QUALIFIER)): raise ValueError(f'invalid asset: {error}')
         self._adding_qualifier_associations.add(asset)
+        self.wake_up()
 
     async def _add_address(self, addr: str):
         try:
             if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
             if addr in self.requested_addrs: return
             self.requested_addrs.add(addr)
-            await self.taskgroup.spawn(self._subscribe_to_address, addr)
+            await self._spawn(self._subscribe_to_address, addr)
         finally:
             self._adding_addrs.discard(addr)  # ok for addr not to be present
 
@@ -232,7 +274,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             if error := get_error_for_asset_name(asset): raise ValueError(f'invalid asset: {error}')
             if asset in self.requested_assets: return
             self.requested_assets.add(asset)
-            await self.taskgroup.spawn(self._subscribe_to_asset, asset)
+            await self._spawn(self._subscribe_to_asset, asset)
         finally:
             self._adding_assets.discard(asset)
 
@@ -240,7 +282,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         try:
             if asset in self.requested_qualifiers_for_tags: return
             self.requested_qualifiers_for_tags.add(asset)
-            await self.taskgroup.spawn(self._subscribe_to_qualifier_for_tags, asset)
+            await self._spawn(self._subscribe_to_qualifier_for_tags, asset)
         finally:
             self._adding_qualifiers_for_tags.discard(asset)
 
@@ -248,7 +290,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         try:
             if h160 in self.requested_h160s_for_tags: return
             self.requested_h160s_for_tags.add(h160)
-            await self.taskgroup.spawn(self._subscribe_to_h160_for_tags, h160)
+            await self._spawn(self._subscribe_to_h160_for_tags, h160)
         finally:
             self._adding_h160s_for_tags.discard(h160)
 
@@ -256,7 +298,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         try:
             if asset in self.requested_restricted_for_verifier: return
             self.requested_restricted_for_verifier.add(asset)
-            await self.taskgroup.spawn(self._subscribe_to_restricted_for_verifier, asset)
+            await self._spawn(self._subscribe_to_restricted_for_verifier, asset)
         finally:
             self._adding_restricted_for_verifier.discard(asset)
 
@@ -264,7 +306,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         try:
             if asset in self.requested_restricted_for_freeze: return
             self.requested_restricted_for_freeze.add(asset)
-            await self.taskgroup.spawn(self._subscribe_to_restricted_for_freeze, asset)
+            await self._spawn(self._subscribe_to_restricted_for_freeze, asset)
         finally:
             self._adding_restricted_for_freeze.discard(asset)
 
@@ -272,7 +314,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         try:
             if asset in self.requested_broadcasts: return
             self.requested_broadcasts.add(asset)
-            await self.taskgroup.spawn(self._subscribe_to_broadcast, asset)
+            await self._spawn(self._subscribe_to_broadcast, asset)
         finally:
             self._adding_broadcasts.discard(asset)
 
@@ -280,10 +322,60 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         try:
             if asset in self.requested_qualifier_associations: return
             self.requested_qualifier_associations.add(asset)
-            await self.taskgroup.spawn(self._subscribe_to_qualifier_associations, asset)
+            await self._spawn(self._subscribe_to_qualifier_associations, asset)
         finally:
             self._adding_qualifier_associations.discard(asset)
 
+    async def _add_batch(self, items, *, requested: Set[str], adding: Set[str], subscribe,
+                         check: Optional[Callable[[str], None]] = None):
+        """Like the _add_* methods above, for many items at once: the new ones
+        are subscribed to in batches of the configured size.
+        """
+        items = list(items)
+        try:
+            if check is not None:
+                for item in items:
+                    check(item)
+            new_items = [item for item in dict.fromkeys(items) if item not in requested]
+            requested.update(new_items)
+            batch_size = max(1, self.network.config.NETWORK_SUBSCRIBE_BATCH_SIZE)
+            for i in range(0, len(new_items), batch_size):
+                await self._spawn(subscribe, new_items[i:i + batch_size])
+        finally:
+            adding.difference_update(items)
+
+    async def _add_addresses(self, addrs):
+        await self._add_batch(addrs, requested=self.requested_addrs, adding=self._adding_addrs,
+                              subscribe=self._subscribe_to_addresses, check=_check_address)
+
+    async def _add_assets(self, assets):
+        await self._add_batch(assets, requested=self.requested_assets, adding=self._adding_assets,
+                              subscribe=self._subscribe_to_assets, check=_check_asset_name)
+
+    async def _add_qualifiers_for_tags(self, assets):
+        await self._add_batch(assets, requested=self.requested_qualifiers_for_tags, adding=self._adding_qualifiers_for_tags,
+                              subscribe=self._subscribe_to_qualifiers_for_tags)
+
+    async def _add_h160s_for_tags(self, h160s):
+        await self._add_batch(h160s, requested=self.requested_h160s_for_tags, adding=self._adding_h160s_for_tags,
+                              subscribe=self._subscribe_to_h160s_for_tags)
+
+    async def _add_restricted_assets_for_verifier(self, assets):
+        await self._add_batch(assets, requested=self.requested_restricted_for_verifier, adding=self._adding_restricted_for_verifier,
+                              subscribe=self._subscribe_to_restricted_assets_for_verifier)
+
+    async def _add_restricted_assets_for_freeze(self, assets):
+        await self._add_batch(assets, requested=self.requested_restricted_for_freeze, adding=self._adding_restricted_for_freeze,
+                              subscribe=self._subscribe_to_restricted_assets_for_freeze)
+
+    async def _add_broadcasts(self, assets):
+        await self._add_batch(assets, requested=self.requested_broadcasts, adding=self._adding_broadcasts,
+                              subscribe=self._subscribe_to_broadcasts)
+
+    async def _add_associations_for_qualifiers(self, assets):
+        await self._add_batch(assets, requested=self.requested_qualifier_associations, adding=self._adding_qualifier_associations,
+                              subscribe=self._subscribe_to_qualifiers_associations)
+
     async def _on_address_status(self, addr, status):
         """Handle the change of the status of an address.
         Should remove addr from self._handling_addr_statuses when done.
@@ -366,13 +458,53 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             await self.session.subscribe('blockchain.asset.restricted_associations.subscribe', [asset], self.qualifier_association_status_queue)
         self._requests_answered += 1
 
+    async def _subscribe_batch(self, method: str, items: List[str], queue: asyncio.Queue):
+        self._requests_sent += len(items)
+        async with self._network_request_semaphore:
+            await self.session.subscribe_batch(method, [[item] for item in items], queue)
+        self._requests_answered += len(items)
+
+    async def _subscribe_to_addresses(self, addrs):
+        hashes = []
+        for addr in addrs:
+            h = address_to_scripthash(addr)
+            self.scripthash_to_address[h] = addr
+            hashes.append(h)
+        try:
+            await self._subscribe_batch('blockchain.scripthash.subscribe', hashes, self.status_queue)
+        except RPCError as e:
+            if e.message == 'history too large':  # no unique error code
+                raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+            raise
+
+    async def _subscribe_to_assets(self, assets):
+        await self._subscribe_batch('blockchain.asset.subscribe', assets, self.asset_status_queue)
+
+    async def _subscribe_to_qualifiers_for_tags(self, assets):
+        await self._subscribe_batch('blockchain.tag.qualifier.subscribe', assets, self.qualifier_tags_status_queue)
+
+    async def _subscribe_to_h160s_for_tags(self, h160s):
+        await self._subscribe_batch('blockchain.tag.h160.subscribe', h160s, self.h160_tags_status_queue)
+
+    async def _subscribe_to_restricted_assets_for_verifier(self, assets):
+        await self._subscribe_batch('blockchain.asset.verifier_string.subscribe', assets, self.restricted_verifier_queue)
+
+    async def _subscribe_to_restricted_assets_for_freeze(self, assets):
+        await self._subscribe_batch('blockchain.asset.is_frozen.subscribe', assets, self.restricted_freeze_queue)
+
+    async def _subscribe_to_broadcasts(self, assets):
+        await self._subscribe_batch('blockchain.asset.broadcasts.subscribe', assets, self.broadcast_status_queue)
+
+    async def _subscribe_to_qualifiers_associations(self, assets):
+        await self._subscribe_batch('blockchain.asset.restricted_associations.subscribe', assets, self.qualifier_association_status_queue)
+
     async def handle_status(self):
         while True:
             h, status = await self.status_queue.get()
             addr = self.scripthash_to_address[h]
             self._handling_addr_statuses.add(addr)
             self.requested_addrs.discard(addr)  # ok for addr not to be present
-            await self.taskgroup.spawn(self._on_address_status, addr, status)
+            await self._spawn(self._on_address_status, addr, status)
             self._processed_some_notifications = True
 
     async def handle_asset_status(self):
@@ -380,7 +512,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.asset_status_queue.get()
             self._handling_asset_statuses.add(asset)
             self.requested_assets.discard(asset)
-            await self.taskgroup.spawn(self._on_asset_status, asset, status)
+            await self._spawn(self._on_asset_status, asset, status)
             self._processed_some_asset_notifications = True
 
     async def handle_qualifier_for_tags_status(self):
@@ -388,7 +520,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.qualifier_tags_status_queue.get()
             self._handling_qualifiers_for_tags_statuses.add(asset)
             self.requested_qualifiers_for_tags.discard(asset)
-            await self.taskgroup.spawn(self._on_qualifier_for_tags_status, asset, status)
+            await self._spawn(self._on_qualifier_for_tags_status, asset, status)
             self._processed_some_qualifier_for_tags_notifications = True
 
     async def handle_h160_for_tags_status(self):
@@ -396,7 +528,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             h160, status = await self.h160_tags_status_queue.get()
             self._handling_h160s_for_tags_statuses.add(h160)
             self.requested_h160s_for_tags.discard(h160)
-            await self.taskgroup.spawn(self._on_h160_for_tags_status, h160, status)
+            await self._spawn(self._on_h160_for_tags_status, h160, status)
             self._processed_some_h160_for_tags_notifications = True
 
     async def handle_restricted_for_verifier_update(self):
@@ -404,7 +536,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, data = await self.restricted_verifier_queue.get()
             self._handling_restricted_for_verifier.add(asset)
             self.requested_restricted_for_verifier.discard(asset)
-            await self.taskgroup.spawn(self._on_restricted_for_verifier_update, asset, data)
+            await self._spawn(self._on_restricted_for_verifier_update, asset, data)
             self._processed_some_restricted_for_verifier = True
 
     async def handle_restricted_for_freeze_update(self):
@@ -412,7 +544,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, data = await self.restricted_freeze_queue.get()
             self._handling_restricted_for_freeze.add(asset)
             self.requested_restricted_for_freeze.discard(asset)
-            await self.taskgroup.spawn(self._on_restricted_for_freeze_update, asset, data)
+            await self._spawn(self._on_restricted_for_freeze_update, asset, data)
             self._processed_some_restricted_for_freeze = True
 
     async def handle_broadcast_status(self):
@@ -420,7 +552,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.broadcast_status_queue.get()
             self._handling_broadcast_statuses.add(asset)
             self.requested_broadcasts.discard(asset)
-            await self.taskgroup.spawn(self._on_broadcast_status, asset, status)
+            await self._spawn(self._on_broadcast_status, asset, status)
             self._processed_some_broadcasts = True
 
     async def handle_qualifier_associations_status(self):
@@ -428,7 +560,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             asset, status = await self.qualifier_association_status_queue.get()
             self._handling_qualifier_association_statuses.add(asset)
             self.requested_qualifier_associations.discard(asset)
-            await self.taskgroup.spawn(self._on_qualifier_associations_status, asset, status)
+            await self._spawn(self._on_qualifier_associations_status, asset, status)
             self._processed_some_qualifier_associations = True
 
     async def main(self):
@@ -887,59 +1019,63 @@ class Synchronizer(SynchronizerBase):
             if history == ['*']: continue
             await self._request_missing_txs(history, allow_server_not_finding_tx=True)
         # add addresses to bootstrap
-        for addr in random_shuffled_copy(self.adb.get_addresses()):
-            await self._add_address(addr)
+        addrs = random_shuffled_copy(self.adb.get_addresses())
+        h160s = []
+        for addr in addrs:
             if is_b58_address(addr):
                 addr_type, h160 = b58_address_to_hash160(addr)
                 if addr_type == constants.net.ADDRTYPE_P2PKH:
                     h160_h = h160.hex()
                     if h160_h not in self.adb.db.verified_tags_for_h160s:
                         self.adb.db.verified_tags_for_h160s[h160_h] = dict()
-                    await self._add_h160_for_tags(h160_h)
+                    h160s.append(h160_h)
+        await self._add_addresses(addrs)
+        await self._add_h160s_for_tags(h160s)
+        assets = []
+        qualifiers_for_tags = []
+        restricted_for_verifier = []
+        restricted_for_freeze = []
+        associations_for_qualifiers = []
         for asset in random_shuffled_copy(self.adb.get_assets_to_watch()):
-            await self._add_asset(asset)
+            assets.append(asset)
             if asset[-1] == '!':
                 # Watch normal asset
-                await self._add_asset(asset[:-1])
+                assets.append(asset[:-1])
                 if get_error_for_asset_typed(asset[:-1], AssetType.ROOT) is None:
                     # Watch for restricted of this asset
                     restricted_asset = f'${asset[:-1]}'
-                    await self._add_asset(restricted_asset)
-                    await self._add_qualifier_for_tags(restricted_asset)
-                    await self._add_restricted_for_verifier(restricted_asset)
-                    await self._add_restricted_for_freeze(restricted_asset)
+                    assets.append(restricted_asset)
+                    qualifiers_for_tags.append(restricted_asset)
+                    restricted_for_verifier.append(restricted_asset)
+                    restricted_for_freeze.append(restricted_asset)
             if asset[0] == '#':
-                await self._add_qualifier_for_tags(asset)
-                await self._add_associations_for_qualifier(asset)
+                qualifiers_for_tags.append(asset)
+                associations_for_qualifiers.append(asset)
             if asset[0] == '$':
-                await self._add_qualifier_for_tags(asset)
-                await self._add_restricted_for_verifier(asset)
-                await self._add_restricted_for_freeze(asset)
-
-        for asset in random_shuffled_copy(self.adb.get_broadcasts_to_watch()):
-            await self._add_broadcast(asset)
+                qualifiers_for_tags.append(asset)
+                restricted_for_verifier.append(asset)
+                restricted_for_freeze.append(asset)
+        await self._add_assets(assets)
+        await self._add_qualifiers_for_tags(qualifiers_for_tags)
+        await self._add_restricted_assets_for_verifier(restricted_for_verifier)
+        await self._add_restricted_assets_for_freeze(restricted_for_freeze)
+        await self._add_associations_for_qualifiers(associations_for_qualifiers)
+        await self._add_broadcasts(random_shuffled_copy(self.adb.get_broadcasts_to_watch()))
 
         # main loop
         self._init_done = True
         prev_uptodate = False
         while True:
-            await asyncio.sleep(0.1)
-            for addr in self._adding_addrs.copy(): # copy set to ensure iterator stability
-                await self._add_address(addr)
-            for asset in self._adding_assets.copy():
-                await self._add_asset(asset)
-            for asset in self._adding_qualifiers_for_tags.copy():
-                await self._add_qualifier_for_tags(asset)
-            for h160 in self._adding_h160s_for_tags.copy():
-                await self._add_h160_for_tags(h160)
-            for asset in self._adding_restricted_for_verifier.copy():
-                await self._add_restricted_for_verifier(asset)
-            for asset in self._adding_restricted_for_freeze.copy():
-                await self._add_restricted_for_freeze(asset)
-            for asset in self._adding_broadcasts.copy():
-                await self._add_broadcast(asset)
-            for asset in self._adding_qualifier_associations.copy():
-                await self._add_associations_for_qualifier(asset)
+            self._main_loop_wakeup.clear()
+            # copy sets to ensure iterator stability
+            await self._add_addresses(self._adding_addrs.copy())
+            await self._add_assets(self._adding_assets.copy())
+            await self._add_qualifiers_for_tags(self._adding_qualifiers_for_tags.copy())
+            await self._add_h160s_for_tags(self._adding_h160s_for_tags.copy())
+            await self._add_restricted_assets_for_verifier(self._adding_restricted_for_verifier.copy())
+            await self._add_restricted_assets_for_freeze(self._adding_restricted_for_freeze.copy())
+            await self._add_broadcasts(self._adding_broadcasts.copy())
+            await self._add_associations_for_qualifiers(self._adding_qualifier_associations.copy())
             up_to_date = self.adb.is_up_to_date()
             # see if status changed
             if (up_to_date != prev_uptodate
@@ -957,6 +1093,10 @@ class Synchronizer(SynchronizerBase):
                 self._processed_some_qualifier_associations = False
                 self.adb.up_to_date_changed()
             prev_uptodate = up_to_date
+            # sleep until something happens. the short sleep after waking up
+            # coalesces the many wakeups of a busy sync, as the previous polling did
+            await self._main_loop_wakeup.wait()
+            await asyncio.sleep(0.1)
 
 
 class Notifier(SynchronizerBase):
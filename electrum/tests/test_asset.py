@@ -0,0 +1,93 @@
+from electrum import asset
+from electrum.asset import (get_asset_info_from_script, generate_create_script, generate_reissue_script,
+                            generate_owner_script_from_base, generate_transfer_script_from_base,
+                            generate_verifier_tag, generate_null_tag, generate_freeze_tag, AssetMemo,
+                            AssetVoutType)
+
+from . import ElectrumTestCase
+
+
+P2PKH = '76a914' + '11' * 20 + '88ac'
+IPFS = bytes.fromhex('1220') + bytes(range(32))
+
+
+class TestGetAssetInfoFromScript(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        asset._get_asset_info_from_script.cache_clear()
+
+    def info(self, script_hex: str):
+        return get_asset_info_from_script(bytes.fromhex(script_hex))
+
+    def test_transfer(self):
+        info = self.info(generate_transfer_script_from_base('ABC', 10**8, P2PKH))
+        self.assertEqual(AssetVoutType.TRANSFER, info.get_type())
+        self.assertEqual(('ABC', 10**8, None, None), (info.asset, info.amount, info.asset_memo, info.asset_memo_timestamp))
+        self.assertTrue(info.well_formed_script)
+        self.assertTrue(info.is_deterministic())
+
+        info = self.info(generate_transfer_script_from_base('ABC', 1, P2PKH, memo=AssetMemo(IPFS, 1234)))
+        self.assertEqual((IPFS, 1234), (info.asset_memo, info.asset_memo_timestamp))
+        self.assertIs(bytes, type(info.asset_memo))
+
+    def test_create_reissue_owner(self):
+        address = 'RAqS1bAuWqW2f6ufsU5H4XpKfy5Pqj2oHz'
+        info = self.info(generate_create_script(address, 'ABC', 10**8, 2, True, IPFS))
+        self.assertEqual(AssetVoutType.CREATE, info.get_type())
+        self.assertEqual(('ABC', 10**8, 2, True, IPFS),
+                         (info.asset, info.amount, info.divisions, info.reissuable, info.associated_data))
+        info = self.info(generate_create_script(address, 'ABC', 10**8, 0, False, None))
+        self.assertEqual((0, False, None), (info.divisions, info.reissuable, info.associated_data))
+
+        info = self.info(generate_reissue_script(address, 'ABC', 5, 0xff, False, IPFS))
+        self.assertEqual(AssetVoutType.REISSUE, info.get_type())
+        self.assertEqual(('ABC', 5, 0xff, IPFS), (info.asset, info.amount, info.divisions, info.associated_data))
+
+        info = self.info(generate_owner_script_from_base('ABC', P2PKH))
+        self.assertEqual(AssetVoutType.OWNER, info.get_type())
+        self.assertEqual('ABC!', info.asset)
+
+    def test_tags(self):
+        info = self.info(generate_verifier_tag('#KYC&!#BAD'))
+        self.assertEqual(AssetVoutType.VERIFIER, info.get_type())
+        self.assertEqual('#KYC&!#BAD', info.verifier_string)
+
+        info = self.info(generate_null_tag('#KYC', '22' * 20, True))
+        self.assertEqual(AssetVoutType.NULL, info.get_type())
+        self.assertEqual(('#KYC', '22' * 20, True), (info.asset, info.h160, info.flag))
+
+        info = self.info(generate_freeze_tag('$TOKEN', False))
+        self.assertEqual(AssetVoutType.FREEZE, info.get_type())
+        self.assertEqual(('$TOKEN', False), (info.asset, info.flag))
+
+    def test_no_asset(self):
+        self.assertEqual(AssetVoutType.NONE, self.info(P2PKH).get_type())
+        self.assertEqual(AssetVoutType.NONE, self.info('').get_type())
+        # OP_ASSET with no asset data after it
+        self.assertEqual(AssetVoutType.NONE, self.info(P2PKH + 'c0').get_type())
+        self.assertEqual(AssetVoutType.NONE, self.info(P2PKH + 'c00675').get_type())
+        # truncated asset data
+        script = generate_transfer_script_from_base('ABC', 10**8, P2PKH)
+        self.assertEqual(AssetVoutType.NONE, self.info(script[:-20]).get_type())
+
+    def test_malformed(self):
+        self.assertIsNone(self.info(P2PKH + '4d01'))
+        self.assertIsNone(self.info(generate_transfer_script_from_base('ABC', 1, P2PKH) + '4c'))
+
+    def test_not_well_formed(self):
+        script = generate_transfer_script_from_base('ABC', 10**8, P2PKH)
+        # trailing data after OP_DROP
+        info = self.info(script + '51')
+        self.assertEqual(('ABC', 10**8), (info.asset, info.amount))
+        self.assertFalse(info.well_formed_script)
+        # non-minimal push of the asset data
+        asset_data = script[len(P2PKH) + 4:-2]
+        info = self.info(P2PKH + 'c04c' + script[len(P2PKH) + 2:len(P2PKH) + 4] + asset_data + '75')
+        self.assertEqual(('ABC', 10**8), (info.asset, info.amount))
+        self.assertFalse(info.well_formed_script)
+
+    def test_cached(self):
+        script = bytes.fromhex(generate_transfer_script_from_base('ABC', 10**8, P2PKH))
+        info = get_asset_info_from_script(script)
+        self.assertIs(info, get_asset_info_from_script(bytearray(script)))
@@ -10,7 +10,7 @@ from electrum.bitcoin import (public_key_to_p2pkh, address_from_private_key,
                               is_compressed_privkey, EncodeBase58Check, DecodeBase58Check,
                               script_num_to_hex, push_script, add_number_to_script, int_to_hex,
                               opcodes, base_encode, base_decode, BitcoinException)
-from electrum import bip32
+from electrum import bip32, keystore
 from electrum import segwit_addr
 from electrum.segwit_addr import DecodedBech32
 from electrum.bip32 import (BIP32Node, convert_bip32_intpath_to_strpath,
@@ -815,6 +815,26 @@ class Test_xprv_xpub(ElectrumTestCase):
         self.assertFalse(is_xprv('xprv1nval1d'))
         self.assertFalse(is_xprv('xprv661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52WRONGBADWRONG'))
 
+    def test_ckd_pub_range(self):
+        node = BIP32Node.from_xkey("xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy")
+        pubkeys = bip32.CKD_pub_range(node.eckey.get_public_key_bytes(compressed=True), node.chaincode, 17, 5)
+        self.assertEqual([node.subkey_at_public_derivation([i]).eckey.get_public_key_bytes(compressed=True)
+                          for i in range(17, 22)],
+                         pubkeys)
+        self.assertEqual([], bip32.CKD_pub_range(node.eckey.get_public_key_bytes(compressed=True), node.chaincode, 0, 0))
+        with self.assertRaisesRegex(Exception, 'hardened'):
+            bip32.CKD_pub_range(node.eckey.get_public_key_bytes(compressed=True), node.chaincode, bip32.BIP32_PRIME - 1, 2)
+
+    def test_keystore_derive_pubkey_range(self):
+        xpub = "xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy"
+        ks1 = keystore.from_master_key(xpub)
+        ks2 = keystore.from_master_key(xpub)
+        for for_change in (0, 1):
+            pubkeys = ks1.derive_pubkey_range(for_change, 3, 10)
+            self.assertEqual([ks2.derive_pubkey(for_change, i) for i in range(3, 13)], pubkeys)
+            # results are cached for derive_pubkey
+            self.assertEqual(pubkeys[4], ks1.derive_pubkey(for_change, 7))
+
     def test_bip32_from_xkey(self):
         bip32node1 = BIP32Node.from_xkey("xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy")
         self.assertEqual(
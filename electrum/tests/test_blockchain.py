@@ -1,10 +1,13 @@
+import concurrent.futures
+import random
 import shutil
 import tempfile
 import os
 
 from electrum import constants, blockchain
 from electrum.simple_config import SimpleConfig
-from electrum.blockchain import Blockchain, deserialize_header, hash_header, InvalidHeader
+from electrum.blockchain import (Blockchain, deserialize_header, serialize_header, hash_header, InvalidHeader,
+                                 HEADER_SIZE, LEGACY_HEADER_SIZE)
 from electrum.util import bfh, make_dir
 
 from . import ElectrumTestCase
@@ -458,3 +461,262 @@ class TestVerifyHeader(ElectrumTestCase):
         with self.assertRaises(InvalidHeader):
             self.header["nonce"] = 42
             Blockchain.verify_header(self.header, self.prev_hash, self.target)
+
+
+class TestDGWWindow(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.chain = Blockchain(config=config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+    def _make_headers(self, start_height: int, count: int) -> dict:
+        # bits follow the targets of the checkpointed range, timestamps are noisy
+        # (including going backwards) so that the timespan clamping gets exercised
+        rand = random.Random(start_height)
+        targets = [target for cp in constants.net.DGW_CHECKPOINTS for __, target in cp]
+        headers = {}
+        timestamp = constants.net.KawpowActivationTS
+        for i in range(count):
+            timestamp += rand.choice((rand.randint(-120, 180), rand.randint(0, 60), rand.randint(300, 900)))
+            height = start_height + i
+            headers[height] = {
+                'block_height': height,
+                'timestamp': timestamp,
+                'bits': Blockchain.target_to_bits(targets[(i // 7) % len(targets)]),
+            }
+        return headers
+
+    def test_targets_match_full_recomputation(self):
+        start_height = constants.net.max_checkpoint() + 1
+        headers = self._make_headers(start_height, 3 * 2016)
+        window = blockchain.DGWWindow()
+        num_compared = 0
+        for height in sorted(headers):
+            target = window.get_target(height)
+            if height - start_height < blockchain.DGWWindow.SIZE:
+                self.assertIsNone(target)
+            else:
+                self.assertEqual(self.chain.get_target_dgwv3(height, headers), target)
+                num_compared += 1
+            window.push(height, headers[height], None)
+        self.assertEqual(3 * 2016 - blockchain.DGWWindow.SIZE, num_compared)
+
+    def test_window_resets_on_gap(self):
+        start_height = constants.net.max_checkpoint() + 1
+        headers = self._make_headers(start_height, 200)
+        window = blockchain.DGWWindow()
+        for height in range(start_height, start_height + 190):
+            window.push(height, headers[height], None)
+        self.assertIsNotNone(window.get_target(start_height + 190))
+        self.assertIsNone(window.get_target(start_height + 191))
+        window.push(start_height + 195, headers[start_height + 195], None)
+        self.assertIsNone(window.get_target(start_height + 196))
+
+
+def make_kawpow_chunk(start_height: int, count: int) -> bytes:
+    """Returns a chunk of synthetic kawpow headers (their PoW is not valid)."""
+    rand = random.Random(start_height)
+    chunk = b''
+    for i in range(count):
+        height = start_height + i
+        chunk += (0x30000000).to_bytes(4, 'little') \
+            + rand.randbytes(64) \
+            + (constants.net.KawpowActivationTS + 60 * i).to_bytes(4, 'little') \
+            + (0x1b01a3c4).to_bytes(4, 'little') \
+            + height.to_bytes(4, 'little') \
+            + rand.randbytes(8 + 32)
+    return chunk
+
+
+class TestChunkPowHashes(ElectrumTestCase):
+
+    async def test_pool_hashes_match_hash_header(self):
+        start_height = constants.net.max_checkpoint() + 1
+        chunk = make_kawpow_chunk(start_height, 25)
+        expected = [hash_header(deserialize_header(raw, height))
+                    for height, raw in blockchain.iter_chunk_headers(start_height, chunk)]
+        self.assertEqual(25, len(expected))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            hashes = await blockchain.compute_chunk_pow_hashes(
+                start_height, chunk, executor=executor, num_parts=4)
+        self.assertEqual(expected, hashes)
+
+
+class TestHeader(ElectrumTestCase):
+
+    # synthetic kawpow header (its PoW is not valid)
+    KAWPOW_HEADER = bytes.fromhex(
+        "00000030"
+        "8d2dc1a0cc70e5fb7b2eee6e3b13a5c4c5f63be56ef8f8a0f6f19b3c00000000"
+        "5d0dd4b4d30b5c6eb3b71a7b0cdb44a1ed38f22d4ee5cbd43d3b49d29e80b2dc"
+        "40fbb25e"
+        "ffff001d"
+        "989c1200"
+        "3ae4ddbd2c41ab2e"
+        "1a4b8e0b21bdbc4b02d36b47dd4d5fd6ae58c5de5bc4a09e70e5b5dc5c02f5ac")
+
+    def test_fields(self):
+        header = deserialize_header(self.KAWPOW_HEADER, 1219736)
+        self.assertTrue(header.is_kawpow())
+        self.assertEqual(0x30000000, header['version'])
+        self.assertEqual(0x1d00ffff, header['bits'])
+        self.assertEqual(1219736, header['nheight'])
+        self.assertEqual(1219736, header.get('block_height'))
+        self.assertEqual(self.KAWPOW_HEADER[4:36][::-1].hex(), header['prev_block_hash'])
+        self.assertEqual(self.KAWPOW_HEADER[88:120][::-1].hex(), header['mix_hash'])
+        self.assertEqual(int.from_bytes(self.KAWPOW_HEADER[80:88], 'little'), header['nonce'])
+        self.assertEqual(
+            ['version', 'prev_block_hash', 'merkle_root', 'timestamp', 'bits', 'nheight', 'nonce', 'mix_hash', 'block_height'],
+            list(header))
+        with self.assertRaises(KeyError):
+            header['foo']
+
+        legacy = deserialize_header(self.KAWPOW_HEADER[:68] + bytes(4) + self.KAWPOW_HEADER[72:80], 5)
+        self.assertFalse(legacy.is_kawpow())
+        self.assertNotIn('mix_hash', legacy)
+        self.assertEqual(0x00129c98, legacy['nonce'])
+        self.assertEqual(LEGACY_HEADER_SIZE, len(legacy.raw))
+        self.assertEqual(HEADER_SIZE, len(legacy.serialize()))
+
+    def test_compatible_with_dict_headers(self):
+        header = deserialize_header(self.KAWPOW_HEADER, 1219736)
+        header_dict = header.to_dict()
+        self.assertEqual(header_dict, header)
+        self.assertEqual(header, deserialize_header(self.KAWPOW_HEADER, 1219736))
+        self.assertEqual(self.KAWPOW_HEADER.hex(), serialize_header(header_dict))
+        self.assertEqual(self.KAWPOW_HEADER.hex(), serialize_header(header))
+        self.assertEqual(hash_header(header_dict), hash_header(header))
+
+    def test_setitem_reserializes(self):
+        header = deserialize_header(self.KAWPOW_HEADER, 1219736)
+        old_hash = hash_header(header)
+        header['nonce'] = 42
+        self.assertEqual(42, header['nonce'])
+        self.assertEqual((42).to_bytes(8, 'little'), header.raw[80:88])
+        self.assertNotEqual(old_hash, hash_header(header))
+
+
+class TestChainworkIndex(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self._saved_cache = dict(blockchain._CHAINWORK_CACHE)
+        self.start_height = constants.net.max_checkpoint() + 1
+        with open(os.path.join(self.electrum_path, 'blockchain_headers'), 'wb') as f:
+            f.seek(self.start_height * HEADER_SIZE)
+            f.write(make_kawpow_chunk(self.start_height, 2 * 2016 + 10))
+
+    def tearDown(self):
+        blockchain._CHAINWORK_CACHE.clear()
+        blockchain._CHAINWORK_CACHE.update(self._saved_cache)
+        super().tearDown()
+
+    def _reset_cache(self):
+        blockchain._CHAINWORK_CACHE.clear()
+        blockchain._CHAINWORK_CACHE.update(self._saved_cache)
+
+    def _new_chain(self) -> Blockchain:
+        return Blockchain(config=self.config, forkpoint=0, parent=None,
+                          forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+    def test_index_persisted_and_loaded(self):
+        chain = self._new_chain()
+        self.assertFalse(os.path.exists(chain.chainwork_index_path()))
+        chainwork = chain.get_chainwork()
+        records = chain._read_chainwork_index()
+        self.assertEqual([self.start_height + 2015, self.start_height + 4031], [r[0] for r in records])
+
+        self._reset_cache()
+        self.assertNotIn(chain.get_hash(self.start_height + 4031), blockchain._CHAINWORK_CACHE)
+        chain = self._new_chain()
+        self.assertIn(chain.get_hash(self.start_height + 4031), blockchain._CHAINWORK_CACHE)
+        self.assertEqual(chainwork, chain.get_chainwork())
+
+    def test_index_truncated_with_headers(self):
+        chain = self._new_chain()
+        chain.get_chainwork()
+        self.assertEqual(2, len(chain._read_chainwork_index()))
+        chain.write(b'', (self.start_height + 4031) * HEADER_SIZE)
+        self.assertEqual([self.start_height + 2015], [r[0] for r in chain._read_chainwork_index()])
+        # appending does not touch the index
+        chain.write(bytes(HEADER_SIZE), chain.size() * HEADER_SIZE, truncate=False)
+        self.assertEqual(1, len(chain._read_chainwork_index()))
+
+    def test_index_ignored_if_checkpoints_changed(self):
+        chain = self._new_chain()
+        chain.get_chainwork()
+        with open(chain.chainwork_index_path(), 'r+b') as f:
+            f.seek(len(blockchain.CHAINWORK_INDEX_MAGIC))
+            f.write(bytes(32))
+        self.assertIsNone(chain._read_chainwork_index())
+
+
+class TestHeadersMmap(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.start_height = constants.net.max_checkpoint() + 1
+        self.chunk = make_kawpow_chunk(self.start_height, 6)
+
+    def _new_chain(self, config: SimpleConfig) -> Blockchain:
+        return Blockchain(config=config, forkpoint=0, parent=None,
+                          forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+    def test_read_header_mmap_follows_writes(self):
+        chain = self._new_chain(self.config)
+        open(chain.path(), 'w+').close()
+        headers = list(blockchain.iter_chunk_headers(self.start_height, self.chunk))
+        for height, raw in headers:
+            chain.write(raw, height * HEADER_SIZE)
+            self.assertEqual(deserialize_header(raw, height), chain.read_header(height))
+        self.assertIsNotNone(chain._headers_mmap)
+
+        # without mmap, reads go through the file and give the same result
+        config_nommap = SimpleConfig({'electrum_path': self.electrum_path, 'blockchain_mmap_headers': False})
+        chain_nommap = self._new_chain(config_nommap)
+        for height, raw in headers:
+            self.assertEqual(chain.read_header(height), chain_nommap.read_header(height))
+        self.assertIsNone(chain_nommap._headers_mmap)
+
+        # truncating the file drops the stale map
+        chain.write(b'', (self.start_height + 3) * HEADER_SIZE)
+        self.assertEqual(self.start_height + 2, chain.height())
+        self.assertIsNone(chain.read_header(self.start_height + 3))
+        self.assertEqual(deserialize_header(headers[2][1], self.start_height + 2),
+                         chain.read_header(self.start_height + 2))
+
+    def test_read_header_mmap_closed_concurrently(self):
+        chain = self._new_chain(self.config)
+        open(chain.path(), 'w+').close()
+        headers = list(blockchain.iter_chunk_headers(self.start_height, self.chunk))
+        for height, raw in headers:
+            chain.write(raw, height * HEADER_SIZE)
+        expected = {height: deserialize_header(raw, height) for height, raw in headers}
+
+        # a map closed behind our back falls back to file reads
+        chain._get_headers_mmap().close()
+        self.assertEqual(expected[self.start_height], chain.read_header(self.start_height))
+        self.assertIsNone(chain._headers_mmap)
+
+        # writes close the map while other threads read through it
+        def rewrite():
+            for _ in range(50):
+                for height, raw in headers:
+                    chain.write(raw, height * HEADER_SIZE, truncate=False)
+
+        def read():
+            for _ in range(50):
+                for height in expected:
+                    self.assertEqual(expected[height], chain.read_header(height))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(rewrite), executor.submit(read), executor.submit(read)]
+            for fut in futures:
+                fut.result()
@@ -1,4 +1,12 @@
-from electrum.coinchooser import CoinChooserPrivacy
+import os
+import time
+import unittest
+
+from electrum import descriptor, ecc
+from electrum.bitcoin import COIN, hash160_to_p2pkh, public_key_to_p2pkh
+from electrum.coinchooser import CoinChooserPrivacy, CoinChooserBnB, get_coin_chooser
+from electrum.simple_config import SimpleConfig
+from electrum.transaction import PartialTransaction, PartialTxInput, PartialTxOutput, Transaction, TxOutpoint
 from electrum.util import NotEnoughFunds
 
 from . import ElectrumTestCase
@@ -7,14 +15,109 @@ from . import ElectrumTestCase
 class TestCoinChooser(ElectrumTestCase):
 
     def test_bucket_candidates_with_empty_buckets(self):
-        def sufficient_funds(buckets, *, bucket_value_sum):
+        def sufficient_funds(*, bucket_value_sum, bucket_weight_sum):
             return True
         coin_chooser = CoinChooserPrivacy(enable_output_value_rounding=False)
         self.assertEqual([[]], coin_chooser.bucket_candidates_any([], sufficient_funds))
         self.assertEqual([[]], coin_chooser.bucket_candidates_prefer_confirmed([], sufficient_funds))
-        def sufficient_funds(buckets, *, bucket_value_sum):
+        def sufficient_funds(*, bucket_value_sum, bucket_weight_sum):
             return False
         with self.assertRaises(NotEnoughFunds):
             coin_chooser.bucket_candidates_any([], sufficient_funds)
         with self.assertRaises(NotEnoughFunds):
             coin_chooser.bucket_candidates_prefer_confirmed([], sufficient_funds)
+
+
+def make_coin(value: int, *, asset: str = None, height: int = 100, privkey: bytes = None) -> PartialTxInput:
+    pubkey = ecc.ECPrivkey(privkey or os.urandom(32)).get_public_key_hex(compressed=True)
+    coin = PartialTxInput(prevout=TxOutpoint(txid=os.urandom(32), out_idx=0))
+    coin.script_descriptor = descriptor.get_singlesig_descriptor_from_legacy_leaf(pubkey=pubkey, script_type='p2pkh')
+    coin._trusted_address = public_key_to_p2pkh(bytes.fromhex(pubkey))
+    coin._trusted_value_sats = value
+    coin._trusted_asset = asset
+    coin.block_height = height
+    return coin
+
+
+class TestCoinChooserBnB(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dest = hash160_to_p2pkh(bytes(20))
+        self.change = hash160_to_p2pkh(bytes([1]) * 20)
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    def make_tx(self, coins, outputs, *, chooser=None, feerate=10):
+        chooser = chooser or CoinChooserBnB(enable_output_value_rounding=False)
+        return chooser.make_tx(coins=coins, inputs=[], outputs=outputs, change_addrs=[self.change],
+                               restricted_change_address={},
+                               fee_estimator_vb=lambda size: round(feerate * size), dust_threshold=546)
+
+    def test_selectable(self):
+        self.config.WALLET_COIN_CHOOSER_POLICY = 'BranchAndBound'
+        self.assertIsInstance(get_coin_chooser(self.config), CoinChooserBnB)
+
+    def test_changeless(self):
+        fee = 10 * (Transaction.virtual_size_from_weight(
+            PartialTransaction.from_io([make_coin(1)], [PartialTxOutput.from_address_and_value(self.dest, 1)]).estimated_weight()))
+        # 80_000 + fee of a 1-in 1-out tx is paid exactly by the second coin, without change
+        coins = [make_coin(v) for v in (1_000_000, 80_000 + fee + 100, 500_000, 30_000)]
+        tx = self.make_tx(coins, [PartialTxOutput.from_address_and_value(self.dest, 80_000)])
+        self.assertEqual(1, len(tx.inputs()))
+        self.assertEqual(80_000 + fee + 100, tx.input_value())
+        self.assertEqual(1, len(tx.outputs()))
+
+    def test_falls_back_to_random(self):
+        coins = [make_coin(v) for v in (1_000_000, 2_000_000)]
+        tx = self.make_tx(coins, [PartialTxOutput.from_address_and_value(self.dest, 80_000)])
+        self.assertEqual(2, len(tx.outputs()))
+        self.assertTrue(any(o.is_change for o in tx.outputs()))
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(coins, [PartialTxOutput.from_address_and_value(self.dest, 5_000_000)])
+
+    def test_assets(self):
+        # spending assets needs RVN for the fee, and asset coins of the needed asset only
+        coins = [make_coin(v) for v in (3_000, 5_000, 7_000, 200_000)]
+        coins += [make_coin(v * COIN, asset='ASSET') for v in (5, 3, 2)]
+        coins += [make_coin(10 * COIN, asset='OTHER')]
+        tx = self.make_tx(coins, [PartialTxOutput.from_address_and_value(self.dest, 4 * COIN, asset='ASSET')])
+        input_value = tx.input_value(asset_aware=True)
+        self.assertEqual({None, 'ASSET'}, set(input_value))
+        change = [(o.asset, o.asset_aware_value()) for o in tx.outputs() if o.is_change]
+        self.assertEqual([('ASSET', input_value['ASSET'] - 4 * COIN)], change)
+        self.assertGreaterEqual(tx.get_fee(), 10 * tx.estimated_size())
+        self.assertLess(tx.get_fee(), 10 * tx.estimated_size() + 546 + 10 * 34)
+
+    def test_prefers_confirmed(self):
+        coin = make_coin(1_000_000, height=0)
+        coins = [coin] + [make_coin(v) for v in (400_000, 700_000)]
+        tx = self.make_tx(coins, [PartialTxOutput.from_address_and_value(self.dest, 1_000_000)])
+        self.assertNotIn(coin.prevout, [txin.prevout for txin in tx.inputs()])
+
+
+@unittest.skipUnless(os.environ.get('ELECTRUM_RUN_BENCHMARKS'), 'set ELECTRUM_RUN_BENCHMARKS=1 to run benchmarks')
+class BenchCoinChooserPrivacy(ElectrumTestCase):
+    NUM_UTXOS = 10_000
+
+    def setUp(self):
+        super().setUp()
+        self.coins = [make_coin(10_000 + i * 49) for i in range(self.NUM_UTXOS)]
+
+    def _select(self, amount: int) -> PartialTransaction:
+        outputs = [PartialTxOutput.from_address_and_value(hash160_to_p2pkh(bytes(20)), amount)]
+        t0 = time.perf_counter()
+        tx = CoinChooserPrivacy(enable_output_value_rounding=False).make_tx(
+            coins=self.coins, inputs=[], outputs=outputs, change_addrs=[hash160_to_p2pkh(bytes([1]) * 20)],
+            restricted_change_address={}, fee_estimator_vb=lambda size: round(10 * size), dust_threshold=546)
+        print(f"\n{self.NUM_UTXOS} UTXOs, {len(tx.inputs())} inputs selected: {time.perf_counter() - t0:.2f} s")
+        return tx
+
+    def test_small_payment(self):
+        total = sum(coin.value_sats() for coin in self.coins)
+        tx = self._select(total // 300)
+        self.assertGreaterEqual(tx.input_value(), total // 300)
+
+    def test_half_of_the_coins(self):
+        total = sum(coin.value_sats() for coin in self.coins)
+        tx = self._select(total // 2)
+        self.assertGreaterEqual(tx.input_value(), total // 2)
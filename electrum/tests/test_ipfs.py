@@ -1,9 +1,18 @@
 import asyncio
+import os
+import tempfile
+
+from multiformats import CID, multihash
+from ipfs_car_decoder import CarDecodeException
+from unix_fs_exporter import PBNode, PBLink, UnixFS, FSType
 
 from electrum import SimpleConfig
 from electrum import Network
 from electrum import util
 from electrum import ipfs_db
+from electrum.ipfs_db import _StreamingCARBlockStore, _write_car_stream_to_file, cidv0_to_base32_cidv1
+
+from . import ElectrumTestCase
 
 if __name__ == 'x__main__':
     loop, stop_loop, loop_thread = util.create_and_start_event_loop()
@@ -22,3 +31,147 @@ if __name__ == 'x__main__':
     #loop.call_soon_threadsafe(stop_loop.set_result, 1)
     #loop_thread.join(timeout=1)
 
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _car_section(data: bytes) -> bytes:
+    return _varint(len(data)) + data
+
+
+def _make_file_car(leaves):
+    """CARv1 of a UnixFS file with raw leaves, in the order gateways send it.
+    Returns the CIDv0 of the file and the car."""
+    leaf_cids = [CID('base32', 1, 'raw', multihash.digest(leaf, 'sha2-256')) for leaf in leaves]
+    unix_fs = UnixFS(fs_type=FSType.FILE, block_sizes=[len(leaf) for leaf in leaves])
+    root = PBNode(data=unix_fs.marshal(),
+                  links=[PBLink(name='', t_size=len(leaf), cid=cid) for leaf, cid in zip(leaves, leaf_cids)]).encode()
+    root_cid = CID('base58btc', 0, 'dag-pb', multihash.digest(root, 'sha2-256'))
+    car = _car_section(bytes.fromhex('a265726f6f7473806776657273696f6e01'))  # {'roots': [], 'version': 1}
+    car += _car_section(bytes(root_cid) + root)
+    for leaf, cid in zip(leaves, leaf_cids):
+        car += _car_section(bytes(cid) + leaf)
+    return str(root_cid), car
+
+
+class TestStreamingCARBlockStore(ElectrumTestCase):
+
+    leaves = [os.urandom(1000), os.urandom(1000), b'\x00' * 1000, b'\x00' * 200]
+
+    async def _write(self, ipfs_hash: str, car: bytes, chunk_size: int) -> bytes:
+        block_store = _StreamingCARBlockStore()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'data')
+            writer = asyncio.create_task(_write_car_stream_to_file(cidv0_to_base32_cidv1(ipfs_hash), block_store, path))
+            for i in range(0, len(car), chunk_size):
+                await block_store.feed(car[i:i + chunk_size])
+                await asyncio.sleep(0)
+            await block_store.finish()
+            await writer
+            with open(path, 'rb') as f:
+                return f.read()
+
+    async def test_file_written_while_streaming(self):
+        ipfs_hash, car = _make_file_car(self.leaves)
+        for chunk_size in (1, 7, 1024, len(car)):
+            self.assertEqual(b''.join(self.leaves), await self._write(ipfs_hash, car, chunk_size))
+
+    async def test_car_v2(self):
+        ipfs_hash, car_v1 = _make_file_car(self.leaves)
+        pragma = _car_section(bytes.fromhex('a16776657273696f6e02'))
+        data_offset = len(pragma) + 40 + 5
+        header = (bytes(16) + data_offset.to_bytes(8, 'little') + len(car_v1).to_bytes(8, 'little')
+                  + (data_offset + len(car_v1)).to_bytes(8, 'little'))
+        car = pragma + header + bytes(5) + car_v1 + b'index bytes'
+        self.assertEqual(b''.join(self.leaves), await self._write(ipfs_hash, car, 13))
+
+    async def test_block_not_matching_digest(self):
+        ipfs_hash, car = _make_file_car(self.leaves)
+        car = car[:-1] + b'\x01'
+        with self.assertRaises(CarDecodeException):
+            await self._write(ipfs_hash, car, 100)
+
+    async def test_truncated(self):
+        ipfs_hash, car = _make_file_car(self.leaves)
+        with self.assertRaises(CarDecodeException):
+            await self._write(ipfs_hash, car[:-1], 100)
+        # missing block
+        with self.assertRaises(CarDecodeException):
+            await self._write(ipfs_hash, car[:-(200 + 36 + 2)], 100)
+
+
+class TestIPFSCacheEviction(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db_path = os.path.join(self.electrum_path, 'ipfs_db.json')
+        self.raw_path = os.path.join(self.electrum_path, 'ipfs_raw')
+        self.db = ipfs_db.IPFSDB(self.db_path, self.raw_path)
+        self.hashes = [str(CID('base58btc', 0, 'dag-pb', multihash.digest(bytes([i]), 'sha2-256')))
+                       for i in range(4)]
+
+    def tearDown(self):
+        self.db.unregister_callbacks()
+        super().tearDown()
+
+    def _add_data(self, ipfs_hash: str, size: int, *, pin: bool = False):
+        self.db.associate_asset_with_ipfs(ipfs_hash, f'ASSET{self.hashes.index(ipfs_hash)}', pin=pin)
+        with open(self.db._local_path_for_ipfs_data(ipfs_hash), 'wb') as f:
+            f.write(bytes(size))
+        m = self.db.get_metadata(ipfs_hash)
+        m.is_client_side = True
+        self.db._add_cached_data(ipfs_hash, m)
+
+    def _cached(self):
+        return [h for h in self.hashes if self.db.get_resource_path_for_ipfs_str(h)[0]]
+
+    def test_total_size(self):
+        for i, ipfs_hash in enumerate(self.hashes):
+            self._add_data(ipfs_hash, 100 * (i + 1))
+        self.assertEqual(1000, self.db.get_total_bytes_on_disk())
+        self.db.remove_ipfs_info(self.hashes[1])
+        self.assertEqual(800, self.db.get_total_bytes_on_disk())
+        self.db.clear_cache()
+        self.assertEqual(0, self.db.get_total_bytes_on_disk())
+
+    def test_least_recently_accessed_evicted(self):
+        for ipfs_hash in self.hashes:
+            self._add_data(ipfs_hash, 100)
+        # access the first one, so the second one is the least recently accessed
+        self.db.get_resource_path_for_ipfs_str(self.hashes[0])
+        self.db.enforce_cache_size(300)
+        self.assertEqual(300, self.db.get_total_bytes_on_disk())
+        self.assertEqual([self.hashes[0], self.hashes[2], self.hashes[3]], self._cached())
+        self.assertFalse(self.db.get_metadata(self.hashes[1]).is_client_side)
+        self.assertFalse(os.path.exists(self.db._local_path_for_ipfs_data(self.hashes[1])))
+
+    def test_pinned_and_kept_not_evicted(self):
+        self._add_data(self.hashes[0], 100, pin=True)
+        for ipfs_hash in self.hashes[1:]:
+            self._add_data(ipfs_hash, 100)
+        self.db.enforce_cache_size(0, keep=self.hashes[3])
+        self.assertEqual([self.hashes[0], self.hashes[3]], self._cached())
+        self.assertEqual(200, self.db.get_total_bytes_on_disk())
+        # unpinned once the wallet asset is gone
+        self.db.associate_asset_with_ipfs(self.hashes[0], 'VIEWED')
+        self.db.dissociate_asset_with_ipfs(self.hashes[0], 'ASSET0')
+        self.db.enforce_cache_size(0)
+        self.assertEqual([], self._cached())
+
+    def test_sizes_and_order_loaded(self):
+        for i, ipfs_hash in enumerate(self.hashes):
+            self._add_data(ipfs_hash, 100)
+            self.db.get_metadata(ipfs_hash).last_accessed = 1000 - i
+        self.db.write()
+        self.db.unregister_callbacks()
+        self.db = ipfs_db.IPFSDB(self.db_path, self.raw_path)
+        self.assertEqual(400, self.db.get_total_bytes_on_disk())
+        self.db.enforce_cache_size(200)
+        self.assertEqual(self.hashes[:2], self._cached())
@@ -1,11 +1,15 @@
 import asyncio
+import itertools
 import tempfile
 import unittest
+from collections import defaultdict
+
+from aiorpcx import RPCError
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface, ServerAddr
+from electrum.interface import Interface, ServerAddr, NotificationSession
 from electrum.crypto import sha256
 from electrum.util import OldTaskGroup
 from electrum import util
@@ -127,6 +131,162 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class MockChunkInterface(MockInterface):
+    """Serves chunks after a small delay and records how many requests are in flight."""
+
+    def __init__(self, config, *, name='mock-server'):
+        super().__init__(config)
+        self.server = ServerAddr.from_str(f'{name}:50000:t')
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requested = []
+
+    async def _fetch_chunk(self, height, size):
+        self.requested.append(height)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # later chunks come back first
+            await asyncio.sleep(0.01 * (1 + (height // 2016) % 3))
+            return f"{self.server.host}:{height}:{size}"
+        finally:
+            self.in_flight -= 1
+
+
+class TestHeaderPipeline(ElectrumTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.interface = MockChunkInterface(self.config)
+        self.connected = []
+        self.fail_at = None
+
+        async def connect_chunk(start_height, hexdata):
+            if start_height == self.fail_at:
+                return False
+            self.connected.append((start_height, hexdata))
+            return True
+        self.interface.blockchain.connect_chunk = connect_chunk
+        # above the last checkpoint, so that no alignment happens
+        self.height = (constants.net.max_checkpoint() // 2016 + 1) * 2016
+
+    async def test_chunks_connected_in_order(self):
+        self.config.NETWORK_HEADER_PIPELINE_DEPTH = 3
+        tip = self.height + 5 * 2016 + 99
+        res = await self.interface.request_chunks_pipelined(self.height, tip)
+        self.assertEqual((True, 5 * 2016 + 100), res)
+        starts = [self.height + i * 2016 for i in range(6)]
+        self.assertEqual(starts, [start for start, _ in self.connected])
+        self.assertEqual(f"mock-server:{starts[-1]}:100", self.connected[-1][1])
+        self.assertEqual(3, self.interface.max_in_flight)
+
+    async def test_stops_at_first_failure(self):
+        self.config.NETWORK_HEADER_PIPELINE_DEPTH = 4
+        self.fail_at = self.height + 2 * 2016
+        res = await self.interface.request_chunks_pipelined(self.height, self.height + 10 * 2016)
+        self.assertEqual((True, 2 * 2016), res)
+        self.assertEqual([self.height, self.height + 2016], [start for start, _ in self.connected])
+        self.assertLessEqual(len(self.interface.requested), 2 + 4)
+
+    async def test_first_chunk_fails(self):
+        self.fail_at = self.height
+        res = await self.interface.request_chunks_pipelined(self.height, self.height + 3 * 2016)
+        self.assertEqual((False, 0), res)
+
+    async def test_spread_over_interfaces(self):
+        self.config.NETWORK_HEADER_PIPELINE_SPREAD = True
+        helper = MockChunkInterface(self.config, name='helper')
+        self.interface.network.get_interfaces_for_header_download = lambda min_tip, exclude: [helper]
+        res = await self.interface.request_chunks_pipelined(self.height, self.height + 4 * 2016 - 1)
+        self.assertEqual((True, 4 * 2016), res)
+        self.assertEqual(2, len(self.interface.requested))
+        self.assertEqual(2, len(helper.requested))
+        self.assertEqual(['mock-server', 'helper'] * 2,
+                         [hexdata.split(':')[0] for _, hexdata in self.connected])
+
+
+class MockBatch:
+
+    def __init__(self, session):
+        self.session = session
+        self.requests = []
+        self.results = None
+
+    def add_request(self, method, args=()):
+        self.requests.append((method, args))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.session.batches.append(self.requests)
+        self.results = tuple(self.session.answer(method, args) for method, args in self.requests)
+
+
+class MockNotificationSession(NotificationSession):
+    """Answers requests locally instead of over a transport."""
+
+    def __init__(self):
+        self.subscriptions = defaultdict(list)
+        self.cache = {}
+        self._msg_counter = itertools.count(start=1)
+        self.interface = None
+        self.batches = []
+        self.requests = []
+
+    def answer(self, method, params):
+        if params[0] == 'bad':
+            return RPCError(1, 'bad request')
+        return f'status-{params[0]}'
+
+    def send_batch(self, raise_errors=False):
+        return MockBatch(self)
+
+    async def send_request(self, method, params, **kwargs):
+        self.requests.append((method, params))
+        return self.answer(method, params)
+
+
+class TestSubscribeBatch(ElectrumTestCase):
+
+    async def test_subscribe_batch(self):
+        session = MockNotificationSession()
+        queue = asyncio.Queue()
+        await session.subscribe_batch('blockchain.asset.subscribe', [['A'], ['B'], ['C']], queue)
+        self.assertEqual([[('blockchain.asset.subscribe', ['A']), ('blockchain.asset.subscribe', ['B']),
+                           ('blockchain.asset.subscribe', ['C'])]], session.batches)
+        self.assertEqual([['A', 'status-A'], ['B', 'status-B'], ['C', 'status-C']],
+                         [queue.get_nowait() for _ in range(3)])
+        # cached results are not requested again
+        queue2 = asyncio.Queue()
+        await session.subscribe_batch('blockchain.asset.subscribe', [['B'], ['D'], ['E']], queue2)
+        self.assertEqual([('blockchain.asset.subscribe', ['D']), ('blockchain.asset.subscribe', ['E'])],
+                         session.batches[-1])
+        self.assertEqual([['B', 'status-B'], ['D', 'status-D'], ['E', 'status-E']],
+                         [queue2.get_nowait() for _ in range(3)])
+        self.assertEqual(5, len(session.cache))
+        self.assertEqual([queue, queue2], session.subscriptions[
+            session.get_hashable_key_for_rpc_call('blockchain.asset.subscribe', ['B'])])
+
+    async def test_subscribe_batch_of_one(self):
+        session = MockNotificationSession()
+        queue = asyncio.Queue()
+        await session.subscribe_batch('blockchain.asset.subscribe', [['A']], queue)
+        self.assertEqual([], session.batches)
+        self.assertEqual([('blockchain.asset.subscribe', ['A'])], session.requests)
+        self.assertEqual(['A', 'status-A'], queue.get_nowait())
+
+    async def test_subscribe_batch_error(self):
+        session = MockNotificationSession()
+        queue = asyncio.Queue()
+        with self.assertRaises(RPCError):
+            await session.subscribe_batch('blockchain.asset.subscribe', [['A'], ['bad'], ['C']], queue)
+        self.assertEqual([['A', 'status-A'], ['C', 'status-C']], [queue.get_nowait() for _ in range(2)])
+        self.assertTrue(queue.empty())
+        self.assertEqual(2, len(session.cache))
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
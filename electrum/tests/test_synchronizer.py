@@ -0,0 +1,103 @@
+import asyncio
+
+from electrum import util
+from electrum.bitcoin import hash160_to_p2pkh
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import Synchronizer
+
+from . import ElectrumTestCase
+
+
+class MockNetwork:
+
+    def __init__(self, config):
+        self.config = config
+        self.asyncio_loop = util.get_asyncio_loop()
+        self.interface = None
+
+
+class MockDB:
+
+    def __init__(self):
+        self.verified_tags_for_h160s = {}
+
+    def get_history(self):
+        return []
+
+
+class MockAddressSynchronizer:
+
+    def __init__(self, network):
+        self.network = network
+        self.db = MockDB()
+        self.synchronizer = None
+        self.num_up_to_date_changed = 0
+        self.num_up_to_date_checks = 0
+
+    def diagnostic_name(self):
+        return 'mock'
+
+    def get_addresses(self):
+        return []
+
+    def get_assets_to_watch(self):
+        return []
+
+    def get_broadcasts_to_watch(self):
+        return []
+
+    def is_up_to_date(self):
+        self.num_up_to_date_checks += 1
+        return self.synchronizer.is_up_to_date()
+
+    def up_to_date_changed(self):
+        self.num_up_to_date_changed += 1
+
+
+class TestSynchronizerMainLoop(ElectrumTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        network = MockNetwork(SimpleConfig({'electrum_path': self.electrum_path}))
+        self.adb = MockAddressSynchronizer(network)
+        self.synchronizer = Synchronizer(self.adb)
+        self.adb.synchronizer = self.synchronizer
+        self.added = []
+
+        async def _add_addresses(addrs):
+            self.added.extend(addrs)
+            self.synchronizer._adding_addrs.difference_update(addrs)
+        self.synchronizer._add_addresses = _add_addresses
+        self.main_task = asyncio.create_task(self.synchronizer.main())
+
+    async def asyncTearDown(self):
+        self.main_task.cancel()
+        await self.synchronizer.stop()
+        await super().asyncTearDown()
+
+    async def test_sleeps_until_woken_up(self):
+        await asyncio.sleep(0.3)
+        num_checks = self.adb.num_up_to_date_checks
+        await asyncio.sleep(0.3)
+        self.assertEqual(num_checks, self.adb.num_up_to_date_checks)
+        # on startup, and when becoming up to date
+        self.assertEqual(2, self.adb.num_up_to_date_changed)
+        self.assertTrue(self.adb.is_up_to_date())
+        addr = hash160_to_p2pkh(bytes(20))
+        self.synchronizer.add(addr)
+        self.assertFalse(self.adb.is_up_to_date())
+        await asyncio.sleep(0.3)
+        self.assertEqual([addr], self.added)
+        self.assertTrue(self.adb.is_up_to_date())
+        self.assertEqual(2, self.adb.num_up_to_date_changed)
+
+    async def test_add_addresses_rejects_invalid(self):
+        addr = hash160_to_p2pkh(bytes(20))
+        with self.assertRaises(ValueError):
+            self.synchronizer.add_addresses([addr, 'not an address'])
+        self.assertFalse(self.synchronizer._adding_addrs)
+        # an invalid item that reaches a batch does not stay pending
+        self.synchronizer._adding_addrs.update([addr, 'not an address'])
+        with self.assertRaises(ValueError):
+            await Synchronizer._add_addresses(self.synchronizer, [addr, 'not an address'])
+        self.assertFalse(self.synchronizer._adding_addrs)
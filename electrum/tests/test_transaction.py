@@ -1,3 +1,4 @@
+import copy
 from typing import NamedTuple, Union
 
 from electrum import transaction, bitcoin
@@ -78,6 +79,26 @@ class TestBCDataStream(ElectrumTestCase):
         self.assertEqual(b'\x01\x00', s.read_bytes(2))
         self.assertFalse(s.can_read_more())
 
+    def test_read_in_place(self):
+        raw = b'\x03foo\x01\x00\x00\x00bar'
+        for data in (raw, bytearray(raw), memoryview(b'xx' + raw)[2:]):
+            with self.subTest(data_type=type(data)):
+                s = transaction.BCDataStream()
+                s.write(data)
+                self.assertEqual(s.read_string(), 'foo')
+                self.assertEqual(s.read_uint32(), 1)
+                s.skip_bytes(1)
+                self.assertEqual(type(s.read_bytes(2)), bytes)
+                with self.assertRaises(transaction.SerializationError):
+                    s.skip_bytes(1)
+        s = transaction.BCDataStream()
+        s.write(raw)
+        self.assertIs(s.input, raw)
+        # writing to a stream initialized from bytes does not modify them
+        s.write(b'!')
+        self.assertEqual(raw + b'!', s.input)
+        self.assertEqual(b'\x03foo\x01\x00\x00\x00bar', raw)
+
 
 class TestTransaction(ElectrumTestCase):
     def test_match_against_script_template(self):
@@ -219,6 +240,23 @@ class TestTransaction(ElectrumTestCase):
         self.assertEqual(raw_hex,
                          tx.serialize_as_bytes().hex())
 
+    def test_txid_from_network_ser_without_parsing(self):
+        for raw_hex in (signed_blob, v2_blob, signed_segwit_blob):
+            with self.subTest(raw_hex=raw_hex[:16]):
+                tx = Transaction(bfh(raw_hex))
+                txid = tx.txid()
+                self.assertIsNone(tx._inputs)
+                self.assertEqual(bfh(raw_hex), tx.serialize_as_bytes())
+                # same as the txid of the re-serialized inputs and outputs
+                tx.deserialize()
+                tx.invalidate_ser_cache()
+                self.assertEqual(txid, tx.txid())
+                self.assertEqual(raw_hex, tx.serialize())
+        self.assertEqual('0d4cb2606505a6590d6944510d4723adcc00b8d7ed338dbdbb33564ff3bb239b',
+                         Transaction(signed_segwit_blob).txid())
+        with self.assertRaises(transaction.SerializationError):
+            Transaction(signed_segwit_blob[:100]).txid()
+
     def test_tx_serialize_methods_for_psbt_that_is_ready_to_be_finalized(self):
         raw_hex_psbt = "70736274ff01009a020000000258e87a21b56daf0c23be8e7070456c336f7cbaa5c8757924f545887bb2abdd750000000000ffffffff838d0427d0ec650a68aa46bb0b098aea4422c071b2ca78352a077959d07cea1d0100000000ffffffff0270aaf00800000000160014d85c2b71d0060b09c9886aeb815e50991dda124d00e1f5050000000016001400aea9a2e5f0f876a588df5546e8742d1d87008f00000000000100bb0200000001aad73931018bd25f84ae400b68848be09db706eac2ac18298babee71ab656f8b0000000048473044022058f6fc7c6a33e1b31548d481c826c015bd30135aad42cd67790dab66d2ad243b02204a1ced2604c6735b6393e5b41691dd78b00f0c5942fb9f751856faa938157dba01feffffff0280f0fa020000000017a9140fb9463421696b82c833af241c78c17ddbde493487d0f20a270100000017a91429ca74f8a08f81999428185c97b5d852e4063f6187650000000107da00473044022074018ad4180097b873323c0015720b3684cc8123891048e7dbcd9b55ad679c99022073d369b740e3eb53dcefa33823c8070514ca55a7dd9544f157c167913261118c01483045022100f61038b308dc1da865a34852746f015772934208c6d24454393cd99bdf2217770220056e675a675a6d0a02b85b14e5e29074d8a25a9b5760bea2816f661910a006ea01475221029583bf39ae0a609747ad199addd634fa6108559d6c5cd39b4c2183f1ab96e07f2102dab61ff49a14db6a7d02b0cd1fbb78fc4b18312b5b4e54dae4dba2fbfef536d752ae0001012000c2eb0b0000000017a914b7f5faf40e3d40a5a459b1db3535f2b72fa921e8870107232200208c2353173743b595dfb4a07b72ba8e42e3797da74e87fe7d9d7497e3b20289030108da0400473044022062eb7a556107a7c73f45ac4ab5a1dddf6f7075fb1275969a7f383efff784bcb202200c05dbb7470dbf2f08557dd356c7325c1ed30913e996cd3840945db12228da5f01473044022065f45ba5998b59a27ffe1a7bed016af1f1f90d54b3aa8f7450aa5f56a25103bd02207f724703ad1edb96680b284b56d4ffcb88f7fb759eabbe08aa30f29b851383d20147522103089dc10c7ac6db54f91329af617333db388cead0c231f723379d1b99030b02dc21023add904f3d6dcf59ddb906b0dee23529b7ffb9ed50e5e86151926860221f0e7352ae00220203a9a4c37f5996d3aa25dbac6b570af0650394492942460b354753ed9eeca5877110d90c6a4f000000800000008004000080002202027f6399757d2eff55a136ad02c684b1838b6556e5f1b6b34282a94b6b5005109610d90c6a4f00000080000000800500008000"
         raw_hex_network_tx = "0200000000010258e87a21b56daf0c23be8e7070456c336f7cbaa5c8757924f545887bb2abdd7500000000da00473044022074018ad4180097b873323c0015720b3684cc8123891048e7dbcd9b55ad679c99022073d369b740e3eb53dcefa33823c8070514ca55a7dd9544f157c167913261118c01483045022100f61038b308dc1da865a34852746f015772934208c6d24454393cd99bdf2217770220056e675a675a6d0a02b85b14e5e29074d8a25a9b5760bea2816f661910a006ea01475221029583bf39ae0a609747ad199addd634fa6108559d6c5cd39b4c2183f1ab96e07f2102dab61ff49a14db6a7d02b0cd1fbb78fc4b18312b5b4e54dae4dba2fbfef536d752aeffffffff838d0427d0ec650a68aa46bb0b098aea4422c071b2ca78352a077959d07cea1d01000000232200208c2353173743b595dfb4a07b72ba8e42e3797da74e87fe7d9d7497e3b2028903ffffffff0270aaf00800000000160014d85c2b71d0060b09c9886aeb815e50991dda124d00e1f5050000000016001400aea9a2e5f0f876a588df5546e8742d1d87008f000400473044022062eb7a556107a7c73f45ac4ab5a1dddf6f7075fb1275969a7f383efff784bcb202200c05dbb7470dbf2f08557dd356c7325c1ed30913e996cd3840945db12228da5f01473044022065f45ba5998b59a27ffe1a7bed016af1f1f90d54b3aa8f7450aa5f56a25103bd02207f724703ad1edb96680b284b56d4ffcb88f7fb759eabbe08aa30f29b851383d20147522103089dc10c7ac6db54f91329af617333db388cead0c231f723379d1b99030b02dc21023add904f3d6dcf59ddb906b0dee23529b7ffb9ed50e5e86151926860221f0e7352ae00000000"
@@ -992,3 +1030,64 @@ class TestSighashTypes(ElectrumTestCase):
         sig = tx.sign_txin(0,privkey)
         self.assertEqual('30440220525406a1482936d5a21888260dc165497a90a15669636d8edca6b9fe490d309c022032af0c646a34a44d1f4576bf6a4a74b67940f8faa84c7df9abe12a01a11e2b4783',
                          sig)
+
+    def test_legacy_preimage_multiple_inputs(self):
+        script_code = '76a914389ffce9cd9ae88dcc0631e88a821ffdbe9bfe2688ac'
+        inputs = []
+        for i in range(3):
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i]) * 32, out_idx=i))
+            txin.nsequence = 0xfffffffe - i
+            inputs.append(txin)
+        overrides = {txin.prevout.to_str(): script_code for txin in inputs}
+        tx = PartialTransaction.from_io(inputs=inputs, outputs=[self.txout1, self.txout2],
+                                        locktime=self.locktime, version=1, BIP69_sort=False)
+
+        def txin_ser(k, *, signing, zero_nsequence=False):
+            outpoint = (bytes([k]) * 32).hex() + int.to_bytes(k, 4, 'little').hex()
+            script = '19' + script_code if signing else '00'
+            nsequence = 0 if zero_nsequence else 0xfffffffe - k
+            return outpoint + script + int.to_bytes(nsequence, 4, 'little').hex()
+
+        outputs = [self.txout1.serialize_to_network().hex(), self.txout2.serialize_to_network().hex()]
+        blank_output = 'ff' * 8 + '00'
+        for sighash, txins, txouts in [
+            (Sighash.ALL,
+             '03' + txin_ser(0, signing=False) + txin_ser(1, signing=True) + txin_ser(2, signing=False),
+             '02' + outputs[0] + outputs[1]),
+            (Sighash.NONE,
+             '03' + txin_ser(0, signing=False, zero_nsequence=True) + txin_ser(1, signing=True)
+             + txin_ser(2, signing=False, zero_nsequence=True),
+             '00'),
+            (Sighash.SINGLE,
+             '03' + txin_ser(0, signing=False, zero_nsequence=True) + txin_ser(1, signing=True)
+             + txin_ser(2, signing=False, zero_nsequence=True),
+             '02' + blank_output + outputs[1]),
+            (Sighash.ALL | Sighash.ANYONECANPAY, '01' + txin_ser(1, signing=True), '02' + outputs[0] + outputs[1]),
+            (Sighash.NONE | Sighash.ANYONECANPAY, '01' + txin_ser(1, signing=True), '00'),
+            (Sighash.SINGLE | Sighash.ANYONECANPAY, '01' + txin_ser(1, signing=True), '02' + blank_output + outputs[1]),
+        ]:
+            tx.inputs()[1].sighash = sighash
+            self.assertEqual('01000000' + txins + txouts + '00000000' + int.to_bytes(sighash, 4, 'little').hex(),
+                             tx.serialize_preimage(1, None, locking_script_overrides=overrides))
+        tx.inputs()[2].sighash = Sighash.SINGLE
+        with self.assertRaisesRegex(Exception, 'Not enough outputs for SIGHASH_SINGLE'):
+            tx.serialize_preimage(2, None, locking_script_overrides=overrides)
+
+    def test_sign_with_workers(self):
+        privkeys = [ECPrivkey(bytes([i + 1]) * 32) for i in range(2)]
+        keypairs = {pk.get_public_key_hex(compressed=True): (pk.get_secret_bytes(), True) for pk in privkeys}
+        inputs = []
+        for i in range(6):
+            pubkey = privkeys[i % 2].get_public_key_hex(compressed=True)
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i]) * 32, out_idx=i))
+            txin.script_descriptor = descriptor.get_singlesig_descriptor_from_legacy_leaf(pubkey=pubkey, script_type='p2pkh')
+            txin._trusted_value_sats = 10 ** 8
+            inputs.append(txin)
+        tx = PartialTransaction.from_io(inputs=inputs, outputs=[self.txout1, self.txout2],
+                                        locktime=self.locktime, version=1, BIP69_sort=False)
+        tx_parallel = PartialTransaction.from_io(inputs=copy.deepcopy(inputs), outputs=[self.txout1, self.txout2],
+                                                 locktime=self.locktime, version=1, BIP69_sort=False)
+        tx.sign(keypairs, None)
+        tx_parallel.sign(keypairs, None, num_workers=3)
+        self.assertTrue(tx_parallel.is_complete())
+        self.assertEqual(tx.serialize(), tx_parallel.serialize())
@@ -435,3 +435,19 @@ class TestUtil(ElectrumTestCase):
                          util.age(from_date=now.timestamp()+103012200, since_date=now))
 
 
+
+    def test_get_worker_executor(self):
+        try:
+            executor = util.get_worker_executor('test_pool', 2, processes=False)
+            self.assertIs(executor, util.get_worker_executor('test_pool', 2, processes=False))
+            self.assertEqual(4, executor.submit(pow, 2, 2).result())
+            resized = util.get_worker_executor('test_pool', 3, processes=False)
+            self.assertIsNot(executor, resized)
+            with self.assertRaises(RuntimeError):  # shut down
+                executor.submit(pow, 2, 2)
+        finally:
+            util.shutdown_worker_executors()
+        with self.assertRaises(RuntimeError):
+            resized.submit(pow, 2, 2)
+        self.assertIsNot(resized, util.get_worker_executor('test_pool', 3, processes=False))
+        util.shutdown_worker_executors()
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import os
+
+from electrum import util
 from electrum.bitcoin import hash_encode
+from electrum.crypto import sha256d
 from electrum.transaction import Transaction
 from electrum.util import bfh
-from electrum.verifier import SPV, InnerNodeOfSpvProofIsValidTx
+from electrum.verifier import (SPV, InnerNodeOfSpvProofIsValidTx, MerkleRootMismatch,
+                               verify_tx_is_in_block)
 
 from . import ElectrumTestCase
 
@@ -49,3 +55,139 @@ class VerifierTestCase(ElectrumTestCase):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+def make_merkle_tree(num_leaves: int):
+    """Returns the txids and, for each leaf, its merkle branch, and the merkle root."""
+    leaves = [os.urandom(32) for _ in range(num_leaves)]
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = level + [level[-1]]
+        levels.append([sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)])
+    branches = []
+    for pos in range(num_leaves):
+        branch = []
+        index = pos
+        for level in levels[:-1]:
+            sibling = index ^ 1
+            branch.append(hash_encode(level[sibling] if sibling < len(level) else level[index]))
+            index >>= 1
+        branches.append(branch)
+    return [hash_encode(leaf) for leaf in leaves], branches, hash_encode(levels[-1][0])
+
+
+class SharedBranchNodesTestCase(ElectrumTestCase):
+
+    def test_verify_with_shared_nodes(self):
+        txids, branches, root = make_merkle_tree(13)
+        header = {'merkle_root': root}
+        verified_nodes = {}
+        for pos, (txid, branch) in enumerate(zip(txids, branches)):
+            verify_tx_is_in_block(txid, branch, pos, header, 100, verified_nodes=verified_nodes)
+            self.assertEqual(root, SPV.hash_merkle_root(branch, txid, pos, verified_nodes=verified_nodes))
+        self.assertEqual(root, hash_encode(verified_nodes[(4, 4, 0)]))
+
+    def test_forged_branch_fails_with_shared_nodes(self):
+        txids, branches, root = make_merkle_tree(8)
+        header = {'merkle_root': root}
+        verified_nodes = {}
+        verify_tx_is_in_block(txids[0], branches[0], 0, header, 100, verified_nodes=verified_nodes)
+        num_nodes = len(verified_nodes)
+        # wrong sibling for a leaf whose parent is not verified yet
+        forged = list(branches[2])
+        forged[0] = hash_encode(os.urandom(32))
+        with self.assertRaises(MerkleRootMismatch):
+            verify_tx_is_in_block(txids[2], forged, 2, header, 100, verified_nodes=verified_nodes)
+        # unknown leaf under a verified parent
+        with self.assertRaises(MerkleRootMismatch):
+            verify_tx_is_in_block(hash_encode(os.urandom(32)), branches[1], 1, header, 100,
+                                  verified_nodes=verified_nodes)
+        # nodes of failed branches are not remembered
+        self.assertEqual(num_nodes, len(verified_nodes))
+        verify_tx_is_in_block(txids[2], branches[2], 2, header, 100, verified_nodes=verified_nodes)
+
+    def test_fake_inner_node_rejected_with_shared_nodes(self):
+        t_tx_hash = Transaction(VALID_64_BYTE_TX).txid()
+        header = {'merkle_root': MERKLE_ROOT}
+        verified_nodes = {}
+        verify_tx_is_in_block(t_tx_hash, MERKLE_BRANCH, 3, header, 100, verified_nodes=verified_nodes)
+        fake_mbranch = [hash_encode(bfh(VALID_64_BYTE_TX[:64]))] + MERKLE_BRANCH
+        f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[64:]))
+        with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+            verify_tx_is_in_block(f_tx_hash, fake_mbranch, 7, header, 100, verified_nodes=verified_nodes)
+
+
+class MockNetwork:
+
+    def __init__(self):
+        self.asyncio_loop = util.get_asyncio_loop()
+        self.interface = None
+
+    def blockchain(self):
+        return None
+
+
+class MockAddressSynchronizer:
+
+    def __init__(self):
+        self.synchronizer = None
+        self.unverified_tx = {}
+        self.unverified_asset_metadata = {}
+        self.unverified_tags_for_qualifier = {}
+        self.unverified_tags_for_h160 = {}
+        self.unverified_verifier_for_restricted = {}
+        self.unverified_freeze_for_restricted = {}
+        self.unverified_broadcast = {}
+        self.unverified_association = {}
+
+    def diagnostic_name(self):
+        return 'mock'
+
+
+class TestSPVMainLoop(ElectrumTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.adb = MockAddressSynchronizer()
+        self.spv = SPV(MockNetwork(), self.adb)
+        self.num_passes = 0
+
+        async def _maybe_undo_verifications():
+            pass
+
+        async def _request_proofs():
+            self.num_passes += 1
+        self.spv._maybe_undo_verifications = _maybe_undo_verifications
+        self.spv._request_proofs = _request_proofs
+        self.main_task = asyncio.create_task(self.spv.main())
+
+    async def asyncTearDown(self):
+        self.main_task.cancel()
+        await self.spv.stop()
+        await super().asyncTearDown()
+
+    async def test_sleeps_until_woken_up(self):
+        await asyncio.sleep(0.3)
+        self.assertEqual(1, self.num_passes)
+        self.assertTrue(self.spv.is_up_to_date())
+        # new items to verify
+        self.adb.unverified_tx['00' * 32] = 100
+        self.spv.wake_up()
+        await asyncio.sleep(0.3)
+        self.assertEqual(2, self.num_passes)
+        self.assertFalse(self.spv._up_to_date)
+        # new headers
+        util.trigger_callback('blockchain_updated')
+        await asyncio.sleep(0.3)
+        self.assertEqual(3, self.num_passes)
+        # a finished request
+        await self.spv._spawn(asyncio.sleep(0))
+        await asyncio.sleep(0.3)
+        self.assertEqual(4, self.num_passes)
+        # no longer woken up by new headers once stopped
+        await self.spv.stop()
+        util.trigger_callback('blockchain_updated')
+        await asyncio.sleep(0.3)
+        self.assertEqual(4, self.num_passes)
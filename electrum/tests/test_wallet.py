@@ -8,15 +8,17 @@ import time
 from io import StringIO
 import asyncio
 
-from electrum.storage import WalletStorage
+from electrum.storage import WalletStorage, StorageEncryptionVersion
 from electrum.wallet_db import FINAL_SEED_VERSION
 from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                              restore_wallet_from_text, Imported_Wallet, Wallet)
 from electrum.exchange_rate import ExchangeBase, FxThread
 from electrum.util import TxMinedInfo, InvalidPassword
-from electrum.bitcoin import COIN
+from electrum.bitcoin import COIN, hash160_to_p2pkh, address_to_script, script_to_scripthash
 from electrum.wallet_db import WalletDB
 from electrum.simple_config import SimpleConfig
+from electrum.address_synchronizer import AddressSynchronizer, TX_HEIGHT_LOCAL
+from electrum.transaction import Transaction, PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint
 from electrum import util
 
 from . import ElectrumTestCase
@@ -84,6 +86,362 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def _load_db(self, password=None) -> WalletDB:
+        storage = WalletStorage(self.wallet_path)
+        if password is not None:
+            storage.decrypt(password)
+        return WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+
+    def _make_db_with_change_log(self) -> WalletDB:
+        db = WalletDB('', storage=WalletStorage(self.wallet_path), manual_upgrades=False)
+        db.set_change_log_enabled(True)
+        db.load_addresses('standard')
+        labels = db.get_dict('labels')
+        for i in range(100):
+            labels[f'label{i}'] = 'x' * 100
+        db.write()
+        return db
+
+    def test_change_log_appends_and_replays(self):
+        db = self._make_db_with_change_log()
+        size = os.path.getsize(self.wallet_path)
+        labels = db.get_dict('labels')
+        labels['a'] = 'b'
+        labels.pop('label0')
+        db.get_dict('verified_tx3')['txid'] = (1, 2, 3, 'ff')
+        db.add_receiving_address('addr1')
+        db.write()
+        self.assertTrue(db.storage.has_changes())
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual(2, len(contents.split('\n\x1e')))
+        self.assertLess(os.path.getsize(self.wallet_path) - size, 1000)
+
+        db2 = self._load_db()
+        self.assertEqual(json.loads(db.dump()), json.loads(db2.dump()))
+        self.assertEqual('b', db2.get_dict('labels')['a'])
+        self.assertNotIn('label0', db2.get_dict('labels'))
+        self.assertEqual(['addr1'], db2.get('addresses')['receiving'])
+
+        # changes made before a full write are not appended again
+        db.write(compact=True)
+        self.assertFalse(db.storage.has_changes())
+        self.assertEqual(json.loads(db.dump()), json.loads(db2.dump()))
+        self.assertEqual(json.loads(db.dump()), json.loads(self._load_db().dump()))
+
+    def test_change_log_ignores_torn_record(self):
+        db = self._make_db_with_change_log()
+        db.get_dict('labels')['a'] = 'b'
+        db.write()
+        with open(self.wallet_path, "a") as f:
+            f.write('\n\x1e[{"op": "set", "pa')
+        db2 = self._load_db()
+        self.assertEqual('b', db2.get_dict('labels')['a'])
+        # the next append overwrites the torn record
+        db2.set_change_log_enabled(True)
+        db2.get_dict('labels')['c'] = 'd'
+        db2.write()
+        db3 = self._load_db()
+        self.assertEqual(('b', 'd'), (db3.get_dict('labels')['a'], db3.get_dict('labels')['c']))
+
+    def test_change_log_appends_to_crlf_snapshot(self):
+        self._make_db_with_change_log()
+        # snapshot written in text mode on Windows
+        with open(self.wallet_path, "rb") as f:
+            contents = f.read()
+        self.assertIn(b'\n', contents)
+        with open(self.wallet_path, "wb") as f:
+            f.write(contents.replace(b'\n', b'\r\n'))
+        db = self._load_db()
+        db.set_change_log_enabled(True)
+        db.get_dict('labels')['a'] = 'b'
+        db.write()
+        db.get_dict('labels')['c'] = 'd'
+        db.write()
+        self.assertTrue(db.storage.has_changes())
+        db2 = self._load_db()
+        self.assertEqual(json.loads(db.dump()), json.loads(db2.dump()))
+        self.assertEqual(('b', 'd'), (db2.get_dict('labels')['a'], db2.get_dict('labels')['c']))
+
+    def test_change_log_with_encryption(self):
+        db = self._make_db_with_change_log()
+        db.storage.set_password('secret', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        db.set_modified(True)
+        db.write()
+        db.get_dict('labels')['a'] = 'b'
+        db.write()
+        self.assertTrue(db.storage.has_changes())
+        with open(self.wallet_path, "r") as f:
+            self.assertNotIn('labels', f.read())
+        with self.assertRaises(InvalidPassword):
+            self._load_db(password='wrong')
+        db2 = self._load_db(password='secret')
+        self.assertEqual(json.loads(db.dump()), json.loads(db2.dump()))
+
+    def test_untracked_change_writes_snapshot(self):
+        db = self._make_db_with_change_log()
+        db.set_modified(True)
+        db.write()
+        self.assertFalse(db.storage.has_changes())
+        # changed in place under @modifier, without recording a path
+        with db.lock:
+            db._modified = True
+            dict.__setitem__(db.data['labels'], 'a', 'b')
+        db.write()
+        self.assertFalse(db.storage.has_changes())
+        self.assertEqual('b', self._load_db().get_dict('labels')['a'])
+
+    def test_verified_height_indexes(self):
+        db = WalletDB('', storage=WalletStorage(self.wallet_path), manual_upgrades=False)
+        db._load_assets()
+        for i in range(10):
+            txid = f'{i:064x}'
+            db.add_verified_tx(txid, TxMinedInfo(height=100 + i, timestamp=0, txpos=0, header_hash='ff'))
+            db.add_verified_restricted_verifier(f'$ASSET{i}', {
+                'tx_hash': txid, 'qualifying_tx_pos': 0, 'restricted_tx_pos': 1, 'height': 100 + i, 'string': 'true'})
+            db.add_verified_qualifier_tag('#TAG', f'{i:040x}', {
+                'tx_hash': txid, 'tx_pos': 0, 'height': 100 + i, 'flag': True})
+            db.add_verified_h160_tag(f'{i % 2:040x}', f'#TAG{i}', {
+                'tx_hash': txid, 'tx_pos': 0, 'height': 100 + i, 'flag': True})
+            db.add_verified_broadcast('ASSET', txid, {'tx_pos': 0, 'height': 100 + i, 'data': 'ff'})
+        # re-verified at a different height
+        db.add_verified_tx(f'{0:064x}', TxMinedInfo(height=120, timestamp=0, txpos=0, header_hash='ff'))
+        db.remove_verified_tx(f'{9:064x}')
+        db.remove_verified_restricted_verifier('$ASSET9')
+        db.remove_verified_qualifier_tag('#TAG', f'{9:040x}')
+
+        self.assertEqual({f'{i:064x}' for i in (0, 7, 8)}, set(db.list_verified_tx_after_height(106)))
+        self.assertEqual({'$ASSET7', '$ASSET8'}, db.get_verified_restricted_verifier_after_height(106))
+        self.assertEqual({'#TAG': {f'{7:040x}', f'{8:040x}'}}, db.get_verified_qualifier_tags_after_height(106))
+        self.assertEqual({f'{0:040x}': {'#TAG8'}, f'{1:040x}': {'#TAG7', '#TAG9'}},
+                         db.get_verified_h160_tags_after_height(106))
+        self.assertEqual({'ASSET': {f'{i:064x}' for i in (7, 8, 9)}}, db.get_verified_broadcasts_after_height(106))
+        self.assertEqual([], db.list_verified_tx_after_height(120))
+
+        # the indexes are rebuilt on load
+        db.write()
+        db2 = self._load_db()
+        db2._load_assets()
+        self.assertEqual(set(db.list_verified_tx_after_height(106)), set(db2.list_verified_tx_after_height(106)))
+        self.assertEqual(db.get_verified_h160_tags_after_height(106), db2.get_verified_h160_tags_after_height(106))
+        self.assertEqual(db.get_verified_broadcasts_after_height(106), db2.get_verified_broadcasts_after_height(106))
+
+
+class TestAddressSynchronizerCoins(WalletTestCase):
+    TESTNET = True
+
+    def setUp(self):
+        super().setUp()
+        self.ADDR = hash160_to_p2pkh(bytes(20))
+        self.OTHER_ADDR = hash160_to_p2pkh(bytes([1] * 20))
+
+    def _make_tx(self, prevouts, outputs) -> Transaction:
+        inputs = [PartialTxInput(prevout=prevout) for prevout in prevouts]
+        for txin in inputs:
+            txin.script_sig = b''
+        outputs = [PartialTxOutput.from_address_and_value(addr, value) for addr, value in outputs]
+        return Transaction(PartialTransaction.from_io(inputs, outputs, locktime=0, BIP69_sort=False).serialize())
+
+    async def test_coin_index(self):
+        db = WalletDB('', storage=None, manual_upgrades=False)
+        db._load_assets()
+        adb = AddressSynchronizer(db, self.config)
+        adb.add_address(self.ADDR)
+        tx1 = self._make_tx([TxOutpoint(bytes([2] * 32), 0)], [(self.ADDR, COIN), (self.ADDR, 2 * COIN)])
+        tx2 = self._make_tx([TxOutpoint(bytes.fromhex(tx1.txid()), 0)], [(self.OTHER_ADDR, COIN // 2)])
+        self.assertTrue(adb.add_transaction(tx1))
+        self.assertEqual(2, len(adb.get_addr_utxo(self.ADDR)))
+        self.assertEqual((0, 3 * COIN, 0), adb.get_balance([self.ADDR]))
+
+        self.assertTrue(adb.add_transaction(tx2))
+        outputs = adb.get_addr_outputs(self.ADDR)
+        spent = outputs[TxOutpoint(bytes.fromhex(tx1.txid()), 0)]
+        self.assertEqual((tx2.txid(), TX_HEIGHT_LOCAL), (spent.spent_txid, spent.spent_height))
+        self.assertEqual({TxOutpoint(bytes.fromhex(tx1.txid()), 1)}, set(adb.get_addr_utxo(self.ADDR)))
+        received, sent = adb.get_addr_io(self.ADDR)
+        self.assertEqual({f'{tx1.txid()}:0', f'{tx1.txid()}:1'}, set(received))
+        self.assertEqual({f'{tx1.txid()}:0': (tx2.txid(), TX_HEIGHT_LOCAL, -1)}, sent)
+        self.assertEqual([2 * COIN], [c.value_sats() for c in adb.get_utxos([self.ADDR])])
+
+        # heights are not cached in the index
+        adb.add_verified_tx(tx1.txid(), TxMinedInfo(height=100, timestamp=0, txpos=3, header_hash='ff'))
+        utxo = adb.get_addr_utxo(self.ADDR)[TxOutpoint(bytes.fromhex(tx1.txid()), 1)]
+        self.assertEqual((100, 3), (utxo.block_height, utxo.block_txpos))
+
+        # the index is rebuilt from the db
+        adb2 = AddressSynchronizer(db, self.config)
+        self.assertEqual(adb.get_addr_io(self.ADDR), adb2.get_addr_io(self.ADDR))
+
+        adb.remove_transaction(tx2.txid())
+        self.assertEqual(2, len(adb.get_addr_utxo(self.ADDR)))
+        adb.remove_transaction(tx1.txid())
+        self.assertEqual({}, adb.get_addr_outputs(self.ADDR))
+        self.assertEqual(({}, {}), adb.get_addr_io(self.ADDR))
+
+
+    async def test_balances(self):
+        addr2 = hash160_to_p2pkh(bytes([3] * 20))
+        db = WalletDB('', storage=None, manual_upgrades=False)
+        db._load_assets()
+        adb = AddressSynchronizer(db, self.config)
+        adb.add_address(self.ADDR)
+        adb.add_address(addr2)
+        tx1 = self._make_tx([TxOutpoint(bytes([2] * 32), 0)], [(self.ADDR, COIN), (self.ADDR, 2 * COIN)])
+        tx2 = self._make_tx([TxOutpoint(bytes.fromhex(tx1.txid()), 0)], [(addr2, COIN // 2), (self.OTHER_ADDR, COIN // 4)])
+        coinbase = self._make_tx([TxOutpoint(bytes(32), 0)], [(addr2, 5 * COIN)])
+        adb.receive_tx_callback(tx1.txid(), tx1, 100)
+        adb.receive_tx_callback(tx2.txid(), tx2, 0)
+        adb.receive_tx_callback(coinbase.txid(), coinbase, 100)
+
+        self.assertEqual((2 * COIN + COIN // 2, 0, 5 * COIN), adb.get_balance([self.ADDR, addr2]))
+        # the confirmed input of tx2 is not in the domain
+        self.assertEqual((0, COIN // 2, 5 * COIN), adb.get_balance([addr2]))
+        self.assertEqual({None}, adb.get_assets_in_mempool([self.ADDR, addr2]))
+        self.assertEqual({}, dict(adb.get_balance([self.ADDR], excluded_coins={f'{tx1.txid()}:1'}, asset_aware=True)))
+        self.assertEqual({None: (2 * COIN, 0, 0)}, dict(adb.get_balance([self.ADDR], asset_aware=True)))
+
+        # verification and maturity update the cached balances
+        adb.add_verified_tx(tx2.txid(), TxMinedInfo(height=101, timestamp=0, txpos=1, header_hash='ff'))
+        self.assertEqual((COIN // 2, 0, 5 * COIN), adb.get_balance([addr2]))
+        self.assertEqual(set(), adb.get_assets_in_mempool([self.ADDR, addr2]))
+        db.put('stored_height', 200)
+        self.assertEqual((5 * COIN + COIN // 2, 0, 0), adb.get_balance([addr2]))
+        adb.remove_transaction(tx2.txid())
+        self.assertEqual((3 * COIN, 0, 0), adb.get_balance([self.ADDR]))
+        self.assertEqual((5 * COIN, 0, 0), adb.get_balance([addr2]))
+
+    async def test_prevouts_by_scripthash(self):
+        other_scripthash = script_to_scripthash(address_to_script(self.OTHER_ADDR))
+        tx1 = self._make_tx([TxOutpoint(bytes([2] * 32), 0)], [(self.ADDR, COIN), (self.OTHER_ADDR, 2 * COIN)])
+        tx2 = self._make_tx([TxOutpoint(bytes.fromhex(tx1.txid()), 0)], [(self.OTHER_ADDR, COIN // 2)])
+        tx1_other = (TxOutpoint(bytes.fromhex(tx1.txid()), 1), 2 * COIN, None)
+        tx2_other = (TxOutpoint(bytes.fromhex(tx2.txid()), 0), COIN // 2, None)
+        db = WalletDB('', storage=None, manual_upgrades=False)
+        db._load_assets()
+        adb = AddressSynchronizer(db, self.config)
+        adb.add_address(self.ADDR)
+        # the child arrives first: it is only known to be ours once its parent is added
+        adb.add_transaction(tx2, allow_unrelated=True)
+        self.assertEqual(set(), adb.get_prevouts_by_scripthash(other_scripthash))
+        adb.add_transaction(tx1)
+        # foreign outputs are indexed only for txs the wallet funded
+        self.assertEqual({tx2_other}, adb.get_prevouts_by_scripthash(other_scripthash))
+        self.assertEqual({(TxOutpoint(bytes.fromhex(tx1.txid()), 0), COIN, None)},
+                         adb.get_prevouts_by_scripthash(script_to_scripthash(address_to_script(self.ADDR))))
+        adb2 = AddressSynchronizer(db, self.config)
+        self.assertEqual({tx2_other}, adb2.get_prevouts_by_scripthash(other_scripthash))
+        self.config.WALLET_PREVOUTS_INDEX_ALL_OUTPUTS = True
+        adb3 = AddressSynchronizer(db, self.config)
+        self.assertEqual({tx1_other, tx2_other}, adb3.get_prevouts_by_scripthash(other_scripthash))
+        adb.remove_transaction(tx2.txid())
+        self.assertEqual(set(), adb.get_prevouts_by_scripthash(other_scripthash))
+
+    def test_prevouts_by_scripthash_not_stored(self):
+        wallet_json = json.dumps({'seed_version': 1, 'prevouts_by_scripthash': {'00' * 32: [['11' * 32 + ':0', 1000, None]]}})
+        db = WalletDB(wallet_json, storage=None, manual_upgrades=False)
+        self.assertEqual(FINAL_SEED_VERSION, db.get_seed_version())
+        self.assertNotIn('prevouts_by_scripthash', json.loads(db.dump()))
+
+
+class TestGapLimitSynchronization(WalletTestCase):
+    """synchronize() must create the same addresses as the loop it replaced,
+    which re-checked the last gap_limit addresses after each new address."""
+
+    XPUB = 'zpub6nydoME6CFdJtMpzHW5BNoPz6i6XbeT9qfz72wsRqGdgGEYeivso6xjfw8cGcCyHwF7BNW4LDuHF35XrZsovBLWMF4qXSjmhTXYiHbWqGLt'
+    GAP_LIMIT = 5
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.config.NETWORK_SKIPMERKLECHECK = True
+        self.wallet = restore_wallet_from_text(self.XPUB, path=None, gap_limit=self.GAP_LIMIT, config=self.config)['wallet']
+        self.ref_wallet = restore_wallet_from_text(self.XPUB, path=None, gap_limit=self.GAP_LIMIT, config=self.config)['wallet']
+        # only the old loop may create addresses in the reference wallet,
+        # not the new synchronize() run on adb_set_up_to_date
+        self.ref_wallet.unregister_callbacks()
+        self.set_local_height(1000)
+
+    @staticmethod
+    def _old_synchronize_sequence(wallet: Abstract_Wallet, for_change: bool) -> None:
+        limit = wallet.gap_limit_for_change if for_change else wallet.gap_limit
+        while True:
+            num_addr = wallet.db.num_change_addresses() if for_change else wallet.db.num_receiving_addresses()
+            if num_addr < limit:
+                wallet.create_new_address(for_change)
+                continue
+            if for_change:
+                last_few_addresses = wallet.get_change_addresses(slice_start=-limit)
+            else:
+                last_few_addresses = wallet.get_receiving_addresses(slice_start=-limit)
+            if any(map(wallet.adb.address_is_old, last_few_addresses)):
+                wallet.create_new_address(for_change)
+            else:
+                break
+
+    def set_local_height(self, height: int) -> None:
+        for wallet in (self.wallet, self.ref_wallet):
+            wallet.db.put('stored_height', height)
+
+    def set_history(self, for_change: bool, index: int, hist) -> None:
+        for wallet in (self.wallet, self.ref_wallet):
+            addresses = wallet.get_change_addresses() if for_change else wallet.get_receiving_addresses()
+            wallet.adb.receive_history_callback(addresses[index], hist, {})
+
+    def assert_synchronized(self) -> int:
+        self.wallet.synchronize()
+        for for_change in (False, True):
+            self._old_synchronize_sequence(self.ref_wallet, for_change)
+        self.assertEqual(self.ref_wallet.get_receiving_addresses(), self.wallet.get_receiving_addresses())
+        self.assertEqual(self.ref_wallet.get_change_addresses(), self.wallet.get_change_addresses())
+        return len(self.wallet.get_receiving_addresses())
+
+    async def test_history_out_of_order(self):
+        self.assertEqual(self.GAP_LIMIT, self.assert_synchronized())
+        self.set_history(False, 4, [('01' * 32, 990)])
+        self.assertEqual(10, self.assert_synchronized())
+        self.set_history(False, 1, [('02' * 32, 980)])
+        self.assertEqual(10, self.assert_synchronized())
+        self.set_history(False, 8, [('03' * 32, 0)])
+        self.assertEqual(10, self.assert_synchronized())
+        self.set_history(False, 9, [('04' * 32, 995)])
+        self.assertEqual(15, self.assert_synchronized())
+        self.set_history(True, 3, [('05' * 32, 995)])
+        self.assert_synchronized()
+        self.assertEqual(self.wallet.gap_limit_for_change + 4, len(self.wallet.get_change_addresses()))
+
+    async def test_address_gets_old_without_new_history(self):
+        self.assertEqual(self.GAP_LIMIT, self.assert_synchronized())
+        self.set_history(False, 2, [('01' * 32, 1000)])
+        self.set_history(False, 4, [('02' * 32, 0)])
+        self.assertEqual(self.GAP_LIMIT, self.assert_synchronized())
+        # more confirmations, but no new history event
+        self.set_local_height(1001)
+        self.assertEqual(self.GAP_LIMIT, self.assert_synchronized())
+        self.set_local_height(1002)
+        self.assertEqual(8, self.assert_synchronized())
+        self.set_history(False, 4, [('02' * 32, 1002)])
+        self.assertEqual(8, self.assert_synchronized())
+        self.set_local_height(1004)
+        self.assertEqual(10, self.assert_synchronized())
+
+    async def test_reorg(self):
+        self.set_history(False, 4, [('01' * 32, 990)])
+        self.assertEqual(10, self.assert_synchronized())
+        # the tx got reorged out, and is unconfirmed again
+        self.set_local_height(985)
+        self.set_history(False, 4, [('01' * 32, 0)])
+        self.assertEqual(10, self.assert_synchronized())
+        self.set_history(False, 6, [('02' * 32, 985)])
+        self.assertEqual(10, self.assert_synchronized())
+        self.set_local_height(987)
+        self.assertEqual(12, self.assert_synchronized())
+        # mined again, lower in the chain than the address after it
+        self.set_history(False, 4, [('01' * 32, 986)])
+        self.set_local_height(990)
+        self.assertEqual(12, self.assert_synchronized())
+        self.set_history(False, 11, [('03' * 32, 980)])
+        self.assertEqual(17, self.assert_synchronized())
+
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -251,6 +609,18 @@ class TestCreateRestoreWallet(WalletTestCase):
         wallet.delete_address('bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c')
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
+    async def test_import_addresses_bulk(self):
+        addrs = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(1, 6)]
+        wallet = restore_wallet_from_text(addrs[0], path=self.wallet_path, config=self.config)['wallet']
+        good, bad = wallet.import_addresses([addrs[1], 'not an address', addrs[0], addrs[2], addrs[1]] + addrs[3:])
+        self.assertEqual(addrs[1:], good)
+        self.assertEqual(['not an address', addrs[0], addrs[1]], [addr for addr, reason in bad])
+        self.assertEqual(sorted(addrs), wallet.get_addresses())
+        self.assertEqual(set(addrs), set(wallet.adb.get_addresses()))
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), storage=storage, manual_upgrades=False)
+        self.assertEqual(sorted(addrs), sorted(db.get_dict('addresses')))
+
 
 class TestWalletPassword(WalletTestCase):
 
@@ -40,7 +40,7 @@ import itertools
 import binascii
 import copy
 
-from . import ecc, bitcoin, constants, segwit_addr, bip32
+from . import ecc, bitcoin, constants, segwit_addr, bip32, util
 from .bip32 import BIP32Node
 from .util import profiler, to_bytes, bfh, chunks, is_hex_str, parse_max_spend
 from .bitcoin import (TYPE_ADDRESS, TYPE_SCRIPT, hash_160,
@@ -253,6 +253,21 @@ class BIP143SharedTxDigestFields(NamedTuple):
     hashOutputs: str
 
 
+class LegacySharedTxDigestFields(NamedTuple):
+    # every input serialized with an empty scriptSig, each _LEGACY_EMPTY_TXIN_SIZE bytes long
+    inputs: bytes
+    # same, with nSequence zeroed, as committed to by SIGHASH_NONE and SIGHASH_SINGLE
+    inputs_zero_nsequence: bytes
+    # the output vector, including its count
+    outputs: bytes
+
+
+# outpoint, empty scriptSig, nSequence
+_LEGACY_EMPTY_TXIN_SIZE = 36 + 1 + 4
+# an output before the signed one under SIGHASH_SINGLE: value -1, empty scriptPubKey
+_LEGACY_SIGHASH_SINGLE_BLANK_TXOUT = b'\xff' * 8 + b'\x00'
+
+
 class TxOutpoint(NamedTuple):
     txid: bytes  # endianness same as hex string displayed; reverse of tx serialization order
     out_idx: int
@@ -475,23 +490,35 @@ class TxInput:
         return self.utxo is not None
 
 
+_STRUCT_INT16 = struct.Struct('<h')
+_STRUCT_UINT16 = struct.Struct('<H')
+_STRUCT_INT32 = struct.Struct('<i')
+_STRUCT_UINT32 = struct.Struct('<I')
+_STRUCT_INT64 = struct.Struct('<q')
+_STRUCT_UINT64 = struct.Struct('<Q')
+
+
 class BCDataStream(object):
     """Workalike python implementation of Bitcoin's CDataStream class."""
 
     def __init__(self):
-        self.input = None  # type: Optional[bytearray]
+        self.input = None  # type: Union[bytes, bytearray, memoryview, None]
         self.read_cursor = 0
 
     def clear(self):
         self.input = None
         self.read_cursor = 0
 
-    def write(self, _bytes: Union[bytes, bytearray]):  # Initialize with string of _bytes
-        assert isinstance(_bytes, (bytes, bytearray))
+    def write(self, _bytes: Union[bytes, bytearray, memoryview]):  # Initialize with string of _bytes
+        assert isinstance(_bytes, (bytes, bytearray, memoryview))
         if self.input is None:
-            self.input = bytearray(_bytes)
+            # bytes and memoryviews are read in place, without a copy.
+            # bytes(bytes_obj) returns the same object
+            self.input = _bytes if isinstance(_bytes, memoryview) else bytes(_bytes)
         else:
-            self.input += bytearray(_bytes)
+            if not isinstance(self.input, bytearray):
+                self.input = bytearray(self.input)
+            self.input += _bytes
 
     def read_string(self, encoding='ascii'):
         # Strings are encoded depending on length:
@@ -518,15 +545,22 @@ class BCDataStream(object):
         if self.input is None:
             raise SerializationError("call write(bytes) before trying to deserialize")
         assert length >= 0
-        input_len = len(self.input)
         read_begin = self.read_cursor
         read_end = read_begin + length
-        if 0 <= read_begin <= read_end <= input_len:
-            result = self.input[read_begin:read_end]  # type: bytearray
-            self.read_cursor += length
-            return bytes(result)
-        else:
+        if read_end > len(self.input):
+            raise SerializationError('attempt to read past end of buffer')
+        result = self.input[read_begin:read_end]
+        self.read_cursor = read_end
+        # slicing bytes already gives a new bytes object
+        return result if type(result) is bytes else bytes(result)
+
+    def skip_bytes(self, length: int) -> None:
+        if self.input is None:
+            raise SerializationError("call write(bytes) before trying to deserialize")
+        assert length >= 0
+        if self.read_cursor + length > len(self.input):
             raise SerializationError('attempt to read past end of buffer')
+        self.read_cursor += length
 
     def write_bytes(self, _bytes: Union[bytes, bytearray], length: int):
         assert len(_bytes) == length, len(_bytes)
@@ -538,34 +572,34 @@ class BCDataStream(object):
         return self.read_cursor < len(self.input)
 
     def read_boolean(self) -> bool: return self.read_bytes(1) != b'\x00'
-    def read_int16(self): return self._read_num('<h')
-    def read_uint16(self): return self._read_num('<H')
-    def read_int32(self): return self._read_num('<i')
-    def read_uint32(self): return self._read_num('<I')
-    def read_int64(self): return self._read_num('<q')
-    def read_uint64(self): return self._read_num('<Q')
+    def read_int16(self): return self._read_num(_STRUCT_INT16)
+    def read_uint16(self): return self._read_num(_STRUCT_UINT16)
+    def read_int32(self): return self._read_num(_STRUCT_INT32)
+    def read_uint32(self): return self._read_num(_STRUCT_UINT32)
+    def read_int64(self): return self._read_num(_STRUCT_INT64)
+    def read_uint64(self): return self._read_num(_STRUCT_UINT64)
 
     def write_boolean(self, val): return self.write(b'\x01' if val else b'\x00')
-    def write_int16(self, val): return self._write_num('<h', val)
-    def write_uint16(self, val): return self._write_num('<H', val)
-    def write_int32(self, val): return self._write_num('<i', val)
-    def write_uint32(self, val): return self._write_num('<I', val)
-    def write_int64(self, val): return self._write_num('<q', val)
-    def write_uint64(self, val): return self._write_num('<Q', val)
+    def write_int16(self, val): return self._write_num(_STRUCT_INT16, val)
+    def write_uint16(self, val): return self._write_num(_STRUCT_UINT16, val)
+    def write_int32(self, val): return self._write_num(_STRUCT_INT32, val)
+    def write_uint32(self, val): return self._write_num(_STRUCT_UINT32, val)
+    def write_int64(self, val): return self._write_num(_STRUCT_INT64, val)
+    def write_uint64(self, val): return self._write_num(_STRUCT_UINT64, val)
 
     def read_compact_size(self):
         try:
             size = self.input[self.read_cursor]
-            self.read_cursor += 1
-            if size == 253:
-                size = self._read_num('<H')
-            elif size == 254:
-                size = self._read_num('<I')
-            elif size == 255:
-                size = self._read_num('<Q')
-            return size
         except IndexError as e:
             raise SerializationError("attempt to read past end of buffer") from e
+        self.read_cursor += 1
+        if size < 253:
+            return size
+        if size == 253:
+            return self._read_num(_STRUCT_UINT16)
+        if size == 254:
+            return self._read_num(_STRUCT_UINT32)
+        return self._read_num(_STRUCT_UINT64)
 
     def write_compact_size(self, size):
         if size < 0:
@@ -574,27 +608,26 @@ class BCDataStream(object):
             self.write(bytes([size]))
         elif size < 2**16:
             self.write(b'\xfd')
-            self._write_num('<H', size)
+            self._write_num(_STRUCT_UINT16, size)
         elif size < 2**32:
             self.write(b'\xfe')
-            self._write_num('<I', size)
+            self._write_num(_STRUCT_UINT32, size)
         elif size < 2**64:
             self.write(b'\xff')
-            self._write_num('<Q', size)
+            self._write_num(_STRUCT_UINT64, size)
         else:
             raise Exception(f"size {size} too large for compact_size")
 
-    def _read_num(self, format):
+    def _read_num(self, fmt: struct.Struct):
         try:
-            (i,) = struct.unpack_from(format, self.input, self.read_cursor)
-            self.read_cursor += struct.calcsize(format)
+            (i,) = fmt.unpack_from(self.input, self.read_cursor)
         except Exception as e:
             raise SerializationError(e) from e
+        self.read_cursor += fmt.size
         return i
 
-    def _write_num(self, format, num):
-        s = struct.pack(format, num)
-        self.write(s)
+    def _write_num(self, fmt: struct.Struct, num):
+        self.write(fmt.pack(num))
 
 
 def script_GetOp(_bytes : bytes):
@@ -778,9 +811,11 @@ def parse_input(vds: BCDataStream) -> TxInput:
 
 
 def parse_witness(vds: BCDataStream, txin: TxInput) -> None:
-    n = vds.read_compact_size()
-    witness_elements = list(vds.read_bytes(vds.read_compact_size()) for i in range(n))
-    txin.witness = bfh(construct_witness(witness_elements))
+    # the witness is kept serialized, so take it as it is in the stream
+    witness_start = vds.read_cursor
+    for i in range(vds.read_compact_size()):
+        vds.skip_bytes(vds.read_compact_size())
+    txin.witness = bytes(vds.input[witness_start:vds.read_cursor])
 
 
 def parse_output(vds: BCDataStream) -> TxOutput:
@@ -793,6 +828,30 @@ def parse_output(vds: BCDataStream) -> TxOutput:
     return TxOutput(value=value, scriptpubkey=scriptpubkey)
 
 
+def strip_witness_from_network_ser(raw: bytes) -> bytes:
+    """Returns the legacy (txid) serialization of a network-serialized tx,
+    without parsing its inputs and outputs.
+    """
+    vds = BCDataStream()
+    vds.write(raw)
+    vds.read_int32()  # version
+    if vds.read_compact_size() != 0:
+        return raw  # no witness
+    if vds.read_bytes(1) != b'\x01':
+        raise SerializationError('invalid txn marker byte')
+    txins_start = vds.read_cursor
+    for i in range(vds.read_compact_size()):
+        vds.skip_bytes(32 + 4)  # prevout
+        vds.skip_bytes(vds.read_compact_size() + 4)  # script_sig, nsequence
+    for i in range(vds.read_compact_size()):
+        vds.skip_bytes(8)  # value
+        vds.skip_bytes(vds.read_compact_size())  # scriptpubkey
+    txouts_end = vds.read_cursor
+    if txouts_end > len(raw) - 4:
+        raise SerializationError('attempt to read past end of buffer')
+    return raw[:4] + raw[txins_start:txouts_end] + raw[-4:]
+
+
 # pay & redeem scripts
 
 def multisig_script(public_keys: Sequence[str], m: int) -> str:
@@ -804,7 +863,7 @@ def multisig_script(public_keys: Sequence[str], m: int) -> str:
 
 
 class Transaction:
-    _cached_network_ser: Optional[str]
+    _cached_network_ser: Optional[bytes]
 
     def __str__(self):
         return self.serialize()
@@ -813,10 +872,11 @@ class Transaction:
         if raw is None:
             self._cached_network_ser = None
         elif isinstance(raw, str):
-            self._cached_network_ser = raw.strip() if raw else None
-            assert is_hex_str(self._cached_network_ser)
+            raw = raw.strip()
+            assert is_hex_str(raw)
+            self._cached_network_ser = bfh(raw) if raw else None
         elif isinstance(raw, (bytes, bytearray)):
-            self._cached_network_ser = raw.hex()
+            self._cached_network_ser = bytes(raw)
         else:
             raise Exception(f"cannot initialize transaction from {raw}")
         self._inputs = None  # type: List[TxInput]
@@ -872,9 +932,8 @@ class Transaction:
         if self._inputs is not None:
             return
 
-        raw_bytes = bfh(self._cached_network_ser)
         vds = BCDataStream()
-        vds.write(raw_bytes)
+        vds.write(self._cached_network_ser)
         self._version = vds.read_int32()
         n_vin = vds.read_compact_size()
         is_segwit = (n_vin == 0)
@@ -997,6 +1056,19 @@ class Transaction:
                                           hashSequence=hashSequence,
                                           hashOutputs=hashOutputs)
 
+    def _calc_legacy_shared_txdigest_fields(self) -> LegacySharedTxDigestFields:
+        inputs = []
+        inputs_zero_nsequence = []
+        for txin in self.inputs():
+            prevout = txin.prevout.serialize_to_network()
+            inputs.append(prevout + b'\x00' + int.to_bytes(txin.nsequence, 4, byteorder="little"))
+            inputs_zero_nsequence.append(prevout + b'\x00' + bytes(4))
+        outputs = self.outputs()
+        return LegacySharedTxDigestFields(
+            inputs=b''.join(inputs),
+            inputs_zero_nsequence=b''.join(inputs_zero_nsequence),
+            outputs=bfh(var_int(len(outputs))) + b''.join(o.serialize_to_network() for o in outputs))
+
     def is_segwit(self, *, guess_for_address=False):
         return any(txin.is_segwit(guess_for_address=guess_for_address)
                    for txin in self.inputs())
@@ -1006,12 +1078,12 @@ class Transaction:
         self._cached_txid = None
 
     def serialize(self) -> str:
-        if not self._cached_network_ser:
-            self._cached_network_ser = self.serialize_to_network(estimate_size=False, include_sigs=True)
-        return self._cached_network_ser
+        return self.serialize_as_bytes().hex()
 
     def serialize_as_bytes(self) -> bytes:
-        return bfh(self.serialize())
+        if not self._cached_network_ser:
+            self._cached_network_ser = bfh(self.serialize_to_network(estimate_size=False, include_sigs=True))
+        return self._cached_network_ser
 
     def serialize_to_network(self, *, estimate_size=False, include_sigs=True, force_legacy=False) -> str:
         """Serialize the transaction as used on the Bitcoin network, into hex.
@@ -1060,6 +1132,9 @@ class Transaction:
         return base_encode(tx_bytes, base=43), is_complete
 
     def txid(self) -> Optional[str]:
+        if self._cached_txid is None and self._cached_network_ser is not None:
+            # hash the network serialization directly, skipping the witness if any
+            self._cached_txid = sha256d(strip_witness_from_network_ser(self._cached_network_ser))[::-1].hex()
         if self._cached_txid is None:
             self.deserialize()
             all_segwit = all(txin.is_segwit() for txin in self.inputs())
@@ -1210,7 +1285,7 @@ class Transaction:
         if not self.is_complete() or self._cached_network_ser is None:
             return len(self.serialize_to_network(estimate_size=True)) // 2
         else:
-            return len(self._cached_network_ser) // 2  # ASCII hex string
+            return len(self._cached_network_ser)
 
     def estimated_witness_size(self):
         """Return an estimate of witness size in bytes."""
@@ -2004,7 +2079,7 @@ class PartialTransaction(Transaction):
                     if tx is not None:
                         raise SerializationError(f"duplicate key: {repr(kt)}")
                     if key: raise SerializationError(f"key for {repr(kt)} must be empty")
-                    unsigned_tx = Transaction(val.hex())
+                    unsigned_tx = Transaction(val)
                     for txin in unsigned_tx.inputs():
                         if txin.script_sig or txin.witness:
                             raise SerializationError(f"PSBT {repr(kt)} must have empty scriptSigs and witnesses")
@@ -2183,6 +2258,7 @@ class PartialTransaction(Transaction):
 
     def serialize_preimage(self, txin_index: int, wallet: 'Abstract_Wallet', *,
                            bip143_shared_txdigest_fields: BIP143SharedTxDigestFields = None,
+                           legacy_shared_txdigest_fields: LegacySharedTxDigestFields = None,
                            locking_script_overrides = None) -> str:
         nVersion = int_to_hex(self.version, 4)
         nLocktime = int_to_hex(self.locktime, 4)
@@ -2217,42 +2293,60 @@ class PartialTransaction(Transaction):
             nSequence = int_to_hex(txin.nsequence, 4)
             preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
         else:
+            # Splice the input being signed into the pre-serialized inputs and outputs,
+            # instead of serializing all of them again for every input.
+            if legacy_shared_txdigest_fields is None:
+                legacy_shared_txdigest_fields = self._calc_legacy_shared_txdigest_fields()
+            txin_ser = txin.serialize_to_network(script_sig=bfh(preimage_script))
             if sighash & Sighash.ANYONECANPAY:
-                txins = var_int(1) + txin.serialize_to_network(script_sig=bfh(preimage_script)).hex()
+                txins = bfh(var_int(1)) + txin_ser
             else:
-                input_serializations = []
-                for k, txin in enumerate(inputs):
-                    if ((sighash & 0x1f) == Sighash.NONE or (sighash & 0x1f) == Sighash.SINGLE) and txin_index != k:
-                        txin = PartialTxInput.from_txin(txin, strip_witness=False)
-                        txin.nsequence = 0
-                    serialization = txin.serialize_to_network(script_sig=bfh(preimage_script) if txin_index==k else b"").hex()
-                    input_serializations.append(serialization)
-
-                txins = var_int(len(inputs)) + ''.join(input_serializations)
+                if (sighash & 0x1f) == Sighash.NONE or (sighash & 0x1f) == Sighash.SINGLE:
+                    other_txins = legacy_shared_txdigest_fields.inputs_zero_nsequence
+                else:
+                    other_txins = legacy_shared_txdigest_fields.inputs
+                pos = txin_index * _LEGACY_EMPTY_TXIN_SIZE
+                txins = (bfh(var_int(len(inputs))) + other_txins[:pos] + txin_ser
+                         + other_txins[pos + _LEGACY_EMPTY_TXIN_SIZE:])
 
             if (sighash & 0x1f) == Sighash.NONE:
-                txouts = var_int(0)
+                txouts = bfh(var_int(0))
             elif (sighash & 0x1f) == Sighash.SINGLE:
                 if txin_index >= len(outputs):
                     raise Exception('Not enough outputs for SIGHASH_SINGLE!')
-                output_serializations = []
-                for k, txout in enumerate(outputs):
-                    if k > txin_index: break
-                    if k < txin_index:
-                        txout = PartialTxOutput.from_txout(txout)
-                        txout.scriptpubkey = b''
-                        txout.value = (1 << 64) - 1
-                    serialization = txout.serialize_to_network().hex()
-                    output_serializations.append(serialization)
-                txouts = var_int(len(output_serializations)) + ''.join(output_serializations)
+                txouts = (bfh(var_int(txin_index + 1)) + _LEGACY_SIGHASH_SINGLE_BLANK_TXOUT * txin_index
+                          + outputs[txin_index].serialize_to_network())
             else:
-                txouts = var_int(len(outputs)) + ''.join(o.serialize_to_network().hex() for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+                txouts = legacy_shared_txdigest_fields.outputs
+            preimage = nVersion + (txins + txouts).hex() + nLocktime + nHashType
         return preimage
 
-    def sign(self, keypairs, wallet: 'Abstract_Wallet', *, locking_script_overrides=None) -> None:
+    def sign(self, keypairs, wallet: 'Abstract_Wallet', *, locking_script_overrides=None, num_workers: int = 0) -> None:
         # keypairs:  pubkey_hex -> (secret_bytes, is_compressed)
+        # num_workers > 1 (experimental): compute the signatures in a thread pool first,
+        #                  then add them in input order. Only hashing and libsecp256k1
+        #                  release the GIL; building the preimages does not, which
+        #                  limits what the extra threads can gain.
         bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        legacy_shared_txdigest_fields = self._calc_legacy_shared_txdigest_fields()
+
+        def sign_txin(txin_index, sec):
+            return self.sign_txin(txin_index, sec, wallet, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                  legacy_shared_txdigest_fields=legacy_shared_txdigest_fields,
+                                  locking_script_overrides=locking_script_overrides)
+
+        precomputed_sigs = {}  # (txin_index, pubkey_hex) -> sig
+        if num_workers > 1:
+            executor = util.get_worker_executor('tx_signing', num_workers, processes=False)
+            futures = {}
+            for i, txin in enumerate(self.inputs()):
+                if txin.is_complete():
+                    continue
+                for pubkey in [pk.hex() for pk in txin.pubkeys]:
+                    if pubkey in keypairs:
+                        futures[(i, pubkey)] = executor.submit(sign_txin, i, keypairs[pubkey][0])
+            precomputed_sigs = {k: fut.result() for k, fut in futures.items()}
+
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             for pubkey in pubkeys:
@@ -2262,18 +2356,21 @@ class PartialTransaction(Transaction):
                     continue
                 _logger.info(f"adding signature for {pubkey}. spending utxo {txin.prevout.to_str()}")
                 sec, compressed = keypairs[pubkey]
-                sig = self.sign_txin(i, sec, wallet, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields, locking_script_overrides=locking_script_overrides)
+                sig = precomputed_sigs.get((i, pubkey)) or sign_txin(i, sec)
                 self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
 
         _logger.debug(f"is_complete {self.is_complete()}")
         self.invalidate_ser_cache()
 
-    def sign_txin(self, txin_index, privkey_bytes, wallet: 'Abstract_Wallet', *, bip143_shared_txdigest_fields=None, locking_script_overrides=None) -> str:
+    def sign_txin(self, txin_index, privkey_bytes, wallet: 'Abstract_Wallet', *, bip143_shared_txdigest_fields=None,
+                  legacy_shared_txdigest_fields=None, locking_script_overrides=None) -> str:
         txin = self.inputs()[txin_index]
         txin.validate_data(for_signing=True)
         sighash = txin.sighash if txin.sighash is not None else Sighash.ALL
         pre_hash = sha256d(bfh(self.serialize_preimage(txin_index, wallet,
-                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields, locking_script_overrides=locking_script_overrides)))
+                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields,
+                                                       legacy_shared_txdigest_fields=legacy_shared_txdigest_fields,
+                                                       locking_script_overrides=locking_script_overrides)))
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = sig.hex() + Sighash.to_sigbytes(sighash).hex()
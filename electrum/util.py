@@ -22,6 +22,7 @@
 # SOFTWARE.
 import binascii
 import concurrent.futures
+import multiprocessing
 import os, sys, re, json
 from collections import defaultdict, OrderedDict
 from typing import (
@@ -1709,6 +1710,39 @@ def get_asyncio_loop() -> asyncio.AbstractEventLoop:
     raise Exception("event loop not created yet")
 
 
+_worker_executors = {}  # type: Dict[str, Tuple[int, concurrent.futures.Executor]]
+_worker_executors_lock = threading.Lock()
+
+
+def get_worker_executor(name: str, num_workers: int, *, processes: bool) -> concurrent.futures.Executor:
+    """Returns the shared executor called name, (re)created if it does not have
+    num_workers workers. Process pools need multiprocessing.freeze_support()
+    to have been called by the entry point of frozen builds.
+    """
+    with _worker_executors_lock:
+        workers, executor = _worker_executors.get(name, (0, None))
+        if executor is None or workers != num_workers:
+            if executor is not None:
+                executor.shutdown(wait=False)
+            if processes:
+                # 'spawn': forking a process that runs an event loop and other threads is not safe
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=num_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=num_workers, thread_name_prefix=name)
+            _worker_executors[name] = num_workers, executor
+        return executor
+
+
+def shutdown_worker_executors() -> None:
+    with _worker_executors_lock:
+        for workers, executor in _worker_executors.values():
+            executor.shutdown(wait=False)
+        _worker_executors.clear()
+
+
 def create_and_start_event_loop() -> (
     Tuple[asyncio.AbstractEventLoop, asyncio.Future, threading.Thread]
 ):
@@ -2235,28 +2269,6 @@ def error_text_bytes_to_safe_str(err: bytes) -> str:
     return repr(ascii_text)
 
 
-class ByteReader:
-    def __init__(self, data: bytes):
-        self.data = data
-        self.cursor = 0
-
-    def read_bytes(self, length: int) -> bytes:
-        if length > len(self.data) - self.cursor:
-            raise IndexError(
-                f"Out of bounds {self.cursor} -> {length} ({len(self.data)})"
-            )
-        b = self.data[self.cursor : self.cursor + length]
-        self.cursor += length
-        return b
-
-    def read_byte_as_int(self) -> int:
-        b = self.read_bytes(1)
-        return b[0]
-
-    def can_read_amount(self, length: int) -> bool:
-        return length <= len(self.data) - self.cursor
-
-
 class SearchableListGrouping:
     def __init__(self, *args):
         self.lists = args
@@ -23,11 +23,12 @@
 
 import asyncio
 import re
-from typing import Sequence, Optional, TYPE_CHECKING, Tuple
+from collections import defaultdict
+from typing import Sequence, Optional, TYPE_CHECKING, Tuple, Dict, List
 
 import aiorpcx
 
-from .util import TxMinedInfo, NetworkJobOnDefaultServer
+from .util import TxMinedInfo, NetworkJobOnDefaultServer, register_callback, unregister_callback
 from .crypto import sha256d
 from .asset import (get_asset_info_from_script, StrictAssetMetadata, AssetException, MetadataAssetVoutInformation, OwnerAssetVoutInformation,
                     AssetVoutType)
@@ -53,27 +54,65 @@ class SPV(NetworkJobOnDefaultServer):
 
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
+        self.asyncio_loop = network.asyncio_loop
         NetworkJobOnDefaultServer.__init__(self, network)
+        # new headers can make pending proofs requestable, or be a reorg
+        register_callback(self._on_blockchain_updated, ['blockchain_updated'])
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
         self.verifying = set()
+        self._up_to_date = False
+        # set when there might be new work for the main loop, or the up-to-date state might have changed
+        self._main_loop_wakeup = asyncio.Event()
 
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
         async with taskgroup as group:
             await group.spawn(self.main)
 
+    async def stop(self, *, full_shutdown: bool = True):
+        if full_shutdown:
+            unregister_callback(self._on_blockchain_updated)
+        await super().stop(full_shutdown=full_shutdown)
+
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    def wake_up(self) -> None:
+        """Makes the main loop look for new work and re-check whether we are up to date.
+        Can be called from any thread.
+        """
+        self.asyncio_loop.call_soon_threadsafe(self._main_loop_wakeup.set)
+
+    def _on_blockchain_updated(self, *args) -> None:
+        self.wake_up()
+
+    async def _spawn(self, coro):
+        """Spawns coro in our taskgroup, and wakes up the main loop once it is done."""
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                self._main_loop_wakeup.set()
+        return await self.taskgroup.spawn(wrapper())
+
     async def main(self):
         self.blockchain = self.network.blockchain()
         while True:
+            self._main_loop_wakeup.clear()
             await self._maybe_undo_verifications()
             await self._request_proofs()
+            # the synchronizer only re-checks whether the wallet is up to date when woken up
+            up_to_date = self.is_up_to_date()
+            if up_to_date != self._up_to_date:
+                self._up_to_date = up_to_date
+                if self.wallet.synchronizer:
+                    self.wallet.synchronizer.wake_up()
+            # sleep until something happens, like the synchronizer does
+            await self._main_loop_wakeup.wait()
             await asyncio.sleep(0.1)
 
     async def wait_and_verify_transitory_transactions(self, txs: Sequence[Tuple[str, int]]):
@@ -116,7 +155,7 @@ class SPV(NetworkJobOnDefaultServer):
         if header is None:
             if tx_height < constants.net.max_checkpoint():
                 # FIXME these requests are not counted (self._requests_sent += 1)
-                await self.taskgroup.spawn(self.interface.request_chunk(tx_height, None, can_return_early=True))
+                await self._spawn(self.interface.request_chunk(tx_height, None, can_return_early=True))
             return True
         # request now
         if add_to_requested_set:
@@ -125,9 +164,14 @@ class SPV(NetworkJobOnDefaultServer):
 
     async def _request_proofs(self):
         unverified = self.wallet.get_unverified_txs()
+        txs_by_height = defaultdict(list)  # type: Dict[int, List[str]]
         for tx_hash, tx_height in unverified.items():
             if await self._maybe_defer(tx_hash, tx_height, for_tx=True): continue
-            await self.taskgroup.spawn(self._verify_unverified_transaction, tx_hash, tx_height)
+            txs_by_height[tx_height].append(tx_hash)
+        batch_size = max(1, self.network.config.NETWORK_MERKLE_BATCH_SIZE)
+        for tx_height, tx_hashes in txs_by_height.items():
+            for i in range(0, len(tx_hashes), batch_size):
+                await self._spawn(self._verify_unverified_transactions(tx_height, tx_hashes[i:i + batch_size]))
 
         unverified_assets = self.wallet.get_unverified_asset_metadatas()
         for asset, (metadata, source_tuple, divisions_tuple, associated_data_tuple) in unverified_assets.items():
@@ -145,7 +189,7 @@ class SPV(NetworkJobOnDefaultServer):
                 if await self._maybe_defer(source_txid, source_height, add_to_requested_set=False, alt_id=verifying_id): continue
             self.logger.info(f'attempting to verify {asset}')
             self.verifying.add(verifying_id)
-            await self.taskgroup.spawn(self._verify_unverified_asset_metadata(asset, metadata, source_tuple, divisions_tuple, associated_data_tuple, verifying_id))
+            await self._spawn(self._verify_unverified_asset_metadata(asset, metadata, source_tuple, divisions_tuple, associated_data_tuple, verifying_id))
                 
         unverified_tags_for_qualifier = self.wallet.get_unverified_tags_for_qualifier()
         for asset, h160_dict in unverified_tags_for_qualifier.items():
@@ -157,7 +201,7 @@ class SPV(NetworkJobOnDefaultServer):
                 if await self._maybe_defer(txid, height, add_to_requested_set=False, alt_id=verifying_id): continue
                 self.logger.info(f'attempting to verify tag for {asset}, {h160}')
                 self.verifying.add(verifying_id)
-                await self.taskgroup.spawn(self._verify_unverified_tags_for_qualifier(asset, h160, d, verifying_id))
+                await self._spawn(self._verify_unverified_tags_for_qualifier(asset, h160, d, verifying_id))
 
         unverified_tags_for_h160 = self.wallet.get_unverified_tags_for_h160()
         for h160, asset_dict in unverified_tags_for_h160.items():
@@ -169,7 +213,7 @@ class SPV(NetworkJobOnDefaultServer):
                 if await self._maybe_defer(txid, height, add_to_requested_set=False, alt_id=verifying_id): continue
                 self.logger.info(f'attempting to verify tag for {h160}, {asset}')
                 self.verifying.add(verifying_id)
-                await self.taskgroup.spawn(self._verify_unverified_tags_for_h160(h160, asset, d, verifying_id))
+                await self._spawn(self._verify_unverified_tags_for_h160(h160, asset, d, verifying_id))
 
         unverified_resticted_verifiers = self.wallet.get_unverified_restricted_verifier_strings()
         for asset, d in unverified_resticted_verifiers.items():
@@ -180,7 +224,7 @@ class SPV(NetworkJobOnDefaultServer):
             if await self._maybe_defer(txid, height, add_to_requested_set=False, alt_id=verifying_id): continue
             self.logger.info(f'attempting to verify restricted verifier for {asset}: {d["string"]}')
             self.verifying.add(verifying_id)
-            await self.taskgroup.spawn(self._verify_unverified_restricted_verifier(asset, d, verifying_id))
+            await self._spawn(self._verify_unverified_restricted_verifier(asset, d, verifying_id))
 
         unverified_resticted_freezes = self.wallet.get_unverified_restricted_freezes()
         for asset, d in unverified_resticted_freezes.items():
@@ -191,7 +235,7 @@ class SPV(NetworkJobOnDefaultServer):
             if await self._maybe_defer(txid, height, add_to_requested_set=False, alt_id=verifying_id): continue
             self.logger.info(f'attempting to verify restricted freeze for {asset}: {d["frozen"]}')
             self.verifying.add(verifying_id)
-            await self.taskgroup.spawn(self._verify_unverified_restricted_freeze(asset, d, verifying_id))
+            await self._spawn(self._verify_unverified_restricted_freeze(asset, d, verifying_id))
 
         unverified_broadcasts = self.wallet.get_unverified_broadcasts()
         for asset, d1 in unverified_broadcasts.items():
@@ -202,7 +246,7 @@ class SPV(NetworkJobOnDefaultServer):
                 if await self._maybe_defer(tx_hash, height, add_to_requested_set=False, alt_id=verifying_id): continue
                 self.logger.info(f'attempting to verify broadcast for {asset}: {tx_hash}')
                 self.verifying.add(verifying_id)
-                await self.taskgroup.spawn(self._verify_unverified_broadcast(asset, tx_hash, d2, verifying_id))
+                await self._spawn(self._verify_unverified_broadcast(asset, tx_hash, d2, verifying_id))
 
         unverified_associations = self.wallet.get_unverified_associations()
         for asset, d1 in unverified_associations.items():
@@ -214,7 +258,7 @@ class SPV(NetworkJobOnDefaultServer):
                 if await self._maybe_defer(tx_hash, height, add_to_requested_set=False, alt_id=verifying_id): continue
                 self.logger.info(f'attempting to verify association for {asset}: {res}')
                 self.verifying.add(verifying_id)
-                await self.taskgroup.spawn(self._verify_unverified_association(asset, res, d2, verifying_id))
+                await self._spawn(self._verify_unverified_association(asset, res, d2, verifying_id))
 
 
     async def _internal_verify_unverified_association(self, asset, res, d):
@@ -651,30 +695,58 @@ class SPV(NetworkJobOnDefaultServer):
         self.wallet.add_verified_tx(tx_hash, tx_info)
 
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height, *, quick_return=False):
-        if quick_return and (tx_hash in self.merkle_roots or self.wallet.db.get_verified_tx(tx_hash)):
-            return
-        self.logger.info(f'requesting merkle {tx_hash}')
+    async def _verify_unverified_transactions(self, tx_height: int, tx_hashes: Sequence[str]):
+        """Verifies txs expected at the same height, with one batch request for their proofs."""
+        if len(tx_hashes) == 1:
+            return await self._verify_unverified_transaction(tx_hashes[0], tx_height)
+        self.logger.info(f'requesting {len(tx_hashes)} merkles at height {tx_height}')
         try:
-            self._requests_sent += 1
+            self._requests_sent += len(tx_hashes)
             async with self._network_request_semaphore:
-                merkle = await self.interface.get_merkle_for_transaction(tx_hash, tx_height)
+                merkles = await self.interface.get_merkles_for_transactions(tx_hashes, tx_height)
         finally:
-            self.requested_merkle.discard(tx_hash)
-            self._requests_answered += 1
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
+            for tx_hash in tx_hashes:
+                self.requested_merkle.discard(tx_hash)
+            self._requests_answered += len(tx_hashes)
+        headers = {}  # block height -> header
+        verified_nodes = {}  # block height -> nodes of the verified branches in that block
+        for tx_hash, merkle in zip(tx_hashes, merkles):
+            if isinstance(merkle, aiorpcx.jsonrpc.RPCError):
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                continue
+            if isinstance(merkle, Exception):
+                raise merkle
+            block_height = merkle.get('block_height')
+            if block_height not in headers:
+                headers[block_height] = await self._read_header(block_height)
+            header = headers[block_height]
+            pos = self._verify_merkle(tx_hash, tx_height, merkle, header,
+                                      verified_nodes=verified_nodes.setdefault(block_height, {}))
+            tx_info = TxMinedInfo(height=tx_height,
+                                  timestamp=header.get('timestamp'),
+                                  txpos=pos,
+                                  header_hash=hash_header(header))
+            self.wallet.add_verified_tx(tx_hash, tx_info)
+
+    async def _read_header(self, height: int) -> Optional[dict]:
+        # we need to wait if header sync/reorg is still ongoing, hence lock:
+        async with self.network.bhi_lock:
+            return self.network.blockchain().read_header(height)
+
+    def _verify_merkle(self, tx_hash: str, tx_height: int, merkle: dict, header: Optional[dict], *,
+                       verified_nodes: Dict[Tuple[int, int, int], bytes] = None) -> int:
+        """Verifies the hash of the server-provided merkle branch to a
+        transaction matches the merkle root of its block. Returns the tx position.
+        """
         if tx_height != merkle.get('block_height'):
             self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
                              .format(tx_height, merkle.get('block_height'), tx_hash))
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
         merkle_branch = merkle.get('merkle')
-        # we need to wait if header sync/reorg is still ongoing, hence lock:
-        async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
         try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
+            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height, verified_nodes=verified_nodes)
         except MerkleVerificationFailure as e:
             if self.network.config.NETWORK_SKIPMERKLECHECK:
                 self.logger.info(f"skipping merkle proof check {tx_hash}")
@@ -683,13 +755,34 @@ class SPV(NetworkJobOnDefaultServer):
                 raise GracefulDisconnect(e) from e
         # we passed all the tests
         self.merkle_roots[tx_hash] = header.get('merkle_root')
-        self.logger.info(f"verified {tx_hash}")    
+        self.logger.info(f"verified {tx_hash}")
+        return pos
 
+    async def _request_and_verify_single_proof(self, tx_hash, tx_height, *, quick_return=False):
+        if quick_return and (tx_hash in self.merkle_roots or self.wallet.db.get_verified_tx(tx_hash)):
+            return
+        self.logger.info(f'requesting merkle {tx_hash}')
+        try:
+            self._requests_sent += 1
+            async with self._network_request_semaphore:
+                merkle = await self.interface.get_merkle_for_transaction(tx_hash, tx_height)
+        finally:
+            self.requested_merkle.discard(tx_hash)
+            self._requests_answered += 1
+        header = await self._read_header(merkle.get('block_height'))
+        pos = self._verify_merkle(tx_hash, tx_height, merkle, header)
         return pos, header
         
     @classmethod
-    def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
-        """Return calculated merkle root."""
+    def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int, *,
+                         verified_nodes: Dict[Tuple[int, int, int], bytes] = None,
+                         computed_nodes: Dict[Tuple[int, int, int], bytes] = None):
+        """Return calculated merkle root.
+        Nodes are keyed by (branch length, level above the leaves, index in level).
+        If verified_nodes is given, hashing stops at the first node that is in it: the
+        rest of the branch was already hashed and checked, and its root is returned.
+        The nodes hashed here are added to computed_nodes, if given.
+        """
         try:
             h = hash_decode(tx_hash)
             merkle_branch_bytes = [hash_decode(item) for item in merkle_branch]
@@ -698,14 +791,19 @@ class SPV(NetworkJobOnDefaultServer):
             raise MerkleVerificationFailure(e)
         if leaf_pos_in_tree < 0:
             raise MerkleVerificationFailure('leaf_pos_in_tree must be non-negative')
+        depth = len(merkle_branch_bytes)
         index = leaf_pos_in_tree
-        for item in merkle_branch_bytes:
+        for level, item in enumerate(merkle_branch_bytes, start=1):
             if len(item) != 32:
                 raise MerkleVerificationFailure('all merkle branch items have to 32 bytes long')
             inner_node = (item + h) if (index & 1) else (h + item)
             cls._raise_if_valid_tx(inner_node.hex())
             h = sha256d(inner_node)
             index >>= 1
+            if verified_nodes and verified_nodes.get((depth, level, index)) == h:
+                return hash_encode(verified_nodes[(depth, depth, 0)])
+            if computed_nodes is not None:
+                computed_nodes[(depth, level, index)] = h
         if index != 0:
             raise MerkleVerificationFailure(f'leaf_pos_in_tree too large for branch')
         return hash_encode(h)
@@ -763,14 +861,22 @@ class SPV(NetworkJobOnDefaultServer):
 
 def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
                           leaf_pos_in_tree: int, block_header: Optional[dict],
-                          block_height: int) -> None:
-    """Raise MerkleVerificationFailure if verification fails."""
+                          block_height: int, *,
+                          verified_nodes: Dict[Tuple[int, int, int], bytes] = None) -> None:
+    """Raise MerkleVerificationFailure if verification fails.
+    verified_nodes: inner nodes of the branches already verified against this block.
+    It is shared between calls for the same block, and extended with the nodes of this branch.
+    """
     if not block_header:
         raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
                                  .format(tx_hash, block_height))
     if len(merkle_branch) > 30:
         raise MerkleVerificationFailure(f"merkle branch too long: {len(merkle_branch)}")
-    calc_merkle_root = SPV.hash_merkle_root(merkle_branch, tx_hash, leaf_pos_in_tree)
+    computed_nodes = {} if verified_nodes is not None else None
+    calc_merkle_root = SPV.hash_merkle_root(merkle_branch, tx_hash, leaf_pos_in_tree,
+                                            verified_nodes=verified_nodes, computed_nodes=computed_nodes)
     if block_header.get('merkle_root') != calc_merkle_root:
         raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
             tx_hash, block_header.get('merkle_root'), calc_merkle_root))
+    if verified_nodes is not None:
+        verified_nodes.update(computed_nodes)
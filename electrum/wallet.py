@@ -68,7 +68,7 @@ from .asset import (get_asset_info_from_script, parse_verifier_string, generate_
                     TransferAssetVoutInformation, AssetMemo)
 from .crypto import sha256d
 from . import keystore
-from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithMPK,
+from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithMPK, Software_KeyStore,
                        AddressIndexGeneric, CannotDerivePubkey)
 from .util import multisig_type, parse_max_spend
 from .storage import StorageEncryptionVersion, WalletStorage
@@ -350,6 +350,7 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         Logger.__init__(self)
 
         self.network = None
+        db.set_change_log_enabled(config.WALLET_DB_CHANGE_LOG)
         self.adb = AddressSynchronizer(db, config, name=self.diagnostic_name())
         for addr in self.get_addresses():
             self.adb.add_address(addr)
@@ -421,9 +422,9 @@ class Abstract_Wallet(ABC, Logger, EventListener):
             #       have history that are mined and SPV-verified.
             await run_in_thread(self.synchronize)
 
-    def save_db(self):
+    def save_db(self, *, compact: bool = False):
         if self.db.storage:
-            self.db.write()
+            self.db.write(compact=compact)
 
     def save_backup(self, backup_dir):
         new_path = os.path.join(backup_dir, self.basename() + '.backup')
@@ -488,7 +489,8 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         finally:  # even if we get cancelled
             if any([ks.is_requesting_to_be_rewritten_to_wallet_file for ks in self.get_keystores()]):
                 self.save_keystore()
-            self.save_db()
+            # leave a plain snapshot on disk
+            self.save_db(compact=True)
 
     def is_up_to_date(self) -> bool:
         if self.taskgroup.joined:  # either stop() was called, or the taskgroup died
@@ -1318,7 +1320,7 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         with self.lock, self.transaction_lock:
             for invoice_scriptpubkey, invoice_amt in invoice_amounts.items():
                 scripthash = bitcoin.script_to_scripthash(invoice_scriptpubkey.hex())
-                prevouts_and_values = self.db.get_prevouts_by_scripthash(scripthash)
+                prevouts_and_values = self.adb.get_prevouts_by_scripthash(scripthash)
                 confs_and_values = []
                 for prevout, v, asset_stringified in prevouts_and_values:
                     relevant_txs.add(prevout.txid.hex())
@@ -2683,8 +2685,10 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         txout.is_change = self.is_change(address)
         self._add_txinout_derivation_info(txout, address, only_der_suffix=only_der_suffix)
 
-    def sign_transaction(self, tx: Transaction, password) -> Optional[PartialTransaction]:
-        """ returns tx if successful else None """
+    def sign_transaction(self, tx: Transaction, password, *, num_workers: int = None) -> Optional[PartialTransaction]:
+        """ returns tx if successful else None
+        num_workers: threads used by software keystores to sign the inputs, defaults to the config
+        """
         if self.is_watching_only():
             return
         if not isinstance(tx, PartialTransaction):
@@ -2696,6 +2700,8 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         if swap:
             self.lnworker.swap_manager.sign_tx(tx, swap)
             return tx
+        if num_workers is None:
+            num_workers = self.config.WALLET_SIGNING_WORKERS
         # add info to a temporary tx copy; including xpubs
         # and full derivation paths as hw keystores might want them
         tmp_tx = copy.deepcopy(tx)
@@ -2706,7 +2712,11 @@ class Abstract_Wallet(ABC, Logger, EventListener):
         #       to see if the user connected/disconnected devices in the meantime.
         for k in sorted(self.get_keystores(), key=lambda ks: ks.ready_to_sign(), reverse=True):
             try:
-                if k.can_sign(tmp_tx):
+                if not k.can_sign(tmp_tx):
+                    continue
+                if isinstance(k, Software_KeyStore):
+                    k.sign_transaction(tmp_tx, password, self, num_workers=num_workers)
+                else:
                     k.sign_transaction(tmp_tx, password, self)
             except UserCancelled:
                 continue
@@ -3433,16 +3443,18 @@ class Imported_Wallet(Simple_Wallet):
                          write_to_disk=True) -> Tuple[List[str], List[Tuple[str, str]]]:
         good_addr = []  # type: List[str]
         bad_addr = []  # type: List[Tuple[str, str]]
+        new_addrs = {}  # type: Dict[str, dict]
         for address in addresses:
             if not bitcoin.is_address(address):
                 bad_addr.append((address, _('invalid address')))
                 continue
-            if self.db.has_imported_address(address):
+            if address in new_addrs or self.db.has_imported_address(address):
                 bad_addr.append((address, _('address already in wallet')))
                 continue
             good_addr.append(address)
-            self.db.add_imported_address(address, {})
-            self.adb.add_address(address)
+            new_addrs[address] = {}
+        self.db.add_imported_addresses(new_addrs)
+        self.adb.add_addresses(good_addr)
         if write_to_disk:
             self.save_db()
         return good_addr, bad_addr
@@ -3530,6 +3542,7 @@ class Imported_Wallet(Simple_Wallet):
                             write_to_disk=True) -> Tuple[List[str], List[Tuple[str, str]]]:
         good_addr = []  # type: List[str]
         bad_keys = []  # type: List[Tuple[str, str]]
+        new_addrs = {}  # type: Dict[str, dict]
         for key in keys:
             try:
                 txin_type, pubkey = self.keystore.import_privkey(key, password)
@@ -3541,8 +3554,9 @@ class Imported_Wallet(Simple_Wallet):
                 continue
             addr = bitcoin.pubkey_to_address(txin_type, pubkey)
             good_addr.append(addr)
-            self.db.add_imported_address(addr, {'type':txin_type, 'pubkey':pubkey})
-            self.adb.add_address(addr)
+            new_addrs[addr] = {'type':txin_type, 'pubkey':pubkey}
+        self.db.add_imported_addresses(new_addrs)
+        self.adb.add_addresses(good_addr)
         self.save_keystore()
         if write_to_disk:
             self.save_db()
@@ -3602,6 +3616,10 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def __init__(self, db, *, config):
         self._ephemeral_addr_to_addr_index = {}  # type: Dict[str, Sequence[int]]
+        # per chain (for_change): index of the last address known to be old,
+        # and indexes of later addresses that have history but were not old yet
+        self._last_old_address_index = {}  # type: Dict[bool, int]
+        self._maybe_old_address_indexes = {}  # type: Dict[bool, Set[int]]
         Abstract_Wallet.__init__(self, db, config=config)
         self.gap_limit = db.get('gap_limit', 20)
         # generate addresses now. note that without libsecp this might block
@@ -3720,35 +3738,71 @@ class Deterministic_Wallet(Abstract_Wallet):
             txinout.bip32_paths[pubkey] = (fp_bytes, der_full)
 
     def create_new_address(self, for_change: bool = False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change: bool, count: int) -> Sequence[str]:
         assert type(for_change) is bool
         with self.lock:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(int(for_change), n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.adb.add_address(address)
+            num_workers = self.config.WALLET_DERIVATION_WORKERS
+            for ks in self.get_keystores():
+                if isinstance(ks, keystore.Xpub):
+                    ks.derive_pubkey_range(int(for_change), n, count, num_workers=num_workers)
+            addresses = [self.derive_address(int(for_change), i) for i in range(n, n + count)]
+            for address in addresses:
+                self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.adb.add_address(address)
             if for_change:
                 # note: if it's actually "old", it will get filtered later
-                self._not_old_change_addresses.append(address)
-            return address
+                self._not_old_change_addresses.extend(addresses)
+            return addresses
+
+    def _get_last_old_address_index(self, for_change: bool) -> int:
+        """Returns the index of the last address of the chain that is old, or -1.
+        Only addresses that got history since the last call are checked.
+        """
+        with self.lock:
+            if for_change not in self._last_old_address_index:
+                addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+                self._last_old_address_index[for_change] = -1
+                self._maybe_old_address_indexes[for_change] = {
+                    i for i, addr in enumerate(addresses) if self.db.get_addr_history(addr)}
+            last_old = self._last_old_address_index[for_change]
+            maybe_old = self._maybe_old_address_indexes[for_change]
+            for i in sorted(maybe_old, reverse=True):
+                if i <= last_old:
+                    break
+                if for_change:
+                    addr = self.db.get_change_addresses(slice_start=i, slice_stop=i + 1)[0]
+                else:
+                    addr = self.db.get_receiving_addresses(slice_start=i, slice_stop=i + 1)[0]
+                if self.adb.address_is_old(addr):
+                    last_old = i
+                    break
+            self._last_old_address_index[for_change] = last_old
+            self._maybe_old_address_indexes[for_change] = {i for i in maybe_old if i > last_old}
+            return last_old
+
+    @event_listener
+    def on_event_adb_addr_history_updated(self, adb, addr: str):
+        if adb != self.adb:
+            return
+        addr_index = self.db.get_address_index(addr)
+        if addr_index is None:
+            return
+        for_change, n = bool(addr_index[0]), addr_index[1]
+        with self.lock:
+            if for_change in self._maybe_old_address_indexes:
+                self._maybe_old_address_indexes[for_change].add(n)
 
     def synchronize_sequence(self, for_change: bool) -> int:
-        count = 0  # num new addresses we generated
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
-            num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            if num_addr < limit:
-                count += 1
-                self.create_new_address(for_change)
-                continue
-            if for_change:
-                last_few_addresses = self.get_change_addresses(slice_start=-limit)
-            else:
-                last_few_addresses = self.get_receiving_addresses(slice_start=-limit)
-            if any(map(self.adb.address_is_old, last_few_addresses)):
-                count += 1
-                self.create_new_address(for_change)
-            else:
-                break
+        num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
+        # there must be at least 'limit' addresses after the last old one
+        count = max(limit, self._get_last_old_address_index(for_change) + 1 + limit) - num_addr
+        if count <= 0:
+            return 0
+        self.create_new_addresses(for_change, count)
         return count
 
     def synchronize(self):
@@ -32,6 +32,7 @@ from collections import defaultdict
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union, Any
 import binascii
 import time
+from bisect import bisect_left, insort
 
 import attr
 
@@ -54,7 +55,7 @@ from .atomic_swap import AtomicSwap
 
 # seed_version is now used for the version of the wallet file
 
-FINAL_SEED_VERSION = 1
+FINAL_SEED_VERSION = 2
 
 @stored_in('tx_fees', tuple)
 class TxFeesValue(NamedTuple):
@@ -83,9 +84,44 @@ class DBMetadata(StoredObject):
 #       separate tracking issues
 class WalletFileExceptionVersion51(WalletFileException): pass
 
+
+class HeightIndex:
+    """In-memory secondary index of a verified collection, ordered by block height,
+    so that the entries above a given height can be found without a full scan.
+    Keys are strings, or tuples of strings for nested collections.
+    """
+
+    def __init__(self):
+        self._heights = {}  # type: Dict[Any, int]
+        self._entries = []  # type: List[Tuple[int, Any]]  # sorted (height, key)
+
+    def add(self, key, height: int) -> None:
+        self.remove(key)
+        self._heights[key] = height
+        insort(self._entries, (height, key))
+
+    def remove(self, key) -> None:
+        height = self._heights.pop(key, None)
+        if height is None:
+            return
+        i = bisect_left(self._entries, (height, key))
+        assert self._entries[i] == (height, key)
+        del self._entries[i]
+
+    def keys_after_height(self, height: int) -> List[Any]:
+        i = bisect_left(self._entries, (height + 1,))
+        return [key for _, key in self._entries[i:]]
+
+    def clear(self) -> None:
+        self._heights.clear()
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._heights)
+
+
 # register dicts that require value conversions not handled by constructor
 json_db.register_dict('transactions', lambda x: tx_from_any(x, deserialize=False), None)
-json_db.register_dict('prevouts_by_scripthash', lambda x: set(tuple(k) for k in x), None)
 json_db.register_dict('data_loss_protect_remote_pcp', lambda x: bytes.fromhex(x), None)
 json_db.register_dict('verified_asset_metadata', lambda metadata, tup1, tup2, tup3: (
                 StrictAssetMetadata(**metadata),
@@ -202,11 +238,20 @@ class WalletDB(JsonDB):
             raise Exception("'after_upgrade_tasks' must NOT be called before 'upgrade'")
         
         # Upgrades go here
-        
+        self._convert_version_2()
+
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
 
         self._after_upgrade_tasks()
 
+    def _convert_version_2(self):
+        if not self._is_upgrade_method_needed(1, 1):
+            return
+        # prevouts_by_scripthash is no longer stored: the AddressSynchronizer
+        # builds it in memory, from the wallet-relevant txs only
+        self.data.pop('prevouts_by_scripthash', None)
+        self.data['seed_version'] = 2
+
     def _after_upgrade_tasks(self):
         self._called_after_upgrade_tasks = True
         self._load_transactions()
@@ -361,37 +406,17 @@ class WalletDB(JsonDB):
             self.spent_outpoints[prevout_hash] = {}
         self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
 
-    @modifier
-    def add_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int, asset: Optional[str]) -> None:
-        assert isinstance(scripthash, str)
-        assert isinstance(prevout, TxOutpoint)
-        assert isinstance(value, int)
-        if scripthash not in self._prevouts_by_scripthash:
-            self._prevouts_by_scripthash[scripthash] = set()
-        self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value, asset))
-
-    @modifier
-    def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
-        assert isinstance(scripthash, str)
-        assert isinstance(prevout, TxOutpoint)
-        assert isinstance(value, int)
-        self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
-        if not self._prevouts_by_scripthash[scripthash]:
-            self._prevouts_by_scripthash.pop(scripthash)
-
-    @locked
-    def get_prevouts_by_scripthash(self, scripthash: str) -> Set[Tuple[TxOutpoint, int, Optional[str]]]:
-        assert isinstance(scripthash, str)
-        prevouts_and_values = self._prevouts_by_scripthash.get(scripthash, set())
-        return {(TxOutpoint.from_str(prevout), value, asset) for prevout, value, asset in prevouts_and_values}
-
     @modifier
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx_hash, str)
         assert isinstance(tx, Transaction), tx
         # note that tx might be a PartialTransaction
-        # serialize and de-serialize tx now. this might e.g. convert a complete PartialTx to a Tx
-        tx = tx_from_any(str(tx))
+        if isinstance(tx, PartialTransaction):
+            # serialize and de-serialize tx now. this might e.g. convert a complete PartialTx to a Tx
+            tx = tx_from_any(str(tx))
+        else:
+            # keep our own copy, holding only the raw tx. it gets parsed when first needed
+            tx = Transaction(tx.serialize_as_bytes())
         if not tx_hash:
             raise Exception("trying to add tx to db without txid")
         if tx_hash != tx.txid():
@@ -445,6 +470,11 @@ class WalletDB(JsonDB):
     def list_verified_tx(self) -> Sequence[str]:
         return list(self.verified_tx.keys())
 
+    @locked
+    def list_verified_tx_after_height(self, height: int) -> Sequence[str]:
+        assert isinstance(height, int)
+        return self._verified_tx_heights.keys_after_height(height)
+
     @locked
     def get_verified_tx(self, txid: str) -> Optional[TxMinedInfo]:
         assert isinstance(txid, str)
@@ -462,11 +492,13 @@ class WalletDB(JsonDB):
         assert isinstance(txid, str)
         assert isinstance(info, TxMinedInfo)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        self._verified_tx_heights.add(txid, info.height)
 
     @modifier
     def remove_verified_tx(self, txid: str):
         assert isinstance(txid, str)
         self.verified_tx.pop(txid, None)
+        self._verified_tx_heights.remove(txid)
 
     def is_in_verified_tx(self, txid: str) -> bool:
         assert isinstance(txid, str)
@@ -554,12 +586,14 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self.data['addresses'].mark_modified('change')
 
     @modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self.data['addresses'].mark_modified('receiving')
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -571,6 +605,12 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self.imported_addresses[addr] = d
 
+    @modifier
+    def add_imported_addresses(self, addrs: Dict[str, dict]) -> None:
+        for addr, d in addrs.items():
+            assert isinstance(addr, str)
+            self.imported_addresses[addr] = d
+
     @modifier
     def remove_imported_address(self, addr: str) -> None:
         assert isinstance(addr, str)
@@ -627,11 +667,46 @@ class WalletDB(JsonDB):
         self.verified_restricted_freezes = self.get_dict('verified_freezes')
         self.verified_broadcasts = self.get_dict('verified_broadcasts')
         self.verified_associations = self.get_dict('verified_associations')
+        self._build_verified_asset_height_indexes()
         self.asset_blacklist = self.get('asset_blacklist')  # type: Set[str]
 
         self.my_swaps = self.get_dict('atomic_swap')
         self.my_output_to_swap_id = self.get_dict('outpoint_to_swap_id')
 
+    def _build_verified_asset_height_indexes(self):
+        self._verified_asset_metadata_heights = HeightIndex()
+        for asset, (_, (_, height), _, _) in self.verified_asset_metadata.items():
+            self._verified_asset_metadata_heights.add(asset, height)
+        self._verified_restricted_verifier_heights = HeightIndex()
+        for asset, d in self.verified_restricted_verifiers.items():
+            self._verified_restricted_verifier_heights.add(asset, d['height'])
+        self._verified_restricted_freeze_heights = HeightIndex()
+        for asset, d in self.verified_restricted_freezes.items():
+            self._verified_restricted_freeze_heights.add(asset, d['height'])
+        self._verified_broadcast_heights = HeightIndex()
+        for asset, d1 in self.verified_broadcasts.items():
+            for tx_hash, d2 in d1.items():
+                self._verified_broadcast_heights.add((asset, tx_hash), d2['height'])
+        self._verified_association_heights = HeightIndex()
+        for asset, res_dict in self.verified_associations.items():
+            for res, d in res_dict.items():
+                self._verified_association_heights.add((asset, res), d['height'])
+        self._verified_qualifier_tag_heights = HeightIndex()
+        for asset, h160_dict in self.verified_tags_for_qualifiers.items():
+            for h160, d in h160_dict.items():
+                self._verified_qualifier_tag_heights.add((asset, h160), d['height'])
+        self._verified_h160_tag_heights = HeightIndex()
+        for h160, asset_dict in self.verified_tags_for_h160s.items():
+            for asset, d in asset_dict.items():
+                self._verified_h160_tag_heights.add((h160, asset), d['height'])
+
+    @staticmethod
+    def _group_keys(keys: Iterable[Tuple[str, str]]) -> Dict[str, Set[str]]:
+        d = defaultdict(set)
+        for outer, inner in keys:
+            d[outer].add(inner)
+        return d
+
     @locked
     def get_swap_id_for_outpoint(self, outpoint: TxOutpoint) -> Optional[str]:
         assert isinstance(outpoint, TxOutpoint)
@@ -672,10 +747,12 @@ class WalletDB(JsonDB):
     @modifier
     def remove_broadcast_to_watch(self, asset):
         self.broadcasts_to_watch.discard(asset)
+        self.data.mark_modified('broadcasts_to_watch')
 
     @modifier
     def add_broadcast_to_watch(self, asset):
         self.broadcasts_to_watch.add(asset)
+        self.data.mark_modified('broadcasts_to_watch')
 
     @locked
     def get_asset_blacklist_regex_list(self) -> Sequence[str]:
@@ -685,10 +762,12 @@ class WalletDB(JsonDB):
     def update_asset_blacklist_regex_list(self, l):
         self.asset_blacklist.clear()
         self.asset_blacklist.update(l)
+        self.data.mark_modified('asset_blacklist')
 
     @modifier
     def add_asset_blacklist_regex(self, r):
         self.asset_blacklist.add(r)
+        self.data.mark_modified('asset_blacklist')
 
     @locked
     def is_non_deterministic_txo_lockingscript(self, outpoint: TxOutpoint) -> bool:
@@ -699,11 +778,13 @@ class WalletDB(JsonDB):
     def add_non_deterministic_txo_lockingscript(self, outpoint: TxOutpoint):
         assert isinstance(outpoint, TxOutpoint)
         self.non_deterministic_vouts.add(outpoint.to_str())
+        self.data.mark_modified('non_deterministic_txo_scriptpubkey')
 
     @modifier
     def remove_non_deterministic_txo_lockingscript(self, outpoint: TxOutpoint):
         assert isinstance(outpoint, TxOutpoint)
         self.non_deterministic_vouts.discard(outpoint.to_str())
+        self.data.mark_modified('non_deterministic_txo_scriptpubkey')
 
     @locked
     def get_assets_to_watch(self) -> Sequence[str]:
@@ -719,6 +800,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert (error := get_error_for_asset_name(asset) is None), error
         self.assets_to_watch.add(asset)
+        self.data.mark_modified('assets_to_watch')
 
     @modifier
     def add_verified_asset_metadata(self, asset: str, metadata: StrictAssetMetadata, source_tup: Tuple[TxOutpoint, int], source_divisions_tup: Optional[Tuple[TxOutpoint, int]], source_associated_data_tup: Optional[Tuple[TxOutpoint, int]]):
@@ -740,6 +822,7 @@ class WalletDB(JsonDB):
             assert isinstance(source_associated_data_tup[1], int)
 
         self.verified_asset_metadata[asset] = metadata, source_tup, source_divisions_tup, source_associated_data_tup
+        self._verified_asset_metadata_heights.add(asset, source_tup[1])
 
     @locked
     def get_verified_asset_metadata(self, asset: str) -> Optional[StrictAssetMetadata]:
@@ -769,15 +852,12 @@ class WalletDB(JsonDB):
     @locked
     def get_assets_verified_after_height(self, height: int) -> Sequence[str]:
         assert isinstance(height, int)
-        assets = []
-        for asset, (_, (_, verified_height), _, _) in self.verified_asset_metadata.items():
-            if verified_height > height:
-                assets.append(asset)
-        return assets
+        return self._verified_asset_metadata_heights.keys_after_height(height)
 
     @modifier
     def remove_verified_asset_metadata(self, asset: str):
         assert isinstance(asset, str)
+        self._verified_asset_metadata_heights.remove(asset)
         return self.verified_asset_metadata.pop(asset, None)
 
     @locked
@@ -789,6 +869,7 @@ class WalletDB(JsonDB):
     def remove_verified_restricted_verifier(self, asset: str):
         assert isinstance(asset, str)
         self.verified_restricted_verifiers.pop(asset)
+        self._verified_restricted_verifier_heights.remove(asset)
 
     @modifier
     def add_verified_restricted_verifier(self, asset: str, d):
@@ -799,15 +880,12 @@ class WalletDB(JsonDB):
         assert isinstance(d['height'], int)
         assert isinstance(d['string'], str)
         self.verified_restricted_verifiers[asset] = d
+        self._verified_restricted_verifier_heights.add(asset, d['height'])
 
     @locked
     def get_verified_restricted_verifier_after_height(self, height: int) -> Set[str]:
         assert isinstance(height, int)
-        s = set()
-        for asset, d in self.verified_restricted_verifiers.items():
-            if d['height'] > height:
-                s.add(asset)
-        return s
+        return set(self._verified_restricted_verifier_heights.keys_after_height(height))
 
     @locked
     def get_verified_restricted_freeze(self, asset: str) -> Optional[Dict[str, Any]]:
@@ -818,6 +896,7 @@ class WalletDB(JsonDB):
     def remove_verified_restricted_freeze(self, asset: str):
         assert isinstance(asset, str)
         self.verified_restricted_freezes.pop(asset)
+        self._verified_restricted_freeze_heights.remove(asset)
 
     @modifier
     def add_verified_restricted_freeze(self, asset: str, d):
@@ -827,15 +906,12 @@ class WalletDB(JsonDB):
         assert isinstance(d['height'], int)
         assert isinstance(d['frozen'], bool)
         self.verified_restricted_freezes[asset] = d
+        self._verified_restricted_freeze_heights.add(asset, d['height'])
 
     @locked
     def get_verified_restricted_freezes_after_height(self, height: int) -> Set[str]:
         assert isinstance(height, int)
-        s = set()
-        for asset, d in self.verified_restricted_freezes.items():
-            if d['height'] > height:
-                s.add(asset)
-        return s
+        return set(self._verified_restricted_freeze_heights.keys_after_height(height))
 
     @locked
     def get_verified_broadcasts(self, asset: str) -> Dict[str, Dict[str, Any]]:
@@ -853,6 +929,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(tx_hash, str)
         self.verified_broadcasts.get(asset, dict()).pop(tx_hash, None)
+        self._verified_broadcast_heights.remove((asset, tx_hash))
 
     @modifier
     def add_verified_broadcast(self, asset: str, tx_hash: str, d):
@@ -867,18 +944,12 @@ class WalletDB(JsonDB):
         if asset not in self.verified_broadcasts:
             self.verified_broadcasts[asset] = dict()
         self.verified_broadcasts[asset][tx_hash] = d
+        self._verified_broadcast_heights.add((asset, tx_hash), d['height'])
 
     @locked
     def get_verified_broadcasts_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
-        d = dict()
-        for asset, d1 in self.verified_broadcasts.items():
-            for tx_hash, d2 in d1.items():
-                if d2['height'] > height:
-                    if asset not in d:
-                        d[asset] = set()
-                    d[asset].add(tx_hash)
-        return d
+        return dict(self._group_keys(self._verified_broadcast_heights.keys_after_height(height)))
 
     @locked
     def get_verified_associations(self, asset: str) -> Dict[str, Dict[str, Any]]:
@@ -890,6 +961,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(res, str)
         self.verified_associations.get(asset, dict()).pop(res, None)
+        self._verified_association_heights.remove((asset, res))
 
     @modifier
     def add_verified_association(self, asset: str, res: str, d):
@@ -903,16 +975,12 @@ class WalletDB(JsonDB):
         if self.verified_associations.get(asset) is None:
             self.verified_associations[asset] = dict()
         self.verified_associations[asset][res] = d
+        self._verified_association_heights.add((asset, res), d['height'])
 
     @locked
     def get_verified_associations_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
-        d = defaultdict(set)
-        for asset, res_dict in self.verified_associations.items():
-            for res, d1 in res_dict.items():
-                if d1['height'] > height:
-                    d[asset].add(res)
-        return d
+        return self._group_keys(self._verified_association_heights.keys_after_height(height))
 
     @locked
     def get_verified_qualifier_tags(self, asset: str) -> Dict[str, Dict[str, Any]]:
@@ -937,6 +1005,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(h160, str)
         self.verified_tags_for_qualifiers.get(asset, dict()).pop(h160, None)
+        self._verified_qualifier_tag_heights.remove((asset, h160))
         # Do not pop off top level key
 
     @modifier
@@ -950,16 +1019,12 @@ class WalletDB(JsonDB):
         if self.verified_tags_for_qualifiers.get(asset) is None:
             self.verified_tags_for_qualifiers[asset] = dict()
         self.verified_tags_for_qualifiers[asset][h160] = d
+        self._verified_qualifier_tag_heights.add((asset, h160), d['height'])
 
     @locked
     def get_verified_qualifier_tags_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
-        d = defaultdict(set)
-        for asset, h160_dict in self.verified_tags_for_qualifiers.items():
-            for h160, d1 in h160_dict.items():
-                if d1['height'] > height:
-                    d[asset].add(h160)
-        return d
+        return self._group_keys(self._verified_qualifier_tag_heights.keys_after_height(height))
 
     @locked
     def get_verified_h160_tags(self, h160: str) -> Dict[str, Dict[str, Any]]:
@@ -982,6 +1047,7 @@ class WalletDB(JsonDB):
         assert isinstance(asset, str)
         assert isinstance(h160, str)
         self.verified_tags_for_h160s.get(h160, dict()).pop(asset, None)
+        self._verified_h160_tag_heights.remove((h160, asset))
         # Do not pop off top level key
 
     @modifier
@@ -995,20 +1061,19 @@ class WalletDB(JsonDB):
         if self.verified_tags_for_h160s.get(h160) is None:
             self.verified_tags_for_h160s[h160] = dict()
         self.verified_tags_for_h160s[h160][asset] = d
+        self._verified_h160_tag_heights.add((h160, asset), d['height'])
 
     @locked
     def get_verified_h160_tags_after_height(self, height: int) -> Dict[str, Set[str]]:
         assert isinstance(height, int)
-        d = defaultdict(set)
-        for h160, asset_dict in self.verified_tags_for_h160s.items():
-            for asset, d1 in asset_dict.items():
-                if d1['height'] > height:
-                    d[h160].add(asset)
-        return d
+        return self._group_keys(self._verified_h160_tag_heights.keys_after_height(height))
 
     @profiler
     def _load_transactions(self):
+        # anything changed so far (new db, upgrades) was not tracked
+        needs_full_write = self.modified()
         self.data = StoredDict(self.data, self, [])
+        self._start_tracking_changes(needs_full_write=needs_full_write)
         # references in self.data
         # TODO make all these private
         # txid -> address -> prev_outpoint -> value
@@ -1019,9 +1084,10 @@ class WalletDB(JsonDB):
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
+        self._verified_tx_heights = HeightIndex()
+        for txid, (height, *_) in self.verified_tx.items():
+            self._verified_tx_heights.add(txid, height)
         self.tx_fees = self.get_dict('tx_fees')                  # type: Dict[str, TxFeesValue]
-        # scripthash -> set of (outpoint, value)
-        self._prevouts_by_scripthash = self.get_dict('prevouts_by_scripthash')  # type: Dict[str, Set[Tuple[str, int]]]
         # remove unreferenced tx
         for tx_hash in list(self.transactions.keys()):
             if not self.get_txi_addresses(tx_hash) and not self.get_txo_addresses(tx_hash):
@@ -1043,8 +1109,8 @@ class WalletDB(JsonDB):
         self.transactions.clear()
         self.history.clear()
         self.verified_tx.clear()
+        self._verified_tx_heights.clear()
         self.tx_fees.clear()
-        self._prevouts_by_scripthash.clear()
 
     def _should_convert_to_stored_dict(self, key) -> bool:
         if key == 'keystore':